@@ -32,21 +32,16 @@ THE ALGORITHM
 """
 
 # import devices
-import pyvisa
-import devices
+import asyncio
 import os
 import sys
-import fcntl
-from time import sleep
 import psutil
-from pynput.keyboard import Key, Controller
 # from subprocess import Popen, PIPE, run
 import subprocess
-from metavision_core.event_io import EventsIterator, LiveReplayEventsIterator, is_live_camera
-from metavision_sdk_analytics import TrackingAlgorithm, TrackingConfig
-from metavision_sdk_core import OnDemandFrameGenerationAlgorithm
-from metavision_sdk_cv import ActivityNoiseFilterAlgorithm, TrailFilterAlgorithm
-from metavision_sdk_ui import EventLoop
+from evk_tracking.sync import CommandLog
+from evk_tracking.instruments import InstrumentManager
+from evk_tracking.runplan import RunPlanScheduler, load_plan
+from evk_tracking.camera import reset_camera
 
 # savingLocation = "/home/levitech/millen2/MacroTrap/DATA/20220720/HE_ramping_plus_noise_1.0V/signal/"
 savingLocation = "/home/levitech/millen2/ElectroMech/Data/20221219/Optimize_Biases/signal/"
@@ -57,10 +52,6 @@ uf = 1000
 bmax = 220
 bmin = 0
 
-EVKcommand_novid  = "python3 evk_tracking_wo_video.py " + " -bf " + biasFileLocation + " -csv " + savingLocation + " -csvt " + str(duration) + " -csvn " + str(NFiles) + " -uf " + str(uf) + " -mins " + str(bmin) + " -maxs " + str(bmax)
-
-EVKcommand_vid = "python3 evk_tracking_video.py -dbb True " + " -mins " + str(bmin) + " -maxs " + str(bmax) + " -bf " + biasFileLocation + " -csv " + savingLocation + " -csvt " + str(duration) + " -csvn " + str(NFiles) + " -uf " + str(uf)
-
 # def ChangeEVKBias(biasFile, SearchBias, newValue):
 #         tempFile = open( biasFile, 'r+' )
 #         for line in fileinput.input( fileToSearch ):
@@ -71,49 +62,43 @@ EVKcommand_vid = "python3 evk_tracking_video.py -dbb True " + " -mins " + str(bm
 #             tempFile.write( line.replace( SearchBias, textToReplace ) )
 #         tempFile.close()
 
-EVKMetaCommand = "metavision_player"
-
 PORT = 'ASRL/dev/ttyUSB2::INSTR'
-ds335 = devices.ds335(PORT)
+NRuns = 2
+# python3 EVKbiasesOptimization.py --plan HeatEnginePlan.yaml runs the cycles of a plan file (see evk_tracking/runplan.py),
+# otherwise NRuns runs are recorded with the values above. Completed runs are skipped when the script is started again.
+# --simulate runs the cycle sequencing with a simulated DS335 and no camera
+simulate = '--simulate' in sys.argv
+if '--plan' in sys.argv:
+    plan = load_plan(sys.argv[sys.argv.index('--plan') + 1])
+else:
+    plan = {'name': 'default', 'saving_location': savingLocation, 'bias_file': biasFileLocation, 'port': PORT,
+            'defaults': {'duration': duration, 'files': NFiles, 'update_frequency': uf, 'min_size': bmin, 'max_size': bmax, 'video': True},
+            'cycles': [{'name': 'HE', 'repeats': NRuns}]}
+
+# Every command sent to the DS335 is logged with the host clock, the tracker aligns it with the camera time
+os.makedirs(plan['saving_location'], exist_ok=True)
+commandLog = CommandLog(os.path.join(plan['saving_location'], 'sync_commands.csv'))
+
+
+def recover_camera():
+    """
+    Resets the sensor through the SDK after the tracker failed.
+    """
+    print("EBC script was killed... resetting the camera...")
+    try:
+        print("Camera reset in {:.2f}s".format(reset_camera()))
+    except Exception as e:
+        print("Camera reset failed: " + str(e))
+    print(psutil.virtual_memory().available * 100 / psutil.virtual_memory().total)
 
-k = 0;
-print('Run Begun')
-ds335.sendCmd('OFFS 0')
 
-while k<2:
-    k += 1
-    print('Run No: ' + str(k-1))
-    ds335.sendCmd('OFFS 2')
-    try:
-        process = subprocess.run(EVKcommand_vid, shell = True, check=True, stdout = subprocess.PIPE)
-        print(psutil.virtual_memory().available * 100 / psutil.virtual_memory().total)
-    except subprocess.CalledProcessError:
-        sleep(5)
-        print("EBC script was killed... restarting metavision...")
-        p = subprocess.Popen("exec " + EVKMetaCommand, stdin=subprocess.PIPE, shell=True)
-        sleep(5)
-        keyboard = Controller()
-        key = "q"
-        keyboard.press(key)
-        keyboard.release(key)
-        p.kill()
-
-        p = subprocess.Popen("exec " + EVKMetaCommand, stdin=subprocess.PIPE, shell=True)
-        sleep(5)
-        keyboard = Controller()
-        key = "q"
-        keyboard.press(key)
-        keyboard.release(key)
-        p.kill()
-
-        print("reset done using metavision_player")
-    except:
-        print("Something else went wrong")
-
-    sleep(5)
-
-
-    ds335.sendCmd('OFFS 0')
-    # print('Offset Value: ' + str(ds335.getStatus()))
-
-ds335.sendCmd('OFFS 0')
+async def heat_engine():
+    async with InstrumentManager(simulate=simulate, command_log=commandLog) as instruments:
+        print('Run Begun')
+        scheduler = RunPlanScheduler(plan, instruments, on_failure=None if simulate else recover_camera, command_log=commandLog,
+                                     tracker_command=(lambda run: "sleep " + str(run['duration'] * run['files'])) if simulate else None)
+        await scheduler.run()
+
+
+asyncio.run(heat_engine())
+commandLog.close()
@@ -0,0 +1,124 @@
+"""
+Benchmark of the event codec (evk_tracking/codec.py) against zlib and the RAW file: size per event and encoding /
+decoding rates, for 1 to [threads] threads.
+
+    python3 benchmarks/codec_benchmark.py -i recording.raw -pt 20
+    python3 benchmarks/codec_benchmark.py              # synthetic events of a particle (evk_tracking.camera.FakeEventsIterator)
+
+With a RAW file, the decoding rate of the SDK (EventsIterator) and the size of the RAW data are the reference.
+"""
+
+import os
+import sys
+import time
+import zlib
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from evk_tracking.codec import encode_blocks, decode_blocks
+from evk_tracking.common import EVENT_DTYPE
+
+
+def load_raw(path, duration):
+    from metavision_core.event_io import EventsIterator
+    start = time.perf_counter()
+    mv_iterator = EventsIterator(input_path=path, delta_t=100000, max_duration=duration * 1e6 if duration else None)
+    evs = np.concatenate([np.array(batch, dtype=EVENT_DTYPE) for batch in mv_iterator])
+    decode_time = time.perf_counter() - start
+    if duration:
+        # The RAW size of the decoded range is estimated from the share of the recording it covers
+        from evk_tracking.rawindex import RawIndex
+        index = RawIndex.load(path)
+        end = np.searchsorted(index.t, index.t_base + evs['t'][-1])
+        raw_bytes = (index.offset[min(end, len(index.offset) - 1)] - index.header_size)
+    else:
+        raw_bytes = os.path.getsize(path)
+    return evs, raw_bytes, decode_time
+
+
+def synthetic_events(n_events):
+    from evk_tracking.camera import FakeEventsIterator
+    batches = []
+    n = 0
+    for batch in FakeEventsIterator(realtime=False, delta_t=10000, rate=2e6):
+        batches.append(batch)
+        n += len(batch)
+        if n >= n_events:
+            break
+    return np.concatenate(batches)
+
+
+def parse_args():
+    import argparse
+    """
+    Parse command line arguments.
+    """
+    parser = argparse.ArgumentParser(description='Event codec benchmark.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-i', '--input-raw-file', dest='input_path', type=str, default='',
+                        help='RAW file. If not specified, synthetic events are used.')
+    parser.add_argument('-pt', '--process-to', dest='process_to', type=float, default=10,
+                        help='Duration of the RAW file that is used (0 = whole file). Unit: seconds. Default: 10s.')
+    parser.add_argument('-n', '--events', dest='events', type=int, default=5000000,
+                        help='Number of synthetic events. Default: 5000000.')
+    parser.add_argument('-c', '--chunk-events', dest='chunk_events', type=int, default=1 << 18,
+                        help='Events per block. Default: 262144.')
+    parser.add_argument('-j', '--threads', dest='threads', type=int, default=os.cpu_count(),
+                        help='Maximum number of threads. Default: number of CPUs.')
+    parser.add_argument('-r', '--repeats', dest='repeats', type=int, default=3,
+                        help='Repeats of each measurement (the best one is kept). Default: 3.')
+    return parser.parse_args()
+
+
+def best_time(fn, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main():
+    """
+    Main
+    """
+    args = parse_args()
+    if args.input_path:
+        evs, raw_bytes, raw_decode_time = load_raw(args.input_path, args.process_to)
+        print(f'{args.input_path}: {len(evs)} events, RAW {raw_bytes / len(evs):.3f} bytes/event, '
+              f'SDK decoding {len(evs) / raw_decode_time / 1e6:.2f} Mev/s')
+    else:
+        evs = synthetic_events(args.events)
+        raw_bytes = None
+        print(f'Synthetic events: {len(evs)} events')
+
+    blocks = [evs[i:i + args.chunk_events] for i in range(0, len(evs), args.chunk_events)]
+    thread_counts = sorted({1, args.threads} | {n for n in (2, 4, 8) if n < args.threads})
+
+    print(f"{'codec':>8} {'threads':>7} {'bytes/event':>11} {'vs RAW':>7} {'encode Mev/s':>12} {'decode Mev/s':>12}")
+    for codec, threads in [('zlib', 1)] + [('evkc1', threads) for threads in thread_counts]:
+        if codec == 'zlib':
+            def encode():
+                return [zlib.compress(block.tobytes(), 1) for block in blocks]
+
+            def decode():
+                return [np.frombuffer(zlib.decompress(data), dtype=EVENT_DTYPE) for data in encoded]
+        else:
+            def encode():
+                return encode_blocks(blocks, threads=threads)
+
+            def decode():
+                return decode_blocks(encoded, threads=threads)
+        encode_time, encoded = best_time(encode, args.repeats)
+        decode_time, decoded = best_time(decode, args.repeats)
+        if not np.array_equal(np.concatenate(decoded), evs):
+            print(f'{codec}: the decoded events differ from the original ones!')
+        size = sum(len(data) for data in encoded)
+        ratio = f'{size / raw_bytes:7.3f}' if raw_bytes else f"{'-':>7}"
+        print(f'{codec:>8} {threads:>7} {size / len(evs):11.3f} {ratio} {len(evs) / encode_time / 1e6:12.2f} '
+              f'{len(evs) / decode_time / 1e6:12.2f}')
+
+
+if __name__ == "__main__":
+        main()
@@ -0,0 +1,150 @@
+"""
+Benchmark of the numpy activity and trail filters (evk_tracking/filters.py) against the SDK filters: processing rate of
+each backend and agreement of the kept events, for several ROI sizes and event batch durations.
+
+    python3 benchmarks/filter_benchmark.py -i recording.raw -pt 10 --roi 64,128,0 -dt 100,1000,10000
+    python3 benchmarks/filter_benchmark.py       # synthetic particle events (evk_tracking.camera.FakeEventsIterator) and noise
+
+The events are cropped to a square ROI of each size around the center of the sensor (0 = whole sensor), then
+cut into batches of -dt us, as the trackers receive them. Agreement: events kept by both backends over the events
+kept by either of them.
+"""
+
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from evk_tracking.common import EVENT_DTYPE
+from evk_tracking.filters import EventFilters
+
+
+def load_raw(path, duration):
+    from metavision_core.event_io import EventsIterator
+    mv_iterator = EventsIterator(input_path=path, delta_t=100000, max_duration=duration * 1e6 if duration else None)
+    height, width = mv_iterator.get_size()
+    evs = np.concatenate([np.array(batch, dtype=EVENT_DTYPE) for batch in mv_iterator])
+    return evs, width, height
+
+
+def synthetic_events(n_events, noise_fraction):
+    from evk_tracking.camera import FakeEventsIterator
+    fake = FakeEventsIterator(realtime=False, delta_t=10000, rate=2e6)
+    batches = []
+    n = 0
+    for batch in fake:
+        batches.append(batch)
+        n += len(batch)
+        if n >= n_events:
+            break
+    evs = np.concatenate(batches)
+    # Uncorrelated background events, which the activity filter should remove
+    rng = np.random.default_rng(1)
+    noise = np.empty(int(len(evs) * noise_fraction), dtype=EVENT_DTYPE)
+    noise['t'] = rng.integers(0, evs['t'][-1], len(noise))
+    noise['x'] = rng.integers(0, fake.width, len(noise))
+    noise['y'] = rng.integers(0, fake.height, len(noise))
+    noise['p'] = rng.integers(0, 2, len(noise))
+    evs = np.concatenate((evs, noise))
+    return evs[np.argsort(evs['t'], kind='stable')], fake.width, fake.height
+
+
+def crop(evs, width, height, size):
+    """
+    Events of the square ROI of side [size] at the center of the sensor, in ROI coordinates, and the ROI size.
+    """
+    if size <= 0 or size >= max(width, height):
+        return evs, width, height
+    x0, y0 = (width - size) // 2, (height - size) // 2
+    inside = (evs['x'] >= x0) & (evs['x'] < x0 + size) & (evs['y'] >= y0) & (evs['y'] < y0 + size)
+    cropped = evs[inside]
+    cropped['x'] -= x0
+    cropped['y'] -= y0
+    return cropped, size, size
+
+
+def run_filters(evs, width, height, delta_t, args, backend):
+    """
+    Returns (kept events, processing time) of one backend; the batches are cut before timing.
+    """
+    bounds = np.searchsorted(evs['t'], np.arange(evs['t'][0], evs['t'][-1] + delta_t, delta_t))
+    batches = [evs[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+    event_filters = EventFilters(width, height, args.activity_time_ths, args.activity_ths, args.activity_trail_ths,
+                                 backend=backend)
+    kept = []
+    start = time.perf_counter()
+    for batch in batches:
+        # The output of the SDK backend is only valid until the next call
+        kept.append(np.array(event_filters.process_events(batch)))
+    elapsed = time.perf_counter() - start
+    return np.concatenate(kept), elapsed
+
+
+def parse_args():
+    import argparse
+    """
+    Parse command line arguments.
+    """
+    parser = argparse.ArgumentParser(description='Activity and trail filters benchmark.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-i', '--input-raw-file', dest='input_path', type=str, default='',
+                        help='RAW file. If not specified, synthetic events are used.')
+    parser.add_argument('-pt', '--process-to', dest='process_to', type=float, default=10,
+                        help='Duration of the RAW file that is used (0 = whole file). Unit: seconds. Default: 10s.')
+    parser.add_argument('-n', '--events', dest='events', type=int, default=2000000,
+                        help='Number of synthetic particle events. Default: 2000000.')
+    parser.add_argument('--noise', dest='noise', type=float, default=0.2,
+                        help='Synthetic background events, as a fraction of the particle events. Default: 0.2.')
+    parser.add_argument('--roi', dest='roi', type=str, default='64,128,0',
+                        help='Comma separated sides of the square ROIs (0 = whole sensor). Unit: pixels. Default: 64,128,0.')
+    parser.add_argument('-dt', '--delta-t', dest='delta_t', type=str, default='100,10000',
+                        help='Comma separated durations of the event batches. Unit: us. Default: 100,10000.')
+    parser.add_argument('--activity-time-ths', dest='activity_time_ths', type=int, default=10000,
+                        help='Length of the time window for activity filtering. Unit: us. Default: 10000us.')
+    parser.add_argument('--activity-ths', dest='activity_ths', type=int, default=1,
+                        help='Minimum number of active pixels in the neighborhood (numpy filters). Default: 1.')
+    parser.add_argument('--activity-trail-ths', dest='activity_trail_ths', type=int, default=1000,
+                        help='Length of the time window for trail filtering. Unit: us. Default: 1000us.')
+    return parser.parse_args()
+
+
+def main():
+    """
+    Main
+    """
+    args = parse_args()
+    if args.input_path:
+        evs, width, height = load_raw(args.input_path, args.process_to)
+        print(f'{args.input_path}: {len(evs)} events, {width}x{height}')
+    else:
+        evs, width, height = synthetic_events(args.events, args.noise)
+        print(f'Synthetic events: {len(evs)} events, {width}x{height}')
+
+    backends = ['numpy']
+    try:
+        import metavision_sdk_cv  # noqa: F401
+        backends.insert(0, 'sdk')
+    except ImportError:
+        print('metavision_sdk_cv is not available: only the numpy filters are measured.')
+
+    print(f"{'roi':>9} {'dt us':>6} {'events':>9} {'backend':>7} {'kept':>6} {'Mev/s':>7} {'agreement':>9}")
+    for size in [int(v) for v in args.roi.split(',')]:
+        roi_evs, roi_width, roi_height = crop(evs, width, height, size)
+        if len(roi_evs) == 0:
+            continue
+        for delta_t in [int(v) for v in args.delta_t.split(',')]:
+            results = {backend: run_filters(roi_evs, roi_width, roi_height, delta_t, args, backend) for backend in backends}
+            for backend, (kept, elapsed) in results.items():
+                agreement = '-'
+                if backend == 'numpy' and 'sdk' in results:
+                    reference = results['sdk'][0]
+                    both = len(np.intersect1d(kept, reference))
+                    either = len(kept) + len(reference) - both
+                    agreement = f'{both / max(either, 1):.4f}'
+                print(f'{roi_width:>4}x{roi_height:<4} {delta_t:>6} {len(roi_evs):>9} {backend:>7} '
+                      f'{len(kept) / len(roi_evs):6.3f} {len(roi_evs) / elapsed / 1e6:7.2f} {agreement:>9}')
+
+
+if __name__ == "__main__":
+        main()
@@ -0,0 +1,97 @@
+"""
+Startup time of the tracking modes (python3 -m evk_tracking [mode]): time to start a new interpreter and import
+the module of each mode, as EVKbiasesOptimization.py does for every run, and the import time of the heavy
+modules alone (OpenCV, matplotlib, Metavision UI...), to see what each mode pays for.
+
+    python3 benchmarks/startup_benchmark.py -r 10
+    python3 benchmarks/startup_benchmark.py --importtime headless     # slowest imports of a mode (python3 -X importtime)
+
+A module that cannot be imported here (e.g. the Metavision SDK is not installed) is reported as such.
+"""
+
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from evk_tracking.cli import COMMANDS
+
+HEAVY_MODULES = ['numpy', 'cv2', 'matplotlib.pyplot', 'metavision_core.event_io', 'metavision_sdk_core',
+                 'metavision_sdk_cv', 'metavision_sdk_analytics', 'metavision_sdk_ui']
+
+
+def time_import(statement, repeats):
+    """
+    Returns (best, median) time in seconds of a new interpreter running statement, or None if it fails.
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, '-c', statement], cwd=ROOT, stdout=subprocess.DEVNULL,
+                                 stderr=subprocess.PIPE)
+        times.append(time.perf_counter() - start)
+        if process.returncode != 0:
+            return None, process.stderr.decode(errors='replace').strip().splitlines()[-1]
+    times.sort()
+    return (times[0], times[len(times) // 2]), ''
+
+
+def slowest_imports(module, count):
+    """
+    Parses the output of python3 -X importtime: the [count] modules with the largest cumulative import time.
+    """
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], cwd=ROOT,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    rows = []
+    for line in process.stderr.decode(errors='replace').splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        rows.append((int(cumulative), name.rstrip()))
+    rows.sort(reverse=True)
+    return rows[:count]
+
+
+def parse_args():
+    import argparse
+    """
+    Parse command line arguments.
+    """
+    parser = argparse.ArgumentParser(description='Startup time of the tracking modes.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-r', '--repeats', dest='repeats', type=int, default=5,
+                        help='Interpreter starts per measurement (best and median are printed). Default: 5.')
+    parser.add_argument('--importtime', dest='importtime', type=str, default='', choices=[''] + list(COMMANDS),
+                        help='Prints the slowest imports of this mode instead. Default: \'\'.')
+    return parser.parse_args()
+
+
+def main():
+    """
+    Main
+    """
+    args = parse_args()
+    if args.importtime:
+        module, _ = COMMANDS[args.importtime]
+        print(f"{'cumulative ms':>13}  module")
+        for cumulative, name in slowest_imports(module, 20):
+            print(f'{cumulative / 1000:13.1f}  {name}')
+        return
+
+    print(f"{'import':<32} {'best ms':>8} {'median ms':>9}")
+    baseline, _ = time_import('pass', args.repeats)
+    print(f"{'(interpreter only)':<32} {baseline[0] * 1e3:8.1f} {baseline[1] * 1e3:9.1f}")
+    rows = [(f'mode {name}', module) for name, (module, _) in COMMANDS.items()]
+    rows += [(module, module) for module in HEAVY_MODULES]
+    for label, module in rows:
+        times, error = time_import(f'import {module}', args.repeats)
+        if times is None:
+            print(f'{label:<32} {"-":>8} {"-":>9}  ({error})')
+        else:
+            print(f'{label:<32} {times[0] * 1e3:8.1f} {times[1] * 1e3:9.1f}')
+
+
+if __name__ == "__main__":
+        main()
@@ -0,0 +1,9 @@
+"""
+Event-based tracking of levitated particles with the Prophesee EVK cameras (Metavision SDK).
+
+The tracking modes are run with python3 -m evk_tracking [mode] (see cli.py). Importing the package imports
+nothing else: every module loads its own dependencies, and the Metavision SDK, OpenCV and matplotlib are only
+loaded by the modes that use them.
+"""
+
+__version__ = '1.0.0'
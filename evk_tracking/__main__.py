@@ -0,0 +1,3 @@
+from evk_tracking.cli import main
+
+main()
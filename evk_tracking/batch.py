@@ -0,0 +1,227 @@
+"""
+Offline batch reprocessing of RAW recordings (or .evk event files, see eventfile.py) over a grid of tracking
+parameters.
+
+Every combination of the parameters given as comma separated lists (e.g. -uf 500,1000 -maxs 100,220)
+is run on every input file by a pool of processes. The events are read as fast as possible (no
+LiveReplayEventsIterator pacing) and go through the same filters and tracking algorithm as in
+headless.py. For each configuration, the quality metrics of quality_metrics() are collected
+into one summary CSV, and optionally the tracks are saved (9 columns, as the CSV files of the trackers).
+The accumulation time (-at) of the trackers is not scanned: it only sets the frames that are displayed or
+recorded, the tracking algorithm does not use it.
+
+Example:
+    python3 -m evk_tracking batch -i run.raw -uf 500,1000 -maxs 100,220 --activity-trail-ths 1000,5000 -o summary.csv
+"""
+
+import csv
+import itertools
+import os
+import time
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+
+from evk_tracking.pipeline import RESULT_DTYPE, results_to_records
+from evk_tracking.rawindex import open_events
+from evk_tracking.filters import EventFilters
+
+
+# Parameters that can be scanned, with their command line option and default value
+GRID_PARAMETERS = {
+    'update_frequency': ('-uf', int, [1000]),
+    'min_size': ('-mins', int, [10]),
+    'max_size': ('-maxs', int, [100]),
+    'activity_time_ths': ('--activity-time-ths', int, [10000]),
+    'activity_ths': ('--activity-ths', int, [1]),
+    'activity_trail_ths': ('--activity-trail-ths', int, [1000]),
+    'filters': ('--filters', str, ['sdk']),
+}
+
+METRIC_FIELDS = ['rows', 'updates', 'expected_updates', 'coverage', 'objects', 'dominant_id', 'dominant_fraction',
+                 'id_switches', 'max_gap_us', 'events', 'processing_time', 'events_per_second']
+
+
+def track_file(input_path, config, process_from=0, process_to=None, delta_t=10000):
+    """
+    Runs the filters and the tracking algorithm on a RAW or .evk file with the parameters of config.
+    Returns (tracking results as RESULT_DTYPE records, number of events read, first and last event timestamps).
+    """
+    from metavision_sdk_analytics import TrackingAlgorithm, TrackingConfig
+
+    mv_iterator = open_events(input_path=input_path, start_ts=process_from,
+                              max_duration=process_to - process_from if process_to else None, delta_t=delta_t)
+    sensor_height, sensor_width = mv_iterator.get_size()
+
+    event_filters = EventFilters(sensor_width, sensor_height, config['activity_time_ths'], config['activity_ths'],
+                                 config['activity_trail_ths'], backend=config['filters'])
+
+    tracking_algo = TrackingAlgorithm(sensor_width=sensor_width, sensor_height=sensor_height, tracking_config=TrackingConfig())
+    tracking_algo.update_frequency = float(config['update_frequency'])
+    tracking_algo.min_size = config['min_size']
+    tracking_algo.max_size = config['max_size']
+
+    results = []
+
+    def tracking_cb(ts, tracking_results):
+        records = tracking_results.numpy()
+        if len(records) > 0:
+            results.append(results_to_records(records))
+
+    tracking_algo.set_output_callback(tracking_cb)
+
+    n_events = 0
+    t_first = t_last = None
+    for evs in mv_iterator:
+        if len(evs) == 0:
+            continue
+        n_events += len(evs)
+        if t_first is None:
+            t_first = int(evs['t'][0])
+        t_last = int(evs['t'][-1])
+        tracking_algo.process_events(event_filters.process_events(evs))
+
+    records = np.concatenate(results) if results else np.empty(0, dtype=RESULT_DTYPE)
+    return records, n_events, t_first, t_last
+
+
+def quality_metrics(records, update_frequency, t_first=None, t_last=None):
+    """
+    Quality metrics of a set of tracking results:
+    - updates / expected_updates / coverage: tracking updates with at least one object, against the number
+      expected from the update frequency over the processed time (missing timestamps);
+    - objects: number of object IDs; dominant_id / dominant_fraction: most frequent ID (the particle, as idMode
+      in MicrotrapEventDetection.m) and the fraction of the rows it has;
+    - id_switches: number of changes of object ID between successive updates with a single object;
+    - max_gap_us: longest time without the dominant ID.
+    """
+    metrics = dict.fromkeys(METRIC_FIELDS, 0)
+    if len(records) == 0:
+        return metrics
+    t = records['t']
+    if t_first is None:
+        t_first, t_last = int(t[0]), int(t[-1])
+    update_times, counts = np.unique(t, return_counts=True)
+    metrics['rows'] = len(records)
+    metrics['updates'] = len(update_times)
+    metrics['expected_updates'] = int((t_last - t_first) * 1e-6 * update_frequency)
+    metrics['coverage'] = round(len(update_times) / max(metrics['expected_updates'], 1), 4)
+
+    ids, id_counts = np.unique(records['object_id'], return_counts=True)
+    dominant = ids[np.argmax(id_counts)]
+    metrics['objects'] = len(ids)
+    metrics['dominant_id'] = int(dominant)
+    metrics['dominant_fraction'] = round(float(id_counts.max()) / len(records), 4)
+
+    single = np.isin(t, update_times[counts == 1])
+    single_ids = records['object_id'][single]
+    metrics['id_switches'] = int(np.count_nonzero(single_ids[1:] != single_ids[:-1]))
+
+    dominant_t = np.concatenate(([t_first], t[records['object_id'] == dominant], [t_last]))
+    metrics['max_gap_us'] = int(np.diff(dominant_t).max())
+    return metrics
+
+
+def run_configuration(input_path, config, process_from=0, process_to=None, delta_t=10000, tracks_dir=''):
+    """
+    Worker of the process pool: tracks one file with one configuration and returns its summary row.
+    """
+    start = time.monotonic()
+    records, n_events, t_first, t_last = track_file(input_path, config, process_from, process_to, delta_t)
+    processing_time = time.monotonic() - start
+
+    row = dict(input=input_path, **config)
+    row.update(quality_metrics(records, config['update_frequency'], t_first, t_last))
+    row['events'] = n_events
+    row['processing_time'] = round(processing_time, 3)
+    row['events_per_second'] = round(n_events / processing_time) if processing_time > 0 else 0
+
+    if tracks_dir:
+        name = os.path.splitext(os.path.basename(input_path))[0] + '_' + \
+            '_'.join(f'{key}={value}' for key, value in config.items()) + '.csv'
+        row['tracks'] = os.path.join(tracks_dir, name)
+        with open(row['tracks'], 'w') as tracks_file:
+            writer = csv.writer(tracks_file, delimiter=',', lineterminator='\n')
+            writer.writerows(records.tolist())
+    return row
+
+
+def parameter_grid(values):
+    """
+    values: {parameter: list of values}. Returns the list of all the combinations, as {parameter: value} dictionaries.
+    """
+    names = list(values)
+    configs = []
+    for combination in itertools.product(*(values[name] for name in names)):
+        configs.append(dict(zip(names, combination)))
+    return configs
+
+
+def parse_args():
+    import argparse
+    """
+    Parse command line arguments.
+    """
+    parser = argparse.ArgumentParser(description='Offline tracking of RAW or .evk files over a grid of parameters.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-i', '--input-raw-files', dest='raw_file_paths', nargs='+', required=True,
+                        help='Paths to the input RAW files or .evk event files.')
+    parser.add_argument('-pf', '--process-from', dest='process_from', type=float, default=0,
+                        help='Time at which the processing starts in each file. Unit: seconds. Default: 0s.')
+    parser.add_argument('-pt', '--process-to', dest='process_to', type=float, default=None,
+                        help='Time at which the processing stops in each file. Unit: seconds. Default: None (end of file).')
+    for name, (option, _, default) in GRID_PARAMETERS.items():
+        parser.add_argument(option, dest=name, type=str, default=','.join(str(v) for v in default),
+                            help=f'Comma separated values of {name} to scan (same units as the tracking scripts).')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=os.cpu_count(),
+                        help='Number of worker processes. Default: number of CPUs.')
+    parser.add_argument('-dt', '--delta-t', dest='delta_t', type=int, default=10000,
+                        help='Duration of the event batches read from the files. Unit: us. Default: 10000us.')
+    parser.add_argument('-o', '--output', dest='output', type=str, default='batch_summary.csv',
+                        help='Path of the summary CSV file. Default: batch_summary.csv.')
+    parser.add_argument('--save-tracks', dest='tracks_dir', type=str, default='',
+                        help='Folder where the tracks of every configuration are saved. If not specified, tracks are not saved.')
+    return parser.parse_args()
+
+
+def main():
+    """
+    Main
+    """
+    args = parse_args()
+    values = {name: [cast(v) for v in getattr(args, name).split(',')] for name, (_, cast, _) in GRID_PARAMETERS.items()}
+    configs = parameter_grid(values)
+    process_from = args.process_from * 1e6
+    process_to = args.process_to * 1e6 if args.process_to is not None else None
+    if args.tracks_dir:
+        os.makedirs(args.tracks_dir, exist_ok=True)
+
+    jobs = [(path, config) for path in args.raw_file_paths for config in configs]
+    print(f'{len(jobs)} jobs ({len(args.raw_file_paths)} files x {len(configs)} configurations) on {args.jobs} processes')
+
+    rows = []
+    with ProcessPoolExecutor(max_workers=args.jobs, mp_context=mp.get_context('spawn')) as pool:
+        futures = {pool.submit(run_configuration, path, config, process_from, process_to, args.delta_t, args.tracks_dir):
+                   (path, config) for path, config in jobs}
+        for future in as_completed(futures):
+            path, config = futures[future]
+            try:
+                row = future.result()
+            except Exception as e:
+                print(f'{path} {config}: failed ({e})')
+                continue
+            rows.append(row)
+            print(f"{path} {config}: coverage {row['coverage']}, id switches {row['id_switches']}, "
+                  f"{row['events_per_second']:.0f} ev/s")
+
+    fieldnames = ['input'] + list(GRID_PARAMETERS) + METRIC_FIELDS + (['tracks'] if args.tracks_dir else [])
+    rows.sort(key=lambda row: (row['input'], -row['coverage'], row['id_switches']))
+    with open(args.output, 'w') as summary_file:
+        writer = csv.DictWriter(summary_file, fieldnames=fieldnames, lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(rows)
+    print("Summary saved at " + args.output)
+
+
+if __name__ == "__main__":
+        main()
@@ -0,0 +1,394 @@
+"""
+Calibration of a continuous run where the voltage is changed every ~30 s (step 5 of the README): the run is split
+into voltage plateaus, the PSD of the X and Y positions of each plateau is fitted in parallel, and the calibration
+table (trap frequency, damping, pixel to meter factor...) is written with one row per plateau.
+
+Plateaus:
+- from the instrument commands (default when there are some): the .sync.json sidecars written by the trackers
+  with -sync (see sync.py), or a command log of CommandLog with the clock offset of the sidecars. Each command
+  matching --command (default: OFFS, the DS335 offset) starts a plateau at the voltage read in the command;
+- from the position statistics (--detect True, or no command): the run is cut in windows of --window seconds and
+  a boundary is put where the mean or the log of the variance of X or Y changes, compared to its noise between
+  windows, by more than --threshold between the --min-plateau / 2 seconds before and after (at the centre of the
+  windows above --threshold around the change). The voltages of the plateaus are then given in order with --voltages.
+The first --settle seconds of each plateau (transient after the change of voltage) are not used. When the files
+come from several runs (e.g. --catalog with several --run), each run is segmented on its own (run column).
+
+Fits (see spectra.py): Welch PSD of the positions resampled at the update period, fitted in --f-min..--f-max with
+    oscillator (default): f0 trap frequency and damping (full width of the peak, Hz), Q = f0 / damping;
+    lorentzian:           fc corner frequency of an overdamped trap.
+Pixel to meter factor (meters_per_pixel), from the equipartition at --temperature:
+    oscillator: kB T / (m (2 pi f0)**2) is the variance in m**2, with the mass m of --mass, or of --radius and
+                --density;
+    lorentzian: kB T / (6 pi viscosity radius) is the diffusion coefficient in m**2/s, with --radius and
+                --viscosity, compared to the one of the fit (pixels**2/s).
+Without mass or radius, meters_per_pixel is left empty.
+
+Each plateau is read and fitted by a process of the pool (-j); with .evkt files only its time range is read.
+    python3 -m evk_tracking.calibration EVK_20240311_*.evkt -j 8 --radius 5e-6 --density 2200 -o calib_0311
+    python3 -m evk_tracking.calibration EVK_20240311_14-02-10.csv --detect True --voltages 0 1 2 3 4 -o calib_0311
+    python3 -m evk_tracking.calibration --catalog runs.sqlite --run 12 --model lorentzian --radius 1e-6
+"""
+
+import csv
+import json
+import os
+import re
+import numpy as np
+
+
+BOLTZMANN = 1.380649e-23
+CALIBRATION_AXES = ('x', 'y')
+PARAMETER_FIELDS = {
+    'oscillator': ['f0', 'damping', 'Q', 'amplitude', 'floor', 'variance', 'meters_per_pixel', 'chi2'],
+    'lorentzian': ['fc', 'amplitude', 'floor', 'variance', 'diffusion', 'meters_per_pixel', 'chi2'],
+}
+
+
+def commands_from_sidecars(paths, command_log=''):
+    """
+    Instrument commands (camera time t_before/t_after in us, command text) of the .sync.json sidecars of paths,
+    or of command_log converted with the clock offset of the first sidecar.
+    """
+    from evk_tracking.sync import read_command_log
+    commands = []
+    clock_offset_ns = None
+    for path in paths:
+        sidecar = os.path.splitext(path)[0] + '.sync.json'
+        if not os.path.isfile(sidecar):
+            continue
+        with open(sidecar, 'r') as sidecar_file:
+            sync = json.load(sidecar_file)
+        if clock_offset_ns is None:
+            clock_offset_ns = sync.get('clock_offset_ns')
+        commands += sync.get('commands', [])
+    if command_log and clock_offset_ns is not None:
+        commands = []
+        for row in read_command_log(command_log):
+            row['t_before'] = (row['host_ns_before'] - clock_offset_ns) / 1000
+            row['t_after'] = (row['host_ns_after'] - clock_offset_ns) / 1000
+            commands.append(row)
+    unique = {(row['t_after'], row['command']): row for row in commands if row.get('t_after') is not None}
+    return sorted(unique.values(), key=lambda row: row['t_after'])
+
+
+def plateaus_from_commands(commands, t_first, t_last, command='OFFS', min_plateau=10.0):
+    """
+    Plateaus [t_start, t_end] (us) of the commands setting a voltage (queries are ignored), between t_first and
+    t_last. The plateau before the first command has no voltage. Plateaus shorter than min_plateau (s) are dropped.
+    """
+    pattern = re.compile(r'^\s*' + re.escape(command) + r'\s+([-+0-9.eE]+)')
+    changes = []
+    for row in commands:
+        match = pattern.match(row['command'])
+        if match:
+            try:
+                changes.append((float(row['t_after']), float(row['t_before']), float(match.group(1))))
+            except ValueError:
+                continue
+    plateaus = []
+    t_start, voltage = t_first, None
+    for t_after, t_before, new_voltage in changes:
+        if t_after <= t_first:
+            voltage = new_voltage
+            continue
+        if t_before >= t_last:
+            break
+        if new_voltage == voltage:
+            continue
+        plateaus.append({'voltage': voltage, 't_start': t_start, 't_end': t_before})
+        t_start, voltage = t_after, new_voltage
+    plateaus.append({'voltage': voltage, 't_start': t_start, 't_end': t_last})
+    return [plateau for plateau in plateaus if plateau['t_end'] - plateau['t_start'] >= min_plateau * 1e6]
+
+
+def window_statistics(t, x, y, window=0.5):
+    """
+    Start times (us), means and variances of X and Y in windows of [window] seconds (empty windows are skipped).
+    """
+    index = ((t - t[0]) // int(window * 1e6)).astype(np.int64)
+    windows, starts, n = np.unique(index, return_index=True, return_counts=True)
+    features = []
+    for values in (x, y):
+        total = np.add.reduceat(values, starts)
+        total_sq = np.add.reduceat(values * values, starts)
+        mean = total / n
+        features += [mean, np.maximum(total_sq / n - mean ** 2, 1e-12)]
+    keep = n >= 2
+    return t[0] + windows[keep] * int(window * 1e6), [feature[keep] for feature in features]
+
+
+def detect_plateaus(t, x, y, window=0.5, min_plateau=10.0, threshold=8.0):
+    """
+    Plateaus [t_start, t_end] (us) from the changes of the position statistics, see the top of this file.
+    """
+    t_windows, (mean_x, var_x, mean_y, var_y) = window_statistics(t, x, y, window)
+    half = max(int(min_plateau / window / 2), 2)
+    plateaus = [{'voltage': None, 't_start': float(t[0]), 't_end': float(t[-1])}]
+    if len(t_windows) < 2 * half + 1:
+        return plateaus
+    score = np.zeros(len(t_windows))
+    for feature in (mean_x, np.log(var_x), mean_y, np.log(var_y)):
+        noise = 1.4826 * np.median(np.abs(np.diff(feature))) / np.sqrt(2)
+        if noise <= 0:
+            continue
+        view = np.lib.stride_tricks.sliding_window_view(feature, half)
+        before = np.median(view[:len(feature) - 2 * half + 1], axis=1)
+        after = np.median(view[half:], axis=1)
+        score[half:len(feature) - half + 1] = np.maximum(score[half:len(feature) - half + 1],
+                                                         np.abs(after - before) / noise)
+    # The score is flat over about half windows around a change: one boundary at the centre of each run of windows
+    # above the threshold, highest runs first, at least min_plateau apart
+    above = np.concatenate(([False], score >= threshold, [False])).astype(np.int8)
+    runs = np.flatnonzero(np.diff(above)).reshape(-1, 2)
+    boundaries = []
+    for first, last in sorted(runs, key=lambda run: -score[run[0]:run[1]].max()):
+        boundary = int((t_windows[first] + t_windows[last - 1]) // 2)
+        if all(abs(boundary - b) >= min_plateau * 1e6 for b in boundaries):
+            boundaries.append(boundary)
+    edges = [float(t[0])] + sorted(boundaries) + [float(t[-1])]
+    return [{'voltage': None, 't_start': start, 't_end': end} for start, end in zip(edges[:-1], edges[1:])]
+
+
+def load_track(paths, t_from=None, t_to=None, object_id=None):
+    """
+    Times (us) and positions of the selected track of paths (files of one run, see streams.file_runs) between t_from
+    and t_to (us), see streams.py.
+    """
+    from evk_tracking.streams import TrackSelector, file_results
+    selector = TrackSelector(object_id)
+    chunks = [selector.select(records) for _, records in file_results(paths, ('t', 'x', 'y', 'object_id'), t_from, t_to)]
+    chunks = [records for records in chunks if len(records)]
+    if not chunks:
+        return np.empty(0, dtype=np.int64), np.empty(0), np.empty(0)
+    records = np.concatenate(chunks)
+    return records['t'].astype(np.int64), records['x'].astype(float), records['y'].astype(float)
+
+
+def run_plateaus(paths, args, t_from=None, t_to=None):
+    """
+    Plateaus of the files of one run (see the top of this file), with detected True when they come from the
+    position statistics.
+    """
+    commands = [] if args.detect else commands_from_sidecars(paths, args.command_log)
+    if commands:
+        from evk_tracking.trajectory import TrajectoryReader
+        t_first, t_last = None, None
+        if all(path.endswith('.evkt') for path in paths):
+            for path in paths:
+                with TrajectoryReader(path) as reader:
+                    t_first = reader.t_first if t_first is None else min(t_first, reader.t_first)
+                    t_last = reader.t_last if t_last is None else max(t_last, reader.t_last)
+        else:
+            t, _, _ = load_track(paths, t_from, t_to, args.object_id)
+            if len(t):
+                t_first, t_last = int(t[0]), int(t[-1])
+        if t_first is None:
+            return []
+        t_first = max(t_first, t_from) if t_from is not None else t_first
+        t_last = min(t_last, t_to) if t_to is not None else t_last
+        plateaus = plateaus_from_commands(commands, t_first, t_last, args.command, args.min_plateau)
+        print(f'{len(plateaus)} plateaus from {len(commands)} instrument commands')
+        return [dict(plateau, detected=False) for plateau in plateaus]
+    t, x, y = load_track(paths, t_from, t_to, args.object_id)
+    if len(t) == 0:
+        return []
+    plateaus = detect_plateaus(t, x, y, args.window, args.min_plateau, args.threshold)
+    print(f'{len(plateaus)} plateaus detected from the position statistics')
+    return [dict(plateau, detected=True) for plateau in plateaus]
+
+
+def meters_per_pixel(fit, temperature=295.0, mass=None, radius=None, viscosity=1.8e-5):
+    """
+    Pixel to meter factor of a fit of spectra.fit_psd(), see the top of this file. None without mass or radius.
+    """
+    if fit['model'] == 'oscillator':
+        if mass is None or fit['variance'] <= 0:
+            return None
+        variance_m2 = BOLTZMANN * temperature / (mass * (2 * np.pi * fit['f0']) ** 2)
+        return float(np.sqrt(variance_m2 / fit['variance']))
+    if radius is None:
+        return None
+    diffusion_m2 = BOLTZMANN * temperature / (6 * np.pi * viscosity * radius)
+    return float(np.sqrt(diffusion_m2 / (fit['amplitude'] * np.pi ** 2)))
+
+
+def fit_segment(paths, segment, model='oscillator', object_id=None, nperseg=4096, f_min=None, f_max=None,
+                temperature=295.0, mass=None, radius=None, viscosity=1.8e-5, psd_path=''):
+    """
+    Reads the track of one plateau and fits the PSD of X and Y (for a process pool). Returns the row of the
+    calibration table.
+    """
+    from evk_tracking.spectra import fit_psd, psd_model, resample, welch_psd
+    row = dict(segment)
+    t, x, y = load_track(paths, segment['t_start'], segment['t_end'], object_id)
+    row['samples'] = int(len(t))
+    if len(t) < 16:
+        row['error'] = 'not enough positions'
+        return row
+    grid, positions, missing = resample(t, np.stack([x, y], axis=1))
+    fs = 1e6 / (grid[1] - grid[0])
+    row['sampling_frequency'] = float(fs)
+    row['missing'] = float(missing)
+    columns = {}
+    for i, axis in enumerate(CALIBRATION_AXES):
+        f, psd, windows = welch_psd(positions[:, i], fs, nperseg)
+        try:
+            fit = fit_psd(f, psd, model, f_min, f_max)
+        except (np.linalg.LinAlgError, ValueError) as error:
+            row['error'] = f'{axis}: {error}'
+            continue
+        if model == 'oscillator':
+            fit['Q'] = fit['f0'] / fit['damping']
+        else:
+            fit['diffusion'] = fit['amplitude'] * np.pi ** 2
+        fit['meters_per_pixel'] = meters_per_pixel(fit, temperature, mass, radius, viscosity)
+        for field in PARAMETER_FIELDS[model]:
+            row[f'{axis}_{field}'] = fit[field]
+        row['windows'] = windows
+        columns['f'] = f
+        columns['psd_' + axis] = psd
+        parameters = [fit[name] for name in (('amplitude', 'f0', 'damping', 'floor') if model == 'oscillator'
+                                             else ('amplitude', 'fc', 'floor'))]
+        columns['fit_' + axis] = psd_model(f, parameters, model)
+    if psd_path and columns:
+        np.savetxt(psd_path, np.stack(list(columns.values()), axis=1), delimiter=',',
+                   header=','.join(columns), comments='')
+    return row
+
+
+def save_table(path, rows, model='oscillator'):
+    """
+    Writes the calibration table (one row per plateau) as CSV.
+    """
+    fields = ['segment', 'run', 'voltage', 't_start', 't_end', 'samples', 'sampling_frequency', 'missing', 'windows']
+    fields += [f'{axis}_{field}' for axis in CALIBRATION_AXES for field in PARAMETER_FIELDS[model]] + ['error']
+    with open(path, 'w') as table_file:
+        writer = csv.DictWriter(table_file, fieldnames=fields, extrasaction='ignore', lineterminator='\n')
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({key: ('' if value is None else value) for key, value in row.items()})
+    return path
+
+
+def parse_args():
+    import argparse
+    from evk_tracking.streams import add_source_arguments
+    """
+    Parse command line arguments.
+    """
+    parser = argparse.ArgumentParser(description='Calibration table of a run with voltage plateaus: segmentation and PSD fits in parallel.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    add_source_arguments(parser)
+    segment_options = parser.add_argument_group('Segmentation options')
+    segment_options.add_argument('--detect', dest='detect', type=bool, default=False,
+                                 help='Plateaus from the position statistics, even with instrument commands. Default: False.')
+    segment_options.add_argument('--command', dest='command', type=str, default='OFFS',
+                                 help='Instrument command setting the voltage (e.g. OFFS or AMPL). Default: OFFS.')
+    segment_options.add_argument('--command-log', dest='command_log', type=str, default='',
+                                 help='Command log of CommandLog, instead of the commands of the sidecars (the clock offset is taken from the sidecars). Default: \'\'.')
+    segment_options.add_argument('--voltages', dest='voltages', type=float, nargs='+', default=None,
+                                 help='Voltages of the detected plateaus, in order. Unit: V. Default: None.')
+    segment_options.add_argument('--window', dest='window', type=float, default=0.5,
+                                 help='Window of the position statistics. Unit: seconds. Default: 0.5.')
+    segment_options.add_argument('--threshold', dest='threshold', type=float, default=8.0,
+                                 help='Change of a statistic between plateaus, relative to its noise between windows. Default: 8.')
+    segment_options.add_argument('--min-plateau', dest='min_plateau', type=float, default=10.0,
+                                 help='Minimum plateau duration. Unit: seconds. Default: 10.')
+    segment_options.add_argument('--settle', dest='settle', type=float, default=2.0,
+                                 help='Duration not used at the start of each plateau. Unit: seconds. Default: 2.')
+    fit_options = parser.add_argument_group('Fit options')
+    fit_options.add_argument('--model', dest='model', type=str, default='oscillator', choices=['oscillator', 'lorentzian'],
+                             help='PSD model. Default: oscillator.')
+    fit_options.add_argument('--nperseg', dest='nperseg', type=int, default=4096,
+                             help='Samples of the Welch windows. Default: 4096.')
+    fit_options.add_argument('--f-min', dest='f_min', type=float, default=None,
+                             help='Lowest fitted frequency. Unit: Hz. Default: first frequency above 0.')
+    fit_options.add_argument('--f-max', dest='f_max', type=float, default=None,
+                             help='Highest fitted frequency. Unit: Hz. Default: Nyquist frequency.')
+    fit_options.add_argument('--temperature', dest='temperature', type=float, default=295.0,
+                             help='Temperature of the particle. Unit: K. Default: 295.')
+    fit_options.add_argument('--mass', dest='mass', type=float, default=None,
+                             help='Mass of the particle (oscillator). Unit: kg. Default: from --radius and --density.')
+    fit_options.add_argument('--radius', dest='radius', type=float, default=None,
+                             help='Radius of the particle. Unit: m. Default: None.')
+    fit_options.add_argument('--density', dest='density', type=float, default=None,
+                             help='Density of the particle (oscillator, with --radius). Unit: kg/m**3. Default: None.')
+    fit_options.add_argument('--viscosity', dest='viscosity', type=float, default=1.8e-5,
+                             help='Viscosity of the medium (lorentzian). Unit: Pa s. Default: 1.8e-5 (air).')
+    fit_options.add_argument('-j', '--processes', dest='processes', type=int, default=1,
+                             help='Number of processes fitting the plateaus. Default: 1.')
+    fit_options.add_argument('--save-psd', dest='save_psd', type=bool, default=False,
+                             help='Also saves the PSD and fits of each plateau as [prefix]_psd_[segment].csv. Default: False.')
+    fit_options.add_argument('-o', '--output', dest='output', type=str, default='calibration',
+                             help='Prefix of the output files: [prefix]_calibration.csv. Default: calibration.')
+    return parser.parse_args()
+
+
+def main():
+    """
+    Main
+    """
+    args = parse_args()
+    if args.results_ring:
+        print('The calibration needs recorded runs: give files or --catalog.')
+        exit(1)
+    from evk_tracking.streams import file_paths_from_args, file_runs
+    paths = file_paths_from_args(args)
+    t_from = args.t_from * 1e6 if args.t_from is not None else None
+    t_to = args.t_to * 1e6 if args.t_to is not None else None
+    runs = file_runs(paths, t_from, t_to)
+    if not runs:
+        print('No positions in the files.')
+        exit(1)
+
+    plateaus = []
+    for run, run_paths in enumerate(runs):
+        for plateau in run_plateaus(run_paths, args, t_from, t_to):
+            plateaus.append(dict(plateau, run=run, paths=run_paths))
+    detected = [plateau for plateau in plateaus if plateau['detected']]
+    if detected and args.voltages:
+        if len(args.voltages) != len(detected):
+            print(f'{len(args.voltages)} voltages given for {len(detected)} plateaus: voltages not assigned.')
+        else:
+            for plateau, voltage in zip(detected, args.voltages):
+                plateau['voltage'] = voltage
+
+    segments, segment_paths = [], []
+    for i, plateau in enumerate(plateaus):
+        t_start = plateau['t_start'] + args.settle * 1e6
+        if t_start < plateau['t_end']:
+            segments.append({'segment': i, 'run': plateau['run'], 'voltage': plateau['voltage'], 't_start': int(t_start),
+                             't_end': int(plateau['t_end'])})
+            segment_paths.append(plateau['paths'])
+    if not segments:
+        print('No plateau to fit.')
+        exit(1)
+
+    mass = args.mass
+    if mass is None and args.radius is not None and args.density is not None:
+        mass = 4 / 3 * np.pi * args.radius ** 3 * args.density
+    n = len(segments)
+    psd_paths = [f'{args.output}_psd_{segment["segment"]}.csv' if args.save_psd else '' for segment in segments]
+    arguments = (segment_paths, segments, [args.model] * n, [args.object_id] * n, [args.nperseg] * n, [args.f_min] * n,
+                 [args.f_max] * n, [args.temperature] * n, [mass] * n, [args.radius] * n, [args.viscosity] * n, psd_paths)
+    if args.processes > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=args.processes) as executor:
+            rows = list(executor.map(fit_segment, *arguments))
+    else:
+        rows = list(map(fit_segment, *arguments))
+
+    frequency = 'f0' if args.model == 'oscillator' else 'fc'
+    for row in rows:
+        voltage = '?' if row['voltage'] is None else f'{row["voltage"]:g} V'
+        if f'x_{frequency}' in row and f'y_{frequency}' in row:
+            print(f'Plateau {row["segment"]} ({voltage}, {row["samples"]} positions): '
+                  f'{frequency} x {row[f"x_{frequency}"]:.2f} Hz, y {row[f"y_{frequency}"]:.2f} Hz')
+        else:
+            print(f'Plateau {row["segment"]} ({voltage}): {row.get("error", "no fit")}')
+    print('Saved at ' + save_table(args.output + '_calibration.csv', rows, args.model))
+
+
+if __name__ == "__main__":
+        main()
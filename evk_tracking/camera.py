@@ -0,0 +1,334 @@
+"""
+Camera sessions with programmatic recovery.
+
+CameraSession opens the camera through a backend, applies the cached biases and ROI and yields the event
+batches from a reader thread. When the stream stalls (no batch for [stall_timeout] seconds) or the reader
+raises an error, the device is closed and opened again through the SDK, the biases and ROI are re-applied
+and the stream continues. The camera timestamps restart from 0 when the device is opened again, so an
+offset is added to keep the timestamps given to the algorithms increasing. Each recovery is timed and kept
+in session.recoveries.
+
+Backends:
+- MetavisionBackend: live camera (or RAW file) through metavision_core;
+- FakeCameraBackend: synthetic events of a moving particle, that can be told to stall or fail, to test the
+  recovery without hardware.
+
+reset_camera() replaces the metavision_player reset of EVKbiasesOptimization.py: it opens the camera,
+reads a few batches and closes it again.
+"""
+
+import gc
+import queue
+import threading
+import time
+import numpy as np
+
+from evk_tracking.common import EVENT_DTYPE
+
+
+class CameraError(Exception):
+    pass
+
+
+class MetavisionBackend:
+    """
+    Opens the camera (or RAW file) through the Metavision SDK.
+    """
+    def __init__(self, input_path='', delta_t=100):
+        self.input_path = input_path
+        self.delta_t = delta_t
+
+    def open(self):
+        """
+        Returns (events iterator, device).
+        """
+        from metavision_core.event_io import EventsIterator
+        from metavision_core.event_io.raw_reader import initiate_device
+        device = initiate_device(path=self.input_path)
+        return EventsIterator.from_device(device=device, delta_t=self.delta_t), device
+
+    @staticmethod
+    def apply_biases(device, biases):
+        i_ll_biases = device.get_i_ll_biases()
+        for bias_name, bias_value in biases.items():
+            i_ll_biases.set(bias_name, bias_value)
+
+    @staticmethod
+    def apply_roi(device, roi):
+        """
+        roi: (x0, y0, x1, y1), corners of the hardware ROI window (included).
+        """
+        from metavision_hal import I_ROI
+        i_roi = device.get_i_roi()
+        if i_roi is None:
+            raise CameraError('The camera has no hardware ROI.')
+        x0, y0, x1, y1 = roi
+        if hasattr(i_roi, 'set_mode'):  # Metavision SDK >= 4.0
+            i_roi.set_mode(I_ROI.Mode.ROI)
+        i_roi.set_window(I_ROI.Window(int(x0), int(y0), int(x1 - x0 + 1), int(y1 - y0 + 1)))  # Corners included
+        i_roi.enable(True)
+
+    @staticmethod
+    def close(iterator, device):
+        """
+        Stops the event stream, so that a reader blocked in the iterator returns. The HAL device is only released
+        when the last reference to it is dropped, which CameraSession does after joining its reader thread.
+        """
+        i_events_stream = device.get_i_events_stream() if device is not None else None
+        if i_events_stream is not None:
+            try:
+                i_events_stream.stop()
+            except Exception as e:
+                print(f'The event stream could not be stopped ({e}).')
+
+
+class _FakeBiases:
+    def __init__(self):
+        self.values = {}
+
+    def set(self, name, value):
+        self.values[name] = value
+        return True
+
+    def get(self, name):
+        return self.values.get(name)
+
+
+class FakeDevice:
+    def __init__(self):
+        self.biases = _FakeBiases()
+        self.roi = None
+
+    def get_i_ll_biases(self):
+        return self.biases
+
+
+class FakeEventsIterator:
+    """
+    Events of a particle oscillating around the center of the sensor, in batches of delta_t us.
+    After fail_after batches, it either raises (failure='error') or blocks (failure='stall') until closed.
+    """
+    def __init__(self, width=640, height=480, delta_t=100, rate=1e6, fail_after=None, failure='stall', realtime=True):
+        self.width, self.height = width, height
+        self.delta_t = delta_t
+        self.events_per_batch = max(int(rate * delta_t * 1e-6), 1)
+        self.fail_after = fail_after
+        self.failure = failure
+        self.realtime = realtime
+        self.closed = threading.Event()
+        self.rng = np.random.default_rng(0)
+
+    def get_size(self):
+        return self.height, self.width
+
+    def __iter__(self):
+        t = 0
+        batch = 0
+        while not self.closed.is_set():
+            if self.fail_after is not None and batch >= self.fail_after:
+                if self.failure == 'error':
+                    raise CameraError('Fake camera: stream error.')
+                self.closed.wait()
+                return
+            evs = np.empty(self.events_per_batch, dtype=EVENT_DTYPE)
+            evs['t'] = np.sort(self.rng.integers(t, t + self.delta_t, self.events_per_batch))
+            phase = 2 * np.pi * 50 * evs['t'] * 1e-6
+            evs['x'] = np.clip(self.width / 2 + 20 * np.cos(phase) + self.rng.normal(0, 3, len(evs)), 0, self.width - 1)
+            evs['y'] = np.clip(self.height / 2 + 20 * np.sin(phase) + self.rng.normal(0, 3, len(evs)), 0, self.height - 1)
+            evs['p'] = self.rng.integers(0, 2, len(evs))
+            if self.realtime:
+                time.sleep(self.delta_t * 1e-6)
+            t += self.delta_t
+            batch += 1
+            yield evs
+
+
+class FakeCameraBackend:
+    """
+    Backend of FakeEventsIterator. failures: list of (fail_after, failure) used by the successive openings,
+    the openings after the last one never fail. open_time: seconds taken to open the device.
+    """
+    def __init__(self, failures=(), open_time=0.05, **iterator_kwargs):
+        self.failures = list(failures)
+        self.open_time = open_time
+        self.iterator_kwargs = iterator_kwargs
+        self.openings = 0
+
+    def open(self):
+        time.sleep(self.open_time)
+        fail_after, failure = self.failures[self.openings] if self.openings < len(self.failures) else (None, None)
+        self.openings += 1
+        return FakeEventsIterator(fail_after=fail_after, failure=failure or 'stall', **self.iterator_kwargs), FakeDevice()
+
+    @staticmethod
+    def apply_biases(device, biases):
+        for bias_name, bias_value in biases.items():
+            device.get_i_ll_biases().set(bias_name, bias_value)
+
+    @staticmethod
+    def apply_roi(device, roi):
+        device.roi = tuple(roi)
+
+    @staticmethod
+    def close(iterator, device):
+        iterator.closed.set()
+
+
+_END = object()
+
+
+class CameraSession:
+    """
+    Resilient stream of event batches, see the top of this file.
+    An already opened iterator and device (e.g. with the biases applied) can be given, they are used until
+    the first recovery: the caller must not keep other references to them (or to the reader of the iterator),
+    otherwise the device cannot be released and opened again.
+    """
+    def __init__(self, backend, biases=None, roi=None, stall_timeout=2., max_recoveries=10, queue_size=1000,
+                 iterator=None, device=None, join_timeout=2.):
+        self.backend = backend
+        self.biases = dict(biases or {})
+        self.roi = roi
+        self.stall_timeout = stall_timeout
+        self.max_recoveries = max_recoveries
+        self.queue_size = queue_size
+        self.join_timeout = join_timeout
+        self.iterator = None
+        self.device = None
+        self.adopted = (iterator, device) if iterator is not None else None
+        self.batches = None
+        self.thread = None
+        self.stop = None
+        self.t_offset = 0
+        self.last_t = -1
+        self.recoveries = []  # (reason, recovery time in s)
+
+    def _open(self):
+        if self.adopted is not None:
+            self.iterator, self.device = self.adopted
+            self.adopted = None
+        else:
+            self.iterator, self.device = self.backend.open()
+            if self.biases:
+                self.backend.apply_biases(self.device, self.biases)
+        if self.roi is not None:
+            try:
+                self.backend.apply_roi(self.device, self.roi)
+            except CameraError as e:
+                print(str(e) + ' Events outside of the ROI have to be filtered in software.')
+        self.batches = queue.Queue(self.queue_size)
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._read, args=(self.iterator, self.batches, self.stop),
+                                       name='evk-camera-reader', daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def _read(iterator, batches, stop):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            for evs in iterator:
+                if not put(evs):
+                    return
+            put(_END)
+        except Exception as e:
+            put(e)
+
+    def _close(self):
+        if self.stop is not None:
+            self.stop.set()
+        if self.iterator is not None:
+            self.backend.close(self.iterator, self.device)
+        # The reader thread holds the iterator (and so the device) until it returns
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(self.join_timeout)
+            if self.thread.is_alive():
+                print(f'The camera reader did not stop within {self.join_timeout}s, the device may not be released.')
+        self.thread = None
+        self.batches = None
+        self.iterator = None
+        self.device = None
+        # Releases the SDK objects caught in reference cycles before the device is opened again
+        gc.collect()
+
+    def get_size(self):
+        if self.iterator is None:
+            self._open()
+        return self.iterator.get_size()
+
+    @property
+    def reader(self):
+        return getattr(self.iterator, 'reader', None)
+
+    def set_biases(self, biases):
+        """
+        Applies biases now and caches them for the next openings.
+        """
+        self.biases.update(biases)
+        if self.device is not None:
+            self.backend.apply_biases(self.device, biases)
+
+    def set_roi(self, roi):
+        self.roi = roi
+        if self.device is not None:
+            self.backend.apply_roi(self.device, roi)
+
+    def recover(self, reason):
+        if len(self.recoveries) >= self.max_recoveries:
+            raise CameraError(f'Camera stream lost ({reason}) and the maximum of {self.max_recoveries} recoveries is reached.')
+        start = time.monotonic()
+        self._close()
+        self._open()
+        # Camera time restarts from 0 after opening
+        self.t_offset = self.last_t + 1
+        duration = time.monotonic() - start
+        self.recoveries.append((reason, duration))
+        print(f'Camera recovered after {reason} in {duration:.3f}s')
+
+    def __iter__(self):
+        if self.iterator is None:
+            self._open()
+        try:
+            while True:
+                try:
+                    item = self.batches.get(timeout=self.stall_timeout)
+                except queue.Empty:
+                    self.recover(f'a stall of {self.stall_timeout}s')
+                    continue
+                if item is _END:
+                    return
+                if isinstance(item, Exception):
+                    self.recover(f'an error ({item})')
+                    continue
+                if len(item) > 0:
+                    if self.t_offset:
+                        item = item.copy()
+                        item['t'] += self.t_offset
+                    self.last_t = int(item['t'][-1])
+                yield item
+        finally:
+            self._close()
+
+
+def reset_camera(backend=None, batches=10, timeout=5.):
+    """
+    Opens the camera, reads a few batches of events and closes it. Returns the time it took (s).
+    """
+    start = time.monotonic()
+    backend = backend or MetavisionBackend()
+    session = CameraSession(backend, stall_timeout=timeout, max_recoveries=0)
+    events = iter(session)
+    try:
+        for i, _ in enumerate(events):
+            if i + 1 >= batches:
+                break
+    finally:
+        events.close()
+    return time.monotonic() - start
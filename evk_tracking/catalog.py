@@ -0,0 +1,203 @@
+"""
+SQLite catalog of the output files (segments) of the trackers, so the analyses select the files they need with
+a query instead of globbing EVK_[date]_[time].csv names (the wall-clock time of the save) and opening each of them.
+
+Every CSV file saved by a tracker run with -cat [catalog] is registered with:
+- its sensor time range (t_first, t_last in us, first and last timestamps of the file) and number of rows;
+- the bias file and the bias values read from it, the tracking parameters (-uf, -at, -mins, -maxs) and the ROI;
+- the run tags given by the run plan (--run-tags: plan, run, cycle, repeat and drive settings of the DS335).
+The catalog is one table, segments, with one row per file (the absolute path is the key: registering a file again
+updates it) and indexes on the time range, the run and the cycle. It is opened in WAL mode, so the tracker can
+register files while analyses read the catalog.
+
+    python3 -m evk_tracking.catalog [saving_location]catalog.sqlite --cycle low_drive --from 10 --to 20
+    python3 -m evk_tracking.catalog [saving_location]catalog.sqlite --run 3 --paths
+
+From a script, RunCatalog(path).segments(t_from=..., t_to=..., cycle=...) returns the rows as dictionaries.
+"""
+
+import datetime
+import json
+import os
+import sqlite3
+
+
+# Column: SQL type. The JSON columns hold dictionaries or lists (biases, roi, drive, extra)
+SEGMENT_COLUMNS = {
+    'path': 'TEXT PRIMARY KEY',
+    'kind': 'TEXT',                 # csv or evkt (trajectory.py)
+    'created': 'TEXT',
+    't_first': 'INTEGER',
+    't_last': 'INTEGER',
+    'rows': 'INTEGER',
+    'bias_file': 'TEXT',
+    'biases': 'TEXT',
+    'update_frequency': 'REAL',
+    'accumulation_time': 'REAL',
+    'min_size': 'INTEGER',
+    'max_size': 'INTEGER',
+    'roi': 'TEXT',
+    'plan': 'TEXT',
+    'run': 'INTEGER',
+    'cycle': 'TEXT',
+    'repeat': 'INTEGER',
+    'drive': 'TEXT',
+    'source': 'TEXT',               # original file of a converted file
+    'checksum': 'TEXT',
+    'extra': 'TEXT',
+}
+JSON_COLUMNS = ('biases', 'roi', 'drive', 'extra')
+INDEXES = {'segments_time': ('t_first', 't_last'), 'segments_run': ('run',), 'segments_cycle': ('cycle', 'run')}
+
+
+class RunCatalog:
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=30)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        columns = ', '.join(f'"{name}" {sql_type}' for name, sql_type in SEGMENT_COLUMNS.items())
+        with self.connection:
+            self.connection.execute(f'CREATE TABLE IF NOT EXISTS segments ({columns})')
+            for name, columns in INDEXES.items():
+                self.connection.execute(f'CREATE INDEX IF NOT EXISTS {name} ON segments ({", ".join(columns)})')
+
+    def register(self, path, t_first, t_last, rows, kind='csv', **fields):
+        """
+        Adds (or updates) the segment of a file. fields: other columns of SEGMENT_COLUMNS; unknown ones go to extra.
+        """
+        row = {'path': os.path.abspath(path), 'kind': kind, 'created': datetime.datetime.now().isoformat(timespec='seconds'),
+               't_first': int(t_first), 't_last': int(t_last), 'rows': int(rows)}
+        extra = {}
+        for name, value in fields.items():
+            if name in SEGMENT_COLUMNS:
+                row[name] = value
+            else:
+                extra[name] = value
+        if extra:
+            row['extra'] = dict(row.get('extra') or {}, **extra)
+        for name in JSON_COLUMNS:
+            if row.get(name) is not None and not isinstance(row[name], str):
+                row[name] = json.dumps(row[name])
+        names = ', '.join(f'"{name}"' for name in row)
+        with self.connection:
+            self.connection.execute(f'INSERT OR REPLACE INTO segments ({names}) VALUES ({", ".join("?" * len(row))})',
+                                    list(row.values()))
+
+    def segments(self, t_from=None, t_to=None, order=('run', 't_first'), **where):
+        """
+        Segments overlapping the sensor time range [t_from, t_to] (us, None = unbounded) whose columns equal the
+        values of where (a list or tuple matches any of its values; None values are ignored), sorted by the column
+        or columns of order. The default keeps the segments of a run together: the sensor time of every tracker
+        process starts at 0, so sorting by time alone interleaves the runs.
+        Returns a list of dictionaries, the JSON columns decoded.
+        """
+        conditions, values = [], []
+        if t_from is not None:
+            conditions.append('t_last >= ?')
+            values.append(int(t_from))
+        if t_to is not None:
+            conditions.append('t_first <= ?')
+            values.append(int(t_to))
+        for name, value in where.items():
+            if name not in SEGMENT_COLUMNS:
+                raise ValueError(f'Unknown catalog column: {name}')
+            if value is None:
+                continue
+            if isinstance(value, (list, tuple)):
+                conditions.append(f'"{name}" IN ({", ".join("?" * len(value))})')
+                values.extend(value)
+            else:
+                conditions.append(f'"{name}" = ?')
+                values.append(value)
+        order = [order] if isinstance(order, str) else list(order)
+        for name in order:
+            if name not in SEGMENT_COLUMNS:
+                raise ValueError(f'Unknown catalog column: {name}')
+        query = 'SELECT * FROM segments' + (' WHERE ' + ' AND '.join(conditions) if conditions else '') \
+            + ' ORDER BY ' + ', '.join(f'"{name}"' for name in order)
+        segments = []
+        for row in self.connection.execute(query, values):
+            segment = dict(row)
+            for name in JSON_COLUMNS:
+                if segment[name]:
+                    segment[name] = json.loads(segment[name])
+            segments.append(segment)
+        return segments
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def segment_fields(inputs, **extra):
+    """
+    Catalog columns of the segments of a tracking script (its Inputs): bias profile, tracking parameters and
+    the run tags (--run-tags, JSON). extra: other columns, e.g. roi.
+    """
+    from evk_tracking.common import get_biases_from_file
+    fields = {key: getattr(inputs, key) for key in ('update_frequency', 'accumulation_time', 'min_size', 'max_size')
+              if hasattr(inputs, key)}
+    bias_file = getattr(inputs, 'bias_file', '')
+    if bias_file and os.path.isfile(bias_file):
+        fields['bias_file'] = os.path.abspath(bias_file)
+        fields['biases'] = get_biases_from_file(bias_file)
+    if getattr(inputs, 'run_tags', ''):
+        fields.update(json.loads(inputs.run_tags))
+    fields.update(extra)
+    return fields
+
+
+def parse_args():
+    import argparse
+    """
+    Parse command line arguments.
+    """
+    parser = argparse.ArgumentParser(description='Query the catalog of the tracker output files.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('catalog', type=str, help='Path of the catalog (SQLite).')
+    parser.add_argument('--from', dest='t_from', type=float, default=None,
+                        help='Start of the sensor time range. Unit: seconds. Default: unbounded.')
+    parser.add_argument('--to', dest='t_to', type=float, default=None,
+                        help='End of the sensor time range. Unit: seconds. Default: unbounded.')
+    parser.add_argument('--run', dest='run', type=int, nargs='+', default=None, help='Run numbers. Default: all.')
+    parser.add_argument('--cycle', dest='cycle', type=str, nargs='+', default=None, help='Cycle names. Default: all.')
+    parser.add_argument('--plan', dest='plan', type=str, default=None, help='Plan name. Default: all.')
+    parser.add_argument('--kind', dest='kind', type=str, default=None, help='Kind of file (csv, evkt). Default: all.')
+    parser.add_argument('-uf', '--update-frequency', dest='update_frequency', type=float, default=None,
+                        help='Update frequency of the tracking. Unit: Hertz. Default: all.')
+    parser.add_argument('--paths', dest='paths', type=bool, default=False,
+                        help='Prints only the paths of the segments (e.g. to pass them to another program). Default: False.')
+    return parser.parse_args()
+
+
+def main():
+    """
+    Main
+    """
+    args = parse_args()
+    if not os.path.isfile(args.catalog):
+        print('No catalog at ' + args.catalog)
+        exit(1)
+    with RunCatalog(args.catalog) as catalog:
+        segments = catalog.segments(t_from=args.t_from * 1e6 if args.t_from is not None else None,
+                                    t_to=args.t_to * 1e6 if args.t_to is not None else None,
+                                    run=args.run, cycle=args.cycle, plan=args.plan, kind=args.kind,
+                                    update_frequency=args.update_frequency)
+    for segment in segments:
+        if args.paths:
+            print(segment['path'])
+        else:
+            print(f"{segment['path']}  t {segment['t_first'] * 1e-6:.3f}-{segment['t_last'] * 1e-6:.3f}s  "
+                  f"{segment['rows']} rows  run {segment['run']}  cycle {segment['cycle']}  uf {segment['update_frequency']}")
+    if not args.paths:
+        print(f'{len(segments)} segments')
+
+
+if __name__ == "__main__":
+        main()
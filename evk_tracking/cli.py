@@ -0,0 +1,52 @@
+"""
+Command line entry point: python3 -m evk_tracking [mode] [options of the mode], or evk-tracking [mode] once the
+package is installed (pip install .). python3 -m evk_tracking [mode] -h lists the options of a mode.
+
+The module of a mode is only imported when that mode is run, so the headless tracker started by
+EVKbiasesOptimization.py for every run does not load OpenCV, matplotlib or the Metavision UI, which only the
+video modes use.
+"""
+
+import importlib
+import sys
+
+
+# Mode: (module, description)
+COMMANDS = {
+    'headless': ('evk_tracking.headless', 'tracking without video feed, CSV files (was evk_tracking_wo_video.py)'),
+    'video': ('evk_tracking.video', 'tracking with the video feed and the bounding boxes (was evk_tracking_video.py)'),
+    'video-ryg': ('evk_tracking.video_ryg', 'video feed variant (was evk_tracking_video_ryg.py)'),
+    'live-analysis': ('evk_tracking.live_analysis', 'video feed and live analysis of the dominant object (was evk_tracking_vid_liveanalysis.py)'),
+    'osci': ('evk_tracking.osci', 'tracking with the position output to the oscilloscope / DAC (was evk_tracking_Osci.py)'),
+    'batch': ('evk_tracking.batch', 'offline reprocessing of recordings over a grid of parameters'),
+}
+
+
+def usage():
+    lines = ['usage: python3 -m evk_tracking {' + ','.join(COMMANDS) + '} [options]', '']
+    lines += [f'  {name:<14} {description}' for name, (_, description) in COMMANDS.items()]
+    return '\n'.join(lines)
+
+
+def run(command, argv=None):
+    """
+    Imports the module of a mode and runs its main() with the arguments argv (default: sys.argv[1:]).
+    """
+    module_name, _ = COMMANDS[command]
+    sys.argv = ['evk_tracking ' + command] + list(sys.argv[1:] if argv is None else argv)
+    importlib.import_module(module_name).main()
+
+
+def main():
+    """
+    Main
+    """
+    if len(sys.argv) < 2 or sys.argv[1] in ('-h', '--help'):
+        print(usage())
+        exit(0 if len(sys.argv) >= 2 else 1)
+    command = sys.argv[1]
+    if command not in COMMANDS:
+        print(f'Unknown mode: {command}\n')
+        print(usage())
+        exit(1)
+    run(command, sys.argv[2:])
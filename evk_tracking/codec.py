@@ -0,0 +1,186 @@
+"""
+Lossless codec of event blocks, tuned for the event streams of the levitation measurements: a few pixels
+wide ROI around the particle, time-ordered events and long runs of the same polarity.
+
+A block (EVENT_DTYPE array) is encoded as:
+- t: first timestamp, then the differences between successive timestamps (zigzag, so unsorted events stay
+  lossless), bit-packed with the width of the 99th percentile; the larger ones are patched from an exception
+  list (patched frame of reference);
+- x, y: offset from the minimum of the block (the ROI corner), bit-packed with the width of the ROI;
+- p: polarity run lengths (bit-packed as t) and the polarity of each run;
+then the packed sections are compressed together with zlib.
+
+Everything is vectorized with numpy; zlib releases the GIL, so blocks are encoded and decoded in parallel by
+threads (encode_blocks(), decode_blocks()). The blocks are independent, which gives random access at block
+level: eventfile.py uses this codec for the chunks of the .evk files (codec='evkc1').
+"""
+
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from evk_tracking.common import EVENT_DTYPE
+
+
+CODEC_NAME = 'evkc1'
+BLOCK_FORMAT = '<4sIqHHh'
+BLOCK_SIZE = struct.calcsize(BLOCK_FORMAT)
+PFOR_FORMAT = '<BI'
+PFOR_SIZE = struct.calcsize(PFOR_FORMAT)
+
+
+def bit_width(value):
+    return int(value).bit_length()
+
+
+def _word_size(width):
+    return 1 if width <= 8 else 2 if width <= 16 else 4 if width <= 32 else 8
+
+
+def pack_bits(values, width):
+    """
+    Packs the [width] low bits of each value (little-endian bit order).
+    """
+    if width == 0 or len(values) == 0:
+        return b''
+    size = _word_size(width)
+    words = np.ascontiguousarray(values.astype(f'<u{size}')).view(np.uint8).reshape(-1, size)
+    bits = np.unpackbits(words, axis=1, bitorder='little')[:, :width]
+    return np.packbits(bits.ravel(), bitorder='little').tobytes()
+
+
+def unpack_bits(data, n, width):
+    if width == 0 or n == 0:
+        return np.zeros(n, dtype=np.uint64)
+    if width > 56:
+        size = _word_size(width)
+        bits = np.zeros((n, 8 * size), dtype=np.uint8)
+        bits[:, :width] = np.unpackbits(np.frombuffer(data, dtype=np.uint8), count=n * width,
+                                        bitorder='little').reshape(n, width)
+        return np.packbits(bits, axis=1, bitorder='little').view(f'<u{size}').ravel().astype(np.uint64)
+    # Each value is read from the (up to 8) bytes that hold its bits
+    padded = np.frombuffer(bytes(data) + bytes(8), dtype=np.uint8)
+    bit_offsets = np.arange(n, dtype=np.uint64) * np.uint64(width)
+    byte_offsets = (bit_offsets >> np.uint64(3)).astype(np.intp)
+    values = np.zeros(n, dtype=np.uint64)
+    for k in range((width + 7 + 7) // 8):
+        values |= padded[byte_offsets + k].astype(np.uint64) << np.uint64(8 * k)
+    return (values >> (bit_offsets & np.uint64(7))) & np.uint64((1 << width) - 1)
+
+
+def pack_pfor(values):
+    """
+    Bit-packs unsigned values with the width of their 99th percentile; the values that do not fit are stored
+    apart (index, value). Returns bytes.
+    """
+    if len(values) == 0:
+        return struct.pack(PFOR_FORMAT, 0, 0)
+    width = bit_width(np.percentile(values, 99, method='higher'))
+    limit = np.uint64((1 << width) - 1)
+    exceptions = np.flatnonzero(values > limit).astype('<u4')
+    packed = pack_bits(np.minimum(values, limit), width)
+    return struct.pack(PFOR_FORMAT, width, len(exceptions)) + exceptions.tobytes() + \
+        values[exceptions].astype('<u8').tobytes() + packed
+
+
+def unpack_pfor(data, n):
+    width, n_exceptions = struct.unpack_from(PFOR_FORMAT, data)
+    position = PFOR_SIZE
+    exceptions = np.frombuffer(data, dtype='<u4', count=n_exceptions, offset=position)
+    position += 4 * n_exceptions
+    exception_values = np.frombuffer(data, dtype='<u8', count=n_exceptions, offset=position)
+    position += 8 * n_exceptions
+    values = unpack_bits(data[position:], n, width)
+    values[exceptions] = exception_values
+    return values
+
+
+def _section(data):
+    return struct.pack('<I', len(data)) + data
+
+
+def _sections(data, position, count):
+    sections = []
+    for _ in range(count):
+        size, = struct.unpack_from('<I', data, position)
+        sections.append(data[position + 4:position + 4 + size])
+        position += 4 + size
+    return sections
+
+
+def encode_block(evs, level=1):
+    """
+    Encodes an EVENT_DTYPE array into bytes, see the top of this file.
+    """
+    n = len(evs)
+    if n == 0:
+        return zlib.compress(struct.pack(BLOCK_FORMAT, b'EVC1', 0, 0, 0, 0, 0), level)
+    t = evs['t'].astype(np.int64)
+    dt = np.diff(t)
+    zigzag = ((dt << 1) ^ (dt >> 63)).astype(np.uint64)
+
+    x_min, y_min = int(evs['x'].min()), int(evs['y'].min())
+    x = evs['x'].astype(np.int64) - x_min
+    y = evs['y'].astype(np.int64) - y_min
+    x_width, y_width = bit_width(x.max()), bit_width(y.max())
+
+    p = evs['p']
+    starts = np.concatenate(([0], np.flatnonzero(p[1:] != p[:-1]) + 1))
+    run_lengths = np.diff(np.append(starts, n)).astype(np.uint64)
+    p_min = int(p.min())
+    run_values = p[starts].astype(np.int64) - p_min
+    p_width = bit_width(run_values.max())
+
+    block = struct.pack(BLOCK_FORMAT, b'EVC1', n, int(t[0]), x_min, y_min, p_min)
+    block += struct.pack('<BBBI', x_width, y_width, p_width, len(starts))
+    block += _section(pack_pfor(zigzag)) + _section(pack_bits(x, x_width)) + _section(pack_bits(y, y_width))
+    block += _section(pack_pfor(run_lengths)) + _section(pack_bits(run_values, p_width))
+    return zlib.compress(block, level)
+
+
+def decode_block(data):
+    """
+    Decodes the bytes of encode_block() into an EVENT_DTYPE array.
+    """
+    block = zlib.decompress(data)
+    magic, n, t0, x_min, y_min, p_min = struct.unpack_from(BLOCK_FORMAT, block)
+    if magic != b'EVC1':
+        raise ValueError('Not an encoded event block.')
+    evs = np.empty(n, dtype=EVENT_DTYPE)
+    if n == 0:
+        return evs
+    x_width, y_width, p_width, n_runs = struct.unpack_from('<BBBI', block, BLOCK_SIZE)
+    t_data, x_data, y_data, lengths_data, values_data = _sections(block, BLOCK_SIZE + struct.calcsize('<BBBI'), 5)
+
+    zigzag = unpack_pfor(t_data, n - 1)
+    dt = (zigzag >> np.uint64(1)).astype(np.int64) ^ -(zigzag & np.uint64(1)).astype(np.int64)
+    evs['t'][0] = t0
+    np.cumsum(dt, out=evs['t'][1:])
+    evs['t'][1:] += t0
+    evs['x'] = unpack_bits(x_data, n, x_width) + np.uint64(x_min)
+    evs['y'] = unpack_bits(y_data, n, y_width) + np.uint64(y_min)
+    run_lengths = unpack_pfor(lengths_data, n_runs).astype(np.int64)
+    run_values = unpack_bits(values_data, n_runs, p_width).astype(np.int64) + p_min
+    evs['p'] = np.repeat(run_values, run_lengths)
+    return evs
+
+
+def encode_blocks(blocks, level=1, threads=1):
+    """
+    Encodes a list of event arrays, in parallel with [threads] threads. Returns the list of bytes.
+    """
+    if threads <= 1:
+        return [encode_block(evs, level) for evs in blocks]
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return list(executor.map(lambda evs: encode_block(evs, level), blocks))
+
+
+def decode_blocks(blocks, threads=1):
+    """
+    Decodes a list of encoded blocks, in parallel with [threads] threads. Returns the list of event arrays.
+    """
+    if threads <= 1:
+        return [decode_block(data) for data in blocks]
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        return list(executor.map(decode_block, blocks))
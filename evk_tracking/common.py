@@ -0,0 +1,45 @@
+"""
+Helpers shared by the tracking modes (headless, video, live-analysis, osci, video-ryg).
+"""
+
+import numpy as np
+
+
+# Events as numpy arrays, with the layout of the EventCD buffers of the Metavision SDK (x, y, p, t at byte offsets
+# 0, 2, 4, 8, 16 bytes per event), so they are given to the SDK algorithms without conversion
+EVENT_DTYPE = np.dtype({'names': ['x', 'y', 'p', 't'], 'formats': ['<u2', '<u2', '<i2', '<i8'],
+                        'offsets': [0, 2, 4, 8], 'itemsize': 16})
+
+
+def concatenate_events(batches):
+    """
+    Concatenates event arrays into an EVENT_DTYPE array (np.concatenate drops the padding of the layout with
+    recent numpy versions).
+    """
+    evs = np.empty(sum(len(batch) for batch in batches), dtype=EVENT_DTYPE)
+    position = 0
+    for batch in batches:
+        evs[position:position + len(batch)] = batch
+        position += len(batch)
+    return evs
+
+
+def get_biases_from_file(path: str):
+    """
+    Helper function to read bias from a file. Return biases list with elements: 0 = value, 1 = name.
+    """
+    biases = {}
+    try:
+        biases_file = open(path, 'r')
+    except IOError:
+        print("Cannot open bias file: " + path)
+    else:
+        with biases_file:
+            for line in biases_file:
+                # Skip lines starting with '%': comments, and lines without a bias (e.g. empty lines)
+                if line.startswith('%') or '%' not in line:
+                    continue
+
+                split = line.split("%")
+                biases[split[1].strip()] = int(split[0])
+    return biases
@@ -0,0 +1,374 @@
+"""
+Online multi-tau correlator: autocorrelation and mean squared displacement (MSD) of the x and y positions for
+lags from one update period to [max_tau], computed chunk by chunk from the tracking stream or archived runs
+with a memory that only depends on the number of lags.
+
+The positions (one per update time, see TrackSelector in streams.py) are put on a regular grid of period dt
+(the update period, estimated from the first positions if not given); updates without position are masked,
+so they do not enter the statistics. The grid feeds the levels of the correlator: level 0 has the lags 0 to
+[points]-1 periods, level l the lags [points]/2 to [points]-1 periods of 2**l grid steps, so there are
+[points]/2 lags per octave. Each level keeps the last [points]-1 samples and, for every lag, the sums of the
+pairs (number of valid pairs, x_i * x_i+k, x_i, x_i+k, (x_i+k - x_i)**2). A chunk is processed at once for all
+the lags of a level (sliding windows). The samples of level l+1 are
+- decimate (default): every second sample of level l, so a lag uses exact pairs of positions and the MSD is not
+  biased; the number of pairs is divided by 2 per level, which adds noise at lags much longer than the
+  correlation time of the positions;
+- average: the mean of two samples of level l, the classical multi-tau correlator. The averaging removes the
+  fluctuations faster than 2**l periods from level l: the MSD is too low (by 1/(3 [points]/2) for a free diffusion,
+  much more for a trapped particle at lags longer than its correlation time).
+Gaps longer than max_tau (e.g. between files) and the start of another run (restart()) reset the histories
+instead of filling the grid.
+
+fft_reference() computes the same statistics over all the pairs of a whole series with FFTs; --check True
+compares both on the analysed data (level 0 must agree exactly, higher levels within the statistical error).
+
+    python3 -m evk_tracking.correlation EVK_*.evkt --max-tau 10 -o run3_msd.csv
+    python3 -m evk_tracking.correlation -rb /dev/shm/evk_results --report 10
+"""
+
+import time
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+CORRELATION_MODES = ('decimate', 'average')
+DIMENSIONS = ('x', 'y')
+
+
+class _Level:
+    def __init__(self, points):
+        self.points = points
+        self.history_values = np.zeros((points - 1, len(DIMENSIONS)))
+        self.history_weights = np.zeros(points - 1)
+        self.fed = 0  # Samples fed to this level so far
+        self.carry = None  # average: sample waiting for its pair
+        self.pairs = np.zeros(points)
+        self.sum_product = np.zeros((len(DIMENSIONS), points))
+        self.sum_left = np.zeros((len(DIMENSIONS), points))
+        self.sum_right = np.zeros((len(DIMENSIONS), points))
+        self.sum_square_difference = np.zeros((len(DIMENSIONS), points))
+
+    def reset_history(self):
+        self.history_values[:] = 0
+        self.history_weights[:] = 0
+        self.carry = None
+
+    def add(self, values, weights):
+        """
+        Adds the pairs of the samples values (n, 2), weights (n) (1 valid, 0 masked) with the previous ones.
+        """
+        n = len(weights)
+        extended_values = np.concatenate((self.history_values, values))
+        extended_weights = np.concatenate((self.history_weights, weights))
+        # left[j, :, k] = sample j - k (lag k), right[j] = sample j
+        left = sliding_window_view(extended_values, self.points, axis=0)[:, :, ::-1]
+        left_weights = sliding_window_view(extended_weights, self.points)[:, ::-1]
+        pair_weights = weights[:, None] * left_weights
+        self.pairs += pair_weights.sum(axis=0)
+        self.sum_product += np.einsum('jd,jdk,jk->dk', values, left, pair_weights)
+        self.sum_left += np.einsum('jdk,jk->dk', left, pair_weights)
+        self.sum_right += values.T @ pair_weights
+        self.sum_square_difference += np.einsum('jdk,jk->dk', (values[:, :, None] - left) ** 2, pair_weights)
+        self.history_values = extended_values[-(self.points - 1):].copy()
+        self.history_weights = extended_weights[-(self.points - 1):].copy()
+        self.fed += n
+
+
+class MultiTauCorrelator:
+    """
+    Multi-tau autocorrelation and MSD of x and y, see the top of this file. add() takes chunks of records with
+    t, x and y (one per update time); result() returns one row per lag.
+    dt: grid period (us, None: median period of the first positions); max_tau: longest lag (us); points: lags
+    per level (even); mode: 'decimate' or 'average'.
+    """
+    def __init__(self, dt=None, max_tau=10e6, points=16, mode='decimate', keep_series=False):
+        if mode not in CORRELATION_MODES:
+            raise ValueError(f'Unknown correlation mode: {mode}')
+        if points < 4 or points % 2:
+            raise ValueError('points must be an even number, at least 4.')
+        self.dt = dt
+        self.max_tau = max_tau
+        self.points = points
+        self.mode = mode
+        self.levels = None
+        self.t0 = None
+        self.last_index = None
+        self.samples = 0
+        self.resets = 0
+        self.pending = None
+        # keep_series: keeps the grid (gap resets before it, values, weights) for the check against fft_reference()
+        self.series = [] if keep_series else None
+
+    def _create_levels(self):
+        max_lag = max(self.max_tau / self.dt, self.points - 1)
+        count = 1
+        while (self.points - 1) * 2 ** (count - 1) < max_lag:
+            count += 1
+        self.levels = [_Level(self.points) for _ in range(count)]
+
+    def add(self, records):
+        if len(records) == 0:
+            return
+        t = np.asarray(records['t'], dtype=np.int64)
+        values = np.stack((records['x'], records['y']), axis=1).astype(float)
+        if self.dt is None:
+            # The period is estimated on the first positions
+            self.pending = (t, values) if self.pending is None else (np.concatenate((self.pending[0], t)),
+                                                                     np.concatenate((self.pending[1], values)))
+            if len(self.pending[0]) < 1000:
+                return
+            t, values = self.pending
+            self.pending = None
+            self.dt = float(np.median(np.diff(t)))
+        if self.levels is None:
+            self._create_levels()
+        self._add_grid(t, values)
+
+    def restart(self):
+        """
+        The next positions come from another run (its sensor clock starts again): resets the histories as a gap
+        does, and the grid starts at the next position.
+        """
+        self.finish()
+        self.pending = None
+        if self.levels is None or self.t0 is None:
+            return
+        for level in self.levels:
+            level.reset_history()
+        self.resets += 1
+        self.t0 = None
+
+    def finish(self):
+        """
+        Analyses the positions kept to estimate the period if the stream ended before.
+        """
+        if self.pending is not None and len(self.pending[0]) > 1:
+            t, values = self.pending
+            self.pending = None
+            self.dt = float(np.median(np.diff(t)))
+            self._create_levels()
+            self._add_grid(t, values)
+
+    def _add_grid(self, t, values):
+        if self.t0 is None:
+            self.t0 = int(t[0])
+            self.last_index = -1
+        index = np.rint((t - self.t0) / self.dt).astype(np.int64)
+        keep = index > self.last_index
+        index, values = index[keep], values[keep]
+        if len(index) == 0:
+            return
+        # Gaps longer than the longest lag: no pair across them
+        max_gap = (self.points - 1) * 2 ** (len(self.levels) - 1)
+        steps = np.diff(np.concatenate(([self.last_index], index)))
+        breaks = np.flatnonzero(steps > max_gap)
+        start = 0
+        for end in list(breaks) + [len(index)]:
+            if end > start:
+                self._add_segment(index[start:end], values[start:end])
+            if end < len(index):
+                for level in self.levels:
+                    level.reset_history()
+                self.resets += 1
+                self.last_index = int(index[end]) - 1
+            start = end
+        self.samples += len(index)
+
+    def _add_segment(self, index, values):
+        length = int(index[-1] - self.last_index)
+        grid_values = np.zeros((length, len(DIMENSIONS)))
+        grid_weights = np.zeros(length)
+        position = index - self.last_index - 1
+        grid_values[position] = values  # The last position of a grid step is kept
+        grid_weights[position] = 1
+        self.last_index = int(index[-1])
+        if self.series is not None:
+            self.series.append((self.resets, grid_values, grid_weights))
+        self._feed(0, grid_values, grid_weights)
+
+    def _feed(self, number, values, weights):
+        level = self.levels[number]
+        first = level.fed
+        level.add(values, weights)
+        if number + 1 == len(self.levels):
+            return
+        if self.mode == 'decimate':
+            # Samples of even position in the level go to the next level
+            even = slice((first % 2), None, 2)
+            values, weights = values[even], weights[even]
+        else:
+            if level.carry is not None:
+                values = np.concatenate((level.carry[0], values))
+                weights = np.concatenate((level.carry[1], weights))
+                level.carry = None
+            if len(weights) % 2:
+                level.carry = (values[-1:], weights[-1:])
+                values, weights = values[:-1], weights[:-1]
+            pair_weights = weights[0::2] + weights[1::2]
+            values = (values[0::2] * weights[0::2, None] + values[1::2] * weights[1::2, None]) \
+                / np.maximum(pair_weights, 1)[:, None]
+            weights = (pair_weights > 0).astype(float)
+        if len(weights):
+            self._feed(number + 1, values, weights)
+
+    def result(self):
+        """
+        One row per lag (increasing): tau (us), pairs, and for x and y the autocorrelation (normalized by the variance),
+        the autocovariance (pixels**2) and the MSD (pixels**2).
+        """
+        names = ['tau', 'pairs'] + [f'{name}_{dimension}' for name in ('acf', 'cov', 'msd') for dimension in DIMENSIONS]
+        rows = []
+        if self.levels is None:
+            return np.empty(0, dtype=[(name, '<f8') for name in names])
+        for number, level in enumerate(self.levels):
+            lags = range(0 if number == 0 else self.points // 2, self.points)
+            for lag in lags:
+                pairs = level.pairs[lag]
+                if pairs <= 0:
+                    continue
+                covariance = level.sum_product[:, lag] / pairs - level.sum_left[:, lag] * level.sum_right[:, lag] / pairs ** 2
+                msd = level.sum_square_difference[:, lag] / pairs
+                rows.append([lag * 2 ** number * self.dt, pairs] + [np.nan, np.nan] + covariance.tolist() + msd.tolist())
+        out = np.array([tuple(row) for row in rows], dtype=[(name, '<f8') for name in names])
+        if len(out) and out['tau'][0] == 0:
+            for dimension in DIMENSIONS:
+                out[f'acf_{dimension}'] = out[f'cov_{dimension}'] / out[f'cov_{dimension}'][0]
+        return out
+
+    def save(self, path):
+        out = self.result()
+        np.savetxt(path, np.column_stack([out[name] for name in out.dtype.names]), delimiter=',', fmt='%.8g',
+                   header=','.join(out.dtype.names), comments='')
+        return path
+
+
+def fft_reference(values, weights, lags):
+    """
+    Autocovariance and MSD of a whole grid series (values (n, 2), weights (n)) at the integer lags, over all the
+    pairs of valid samples, with FFTs. Returns pairs (lags), covariance and msd (2, lags).
+    """
+    n = len(weights)
+    size = 1 << int(np.ceil(np.log2(2 * n)))
+    lags = np.asarray(lags, dtype=np.int64)
+
+    def correlate(a, b):
+        # sum_j a[j] * b[j + lag]
+        return np.fft.irfft(np.conj(np.fft.rfft(a, size)) * np.fft.rfft(b, size), size)[lags]
+
+    pairs = np.rint(correlate(weights, weights))
+    covariance = np.empty((len(DIMENSIONS), len(lags)))
+    msd = np.empty((len(DIMENSIONS), len(lags)))
+    for dimension in range(len(DIMENSIONS)):
+        masked = values[:, dimension] * weights
+        product = correlate(masked, masked)
+        left = correlate(masked, weights)
+        right = correlate(weights, masked)
+        squares = correlate(masked * values[:, dimension], weights) + correlate(weights, masked * values[:, dimension])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            covariance[dimension] = product / pairs - left * right / pairs ** 2
+            msd[dimension] = (squares - 2 * product) / pairs
+    return pairs, covariance, msd
+
+
+def check(correlator):
+    """
+    Compares the result of a correlator created with keep_series=True with fft_reference() on its grid.
+    Returns the result rows with the reference MSD and covariance, and the largest relative difference of the MSD
+    at level 0 and above.
+    """
+    # The correlator has no pair across a gap reset: masked samples longer than the longest lag separate the
+    # segments, so the reference has none either
+    max_gap = (correlator.points - 1) * 2 ** (len(correlator.levels) - 1)
+    padding = (np.zeros((max_gap, len(DIMENSIONS))), np.zeros(max_gap))
+    grid = []
+    for number, (resets, values, weights) in enumerate(correlator.series):
+        if number and resets != correlator.series[number - 1][0]:
+            grid.append(padding)
+        grid.append((values, weights))
+    values = np.concatenate([series[0] for series in grid])
+    weights = np.concatenate([series[1] for series in grid])
+    out = correlator.result()
+    lags = np.rint(out['tau'] / correlator.dt).astype(np.int64)
+    pairs, covariance, msd = fft_reference(values, weights, lags)
+    level_0 = lags < correlator.points
+    differences = {}
+    for number, dimension in enumerate(DIMENSIONS):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            relative = np.abs(out[f'msd_{dimension}'] - msd[number]) / msd[number]
+        relative[lags == 0] = 0
+        differences[dimension] = (float(np.nanmax(relative[level_0])), float(np.nanmax(relative[~level_0])) if (~level_0).any() else 0.0)
+    return out, pairs, covariance, msd, differences
+
+
+def parse_args():
+    import argparse
+    from evk_tracking.streams import add_source_arguments
+    """
+    Parse command line arguments.
+    """
+    parser = argparse.ArgumentParser(description='Multi-tau autocorrelation and MSD of the x and y positions.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    add_source_arguments(parser)
+    analysis_options = parser.add_argument_group('Analysis options')
+    analysis_options.add_argument('--dt', dest='dt', type=float, default=None,
+                                  help='Period of the grid (update period of the tracker). Unit: us. Default: median period of the first positions.')
+    analysis_options.add_argument('--max-tau', dest='max_tau', type=float, default=10,
+                                  help='Longest lag. Unit: seconds. Default: 10s.')
+    analysis_options.add_argument('--points', dest='points', type=int, default=16,
+                                  help='Lags per level (even); there are points/2 lags per octave. Default: 16.')
+    analysis_options.add_argument('--mode', dest='mode', type=str, default='decimate', choices=CORRELATION_MODES,
+                                  help='Samples of the higher levels: every second sample (unbiased MSD) or mean of two samples. Default: decimate.')
+    analysis_options.add_argument('--report', dest='report', type=float, default=0,
+                                  help='Saves (or prints) the result every [report] seconds (0: only at the end). Unit: seconds. Default: 0.')
+    analysis_options.add_argument('--check', dest='check', type=bool, default=False,
+                                  help='Compares the result with an FFT computation over all the pairs (keeps the whole series in memory). Default: False.')
+    analysis_options.add_argument('-o', '--output', dest='output', type=str, default='',
+                                  help='CSV file of the result (tau in us, pairs, acf, cov and msd of x and y). Default: \'\' (printed).')
+    return parser.parse_args()
+
+
+def print_result(out):
+    print('tau_s,pairs,acf_x,acf_y,msd_x,msd_y')
+    for row in out:
+        print(f"{row['tau'] * 1e-6:.6g},{row['pairs']:.0f},{row['acf_x']:.4f},{row['acf_y']:.4f},{row['msd_x']:.5g},{row['msd_y']:.5g}")
+
+
+def main():
+    """
+    Main
+    """
+    from evk_tracking.streams import TrackSelector, results_from_args
+    args = parse_args()
+    correlator = MultiTauCorrelator(args.dt, args.max_tau * 1e6, args.points, args.mode, keep_series=args.check)
+    selector = TrackSelector(args.object_id)
+    last_report = time.monotonic()
+    try:
+        for new_run, records in results_from_args(args):
+            if new_run:
+                selector.reset()
+                correlator.restart()
+            correlator.add(selector.select(records))
+            if args.report and time.monotonic() - last_report >= args.report and correlator.levels is not None:
+                if args.output:
+                    correlator.save(args.output)
+                else:
+                    print_result(correlator.result())
+                last_report = time.monotonic()
+    except KeyboardInterrupt:
+        pass
+    correlator.finish()
+    print(f'{correlator.samples} positions, period {correlator.dt}us, {len(correlator.levels or [])} levels, '
+          f'{correlator.resets} resets (gaps longer than the longest lag, new runs)')
+    if args.output:
+        print('Result saved at ' + correlator.save(args.output))
+    else:
+        print_result(correlator.result())
+    if args.check and correlator.levels is not None:
+        differences = check(correlator)[-1]
+        for dimension, (level_0, higher) in differences.items():
+            print(f'MSD {dimension}: largest relative difference with the FFT reference {level_0:.2e} at level 0, '
+                  f'{higher:.2e} at the higher levels')
+
+
+if __name__ == "__main__":
+        main()
@@ -0,0 +1,364 @@
+"""
+Compressed, chunked event files (.evk): a record of the events given to the tracking filters, so the tracks
+can be computed again (e.g. with other parameters, python3 -m evk_tracking batch -i [file].evk) without a new measurement.
+
+EventFileWriter takes the event batches from the acquisition loop and only copies them into a queue; a
+background thread gathers them into chunks, compresses them and writes them. The chunks are compressed with
+the event codec of codec.py (codec='evkc1', about half the size of zlib) or with zlib alone (codec='zlib'),
+by [threads] threads.
+When the queue is full (the disk cannot keep up), the batch is dropped and counted instead of slowing down
+the tracking; the count is written at the end of the file.
+
+Layout (little-endian):
+    header:  magic b'EVKEVTS1', uint32 metadata size, metadata (JSON: width, height, dtype, codec, source,
+             tracking parameters...)
+    chunks:  b'CHNK', uint32 events, uint32 payload size, int64 first t, int64 last t, uint32 crc32 of the payload,
+             payload (evk_codec block, or zlib of the EVENT_DTYPE records)
+    end:     b'END ', uint32 0, uint32 16, int64 first t, int64 last t, uint32 0, uint64 events, uint64 dropped events
+The chunk headers give the time range of the chunks, so a time range is read without decompressing the
+chunks before it (EventFileIterator).
+
+Files can also be converted (e.g. a RAW file to archive it) and inspected:
+    python3 -m evk_tracking.eventfile recording.raw recording.evk --threads 4
+    python3 -m evk_tracking.eventfile recording.evk
+"""
+
+import datetime
+import json
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from evk_tracking.codec import CODEC_NAME, encode_block, decode_block
+from evk_tracking.common import EVENT_DTYPE, concatenate_events
+
+
+MAGIC = b'EVKEVTS1'
+CHUNK_FORMAT = '<4sIIqqI'
+CHUNK_SIZE = struct.calcsize(CHUNK_FORMAT)
+END_FORMAT = '<QQ'
+
+_CLOSE = object()
+
+
+class EventFileWriter:
+    """
+    Writes an .evk file from a background thread, see the top of this file.
+    chunk_events: events per chunk; chunk_duration: maximum time (us) covered by a chunk; threads: chunks
+    encoded in parallel. With background=False, write() encodes and writes from the calling thread (file
+    conversion, nothing is dropped).
+    """
+    def __init__(self, path, width, height, metadata=None, chunk_events=1 << 18, chunk_duration=1000000, level=1,
+                 queue_size=4096, codec=CODEC_NAME, threads=1, background=True):
+        if codec not in (CODEC_NAME, 'zlib'):
+            raise ValueError(f'Unknown event codec: {codec}')
+        self.path = path
+        self.chunk_events = chunk_events
+        self.chunk_duration = chunk_duration
+        self.level = level
+        self.codec = codec
+        self.threads = threads
+        self.events = 0
+        self.dropped = 0
+        self.t_first = self.t_last = -1
+        self.pending = []
+        self.pending_events = 0
+        # Chunks being encoded by the threads, written in order
+        self.encoding = deque()
+        self.executor = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+        self.file = open(path, 'wb')
+        metadata = dict(metadata or {}, width=width, height=height, dtype=EVENT_DTYPE.descr, codec=codec,
+                        created=datetime.datetime.now().strftime('%Y%m%d_%H-%M-%S'))
+        metadata_bytes = json.dumps(metadata).encode()
+        self.file.write(MAGIC + struct.pack('<I', len(metadata_bytes)) + metadata_bytes)
+        self.queue = None
+        self.thread = None
+        if background:
+            self.queue = queue.Queue(queue_size)
+            self.thread = threading.Thread(target=self._run, name='evk-event-tee', daemon=True)
+            self.thread.start()
+
+    def write(self, evs):
+        """
+        Queues a copy of the events, never blocks.
+        """
+        if len(evs) == 0:
+            return
+        if self.thread is None:
+            self._add(np.array(evs, dtype=EVENT_DTYPE))
+            return
+        try:
+            self.queue.put_nowait(np.array(evs, dtype=EVENT_DTYPE))
+        except queue.Full:
+            self.dropped += len(evs)
+
+    def encode(self, evs):
+        if self.codec == 'zlib':
+            return zlib.compress(evs.tobytes(), self.level)
+        return encode_block(evs, self.level)
+
+    def _add(self, evs):
+        self.pending.append(evs)
+        self.pending_events += len(evs)
+        if self.pending_events >= self.chunk_events or evs['t'][-1] - self.pending[0]['t'][0] >= self.chunk_duration:
+            self._flush_pending()
+
+    def _flush_pending(self):
+        if not self.pending:
+            return
+        evs = concatenate_events(self.pending)
+        self.pending, self.pending_events = [], 0
+        if self.executor is None:
+            self._write_chunk(len(evs), int(evs['t'][0]), int(evs['t'][-1]), self.encode(evs))
+        else:
+            self.encoding.append((len(evs), int(evs['t'][0]), int(evs['t'][-1]), self.executor.submit(self.encode, evs)))
+            self._write_encoded()
+
+    def _write_encoded(self, wait=False):
+        while self.encoding and (wait or self.encoding[0][3].done() or len(self.encoding) > self.threads):
+            n, t_first, t_last, future = self.encoding.popleft()
+            self._write_chunk(n, t_first, t_last, future.result())
+
+    def _write_chunk(self, n, t_first, t_last, payload):
+        self.file.write(struct.pack(CHUNK_FORMAT, b'CHNK', n, len(payload), t_first, t_last, zlib.crc32(payload)))
+        self.file.write(payload)
+        if self.t_first < 0:
+            self.t_first = t_first
+        self.t_last = t_last
+        self.events += n
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is _CLOSE:
+                return
+            self._add(item)
+
+    def close(self):
+        """
+        Writes the last chunk and the end record. Returns the number of dropped events.
+        """
+        if self.thread is not None:
+            self.queue.put(_CLOSE)
+            self.thread.join()
+        self._flush_pending()
+        self._write_encoded(wait=True)
+        if self.executor is not None:
+            self.executor.shutdown()
+        self.file.write(struct.pack(CHUNK_FORMAT, b'END ', 0, 16, self.t_first, self.t_last, 0))
+        self.file.write(struct.pack(END_FORMAT, self.events, self.dropped))
+        self.file.close()
+        return self.dropped
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class EventFileReader:
+    """
+    Reads an .evk file. metadata: the JSON metadata of the header; events/dropped: from the end record (None
+    if the file was not closed, e.g. after a crash: the complete chunks can still be read).
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as event_file:
+            if event_file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f'{path} is not an .evk event file.')
+            size, = struct.unpack('<I', event_file.read(4))
+            self.metadata = json.loads(event_file.read(size))
+            self.data_offset = event_file.tell()
+        self.width = self.metadata['width']
+        self.height = self.metadata['height']
+        self.codec = self.metadata.get('codec', 'zlib')
+        # Record layout of the zlib chunks (files written before EVENT_DTYPE had the EventCD layout are packed)
+        self.dtype = np.lib.format.descr_to_dtype([tuple(field) for field in self.metadata['dtype']]) \
+            if 'dtype' in self.metadata else EVENT_DTYPE
+        self.events = None
+        self.dropped = None
+
+    def chunk_headers(self):
+        """
+        Yields (file offset of the payload, events, payload size, first t, last t, crc32) of every chunk.
+        """
+        with open(self.path, 'rb') as event_file:
+            event_file.seek(self.data_offset)
+            while True:
+                header = event_file.read(CHUNK_SIZE)
+                if len(header) < CHUNK_SIZE:
+                    return
+                tag, n, size, t_first, t_last, crc = struct.unpack(CHUNK_FORMAT, header)
+                if tag == b'END ':
+                    self.events, self.dropped = struct.unpack(END_FORMAT, event_file.read(size))
+                    return
+                if tag != b'CHNK':
+                    raise ValueError(f'{self.path}: corrupted chunk at byte {event_file.tell() - CHUNK_SIZE}.')
+                yield event_file.tell(), n, size, t_first, t_last, crc
+                event_file.seek(size, os.SEEK_CUR)
+
+    def read_payload(self, event_file, offset, size, crc):
+        event_file.seek(offset)
+        payload = event_file.read(size)
+        if len(payload) < size:
+            raise EOFError(f'{self.path}: truncated chunk at byte {offset}.')
+        if zlib.crc32(payload) != crc:
+            raise ValueError(f'{self.path}: checksum error in the chunk at byte {offset}.')
+        return payload
+
+    def decode(self, payload, n):
+        if self.codec == 'zlib':
+            evs = np.frombuffer(zlib.decompress(payload), dtype=self.dtype, count=n)
+            return evs if self.dtype == EVENT_DTYPE else evs.astype(EVENT_DTYPE)
+        return decode_block(payload)
+
+    def chunks(self, start_ts=0, end_ts=None, threads=1):
+        """
+        Yields the chunks (event arrays) that overlap [start_ts, end_ts), without reading the others.
+        With threads > 1, the next chunks are decoded in parallel while the current one is used.
+        """
+        executor = ThreadPoolExecutor(max_workers=threads) if threads > 1 else None
+        decoding = deque()
+        try:
+            with open(self.path, 'rb') as event_file:
+                for offset, n, size, t_first, t_last, crc in self.chunk_headers():
+                    if t_last < start_ts:
+                        continue
+                    if end_ts is not None and t_first >= end_ts:
+                        break
+                    try:
+                        payload = self.read_payload(event_file, offset, size, crc)
+                    except EOFError as e:  # The writer did not finish the file
+                        print(e)
+                        break
+                    if executor is None:
+                        yield self.decode(payload, n)
+                        continue
+                    decoding.append(executor.submit(self.decode, payload, n))
+                    if len(decoding) > threads:
+                        yield decoding.popleft().result()
+            while decoding:
+                yield decoding.popleft().result()
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+
+class EventFileIterator:
+    """
+    Same interface as EventsIterator for an .evk file: batches of delta_t us of the events of
+    [start_ts, start_ts + max_duration), and get_size(). threads: chunks decoded in parallel.
+    """
+    def __init__(self, input_path, start_ts=0, max_duration=None, delta_t=10000, threads=1):
+        self.event_file = EventFileReader(input_path)
+        self.start_ts = start_ts
+        self.max_duration = max_duration
+        self.delta_t = delta_t
+        self.threads = threads
+
+    def get_size(self):
+        return self.event_file.height, self.event_file.width
+
+    def __iter__(self):
+        end_ts = self.start_ts + self.max_duration if self.max_duration else None
+        batch_end = None
+        carry = np.empty(0, dtype=EVENT_DTYPE)
+        for evs in self.event_file.chunks(self.start_ts, end_ts, self.threads):
+            evs = evs[(evs['t'] >= self.start_ts) & ((evs['t'] < end_ts) if end_ts is not None else True)]
+            if len(evs) == 0:
+                continue
+            evs = concatenate_events((carry, evs)) if len(carry) else evs
+            if batch_end is None:
+                batch_end = self.start_ts + ((int(evs['t'][0]) - self.start_ts) // self.delta_t + 1) * self.delta_t
+            # The batches are complete once a later event is read, the rest waits for the next chunk
+            while evs['t'][-1] >= batch_end:
+                split = np.searchsorted(evs['t'], batch_end)
+                if split:
+                    yield evs[:split]
+                evs = evs[split:]
+                batch_end += self.delta_t * ((int(evs['t'][0]) - batch_end) // self.delta_t + 1)
+            carry = evs
+        if len(carry):
+            yield carry
+
+
+def tracker_metadata(inputs, **extra):
+    """
+    Input and tracking parameters of a tracking script (its Inputs), kept in the header of its event file.
+    """
+    keys = ('input_path', 'process_from', 'process_to', 'update_frequency', 'accumulation_time', 'min_size', 'max_size',
+            'activity_time_ths', 'activity_ths', 'activity_trail_ths', 'filter_backend', 'bias_file')
+    return dict({key: getattr(inputs, key) for key in keys if hasattr(inputs, key)}, **extra)
+
+
+def convert(input_path, output_path, start_ts=0, max_duration=None, codec=CODEC_NAME, level=1, threads=1):
+    """
+    Writes the events of a RAW or .evk file (or of a time range of it) into an .evk file. Returns the number of events.
+    """
+    from evk_tracking.rawindex import open_events
+    mv_iterator = open_events(input_path=input_path, start_ts=start_ts, max_duration=max_duration, delta_t=100000)
+    height, width = mv_iterator.get_size()
+    with EventFileWriter(output_path, width, height, metadata={'source': input_path}, level=level, codec=codec,
+                         threads=threads, background=False) as writer:
+        for evs in mv_iterator:
+            writer.write(evs)
+    return writer.events
+
+
+def parse_args():
+    import argparse
+    """
+    Parse command line arguments.
+    """
+    parser = argparse.ArgumentParser(description='Converts RAW or .evk files to .evk files, or prints the content of an .evk file.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('input_path', help='RAW or .evk file.')
+    parser.add_argument('output_path', nargs='?', default='', help='.evk file to write. If not specified, the input .evk file is described.')
+    parser.add_argument('-pf', '--process-from', dest='process_from', type=float, default=0,
+                        help='Start of the converted time range. Unit: seconds. Default: 0s.')
+    parser.add_argument('-pt', '--process-to', dest='process_to', type=float, default=None,
+                        help='End of the converted time range. Unit: seconds. Default: None (end of file).')
+    parser.add_argument('-c', '--codec', dest='codec', type=str, default=CODEC_NAME, choices=[CODEC_NAME, 'zlib'],
+                        help=f'Compression of the chunks. Default: {CODEC_NAME}.')
+    parser.add_argument('-l', '--level', dest='level', type=int, default=1, help='zlib compression level. Default: 1.')
+    parser.add_argument('-j', '--threads', dest='threads', type=int, default=1,
+                        help='Number of threads encoding the chunks. Default: 1.')
+    return parser.parse_args()
+
+
+def main():
+    """
+    Main
+    """
+    args = parse_args()
+    if not args.output_path:
+        reader = EventFileReader(args.input_path)
+        headers = list(reader.chunk_headers())
+        print(json.dumps(reader.metadata, indent=4))
+        if headers:
+            n = sum(header[1] for header in headers)
+            print(f'{len(headers)} chunks, {n} events from {headers[0][3]}us to {headers[-1][4]}us, '
+                  f'{os.path.getsize(args.input_path) / max(n, 1):.2f} bytes per event')
+        if reader.events is None:
+            print('No end record: the file was not closed.')
+        elif reader.dropped:
+            print(f'{reader.dropped} events were dropped while recording.')
+        return
+
+    start_ts = args.process_from * 1e6
+    max_duration = (args.process_to - args.process_from) * 1e6 if args.process_to is not None else None
+    start = time.monotonic()
+    events = convert(args.input_path, args.output_path, start_ts, max_duration, args.codec, args.level, args.threads)
+    print(f'{events} events written to {args.output_path} in {time.monotonic() - start:.2f}s, '
+          f'{os.path.getsize(args.output_path) / max(events, 1):.2f} bytes per event')
+
+
+if __name__ == "__main__":
+        main()
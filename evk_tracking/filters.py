@@ -0,0 +1,128 @@
+"""
+Activity noise filter and trail filter in numpy, to compare with (and replace) the filters of the SDK
+(ActivityNoiseFilterAlgorithm, TrailFilterAlgorithm), whose cost cannot be tuned.
+
+Both filters keep a map of the last timestamp of every pixel:
+- ActivityFilter: an event is kept when at least [activity_ths] of its 8 neighbouring pixels had an event in the
+  last [time_ths] us (the SDK filter is the case activity_ths = 1). All the events update the map;
+- TrailFilter: an event is kept when the previous event of the same pixel had the other polarity, or happened
+  at least [time_ths] us before. All the events update the map (the map of the SDK filter may only be updated
+  by the kept events: benchmarks/filter_benchmark.py measures how often both filters agree).
+The events of a batch depend on the previous events of the same batch. Instead of a loop over the events, the
+batch is sorted by pixel (stable, so each pixel keeps its time order): the previous event of a pixel is then
+the previous event of the sorted batch, or the map when the pixel has no earlier event in the batch, and a
+searchsorted per neighbour offset finds the previous event of the neighbouring pixels.
+
+EventFilters runs the activity filter then the trail filter with either backend ('sdk' or 'numpy') and returns
+numpy arrays of events, which the SDK algorithms (TrackingAlgorithm, frame generation) accept as they are.
+"""
+
+import numpy as np
+
+
+FILTER_BACKENDS = ['sdk', 'numpy']
+NEVER = np.iinfo(np.int64).min // 2
+
+
+class ActivityFilter:
+    def __init__(self, width, height, time_ths, activity_ths=1):
+        self.time_ths = time_ths
+        self.activity_ths = activity_ths
+        # One pixel of padding around the sensor, so the neighbours of the border pixels exist
+        self.stride = width + 2
+        self.last_t = np.full((height + 2) * self.stride, NEVER, dtype=np.int64)
+        self.offsets = [dy * self.stride + dx for dy in (-1, 0, 1) for dx in (-1, 0, 1) if dx or dy]
+
+    def process_events(self, evs):
+        """
+        Returns the events of evs that pass the filter (the SDK filter is disabled with time_ths = 0).
+        """
+        n = len(evs)
+        if n == 0 or self.time_ths <= 0:
+            return evs
+        t = evs['t']
+        pixels = (evs['y'].astype(np.int64) + 1) * self.stride + evs['x'].astype(np.int64) + 1
+        order = np.argsort(pixels, kind='stable')
+        sorted_pixels = pixels[order]
+        sorted_t = t[order]
+        # (pixel, index in the batch) as a single sorted key. The queries are made in the same order, so they are
+        # sorted too, which makes searchsorted several times faster
+        keys = sorted_pixels * n + order
+
+        active = np.zeros(n, dtype=np.int32)
+        for offset in self.offsets:
+            neighbours = sorted_pixels + offset
+            previous = np.searchsorted(keys, keys + offset * n) - 1
+            clipped = np.maximum(previous, 0)
+            in_batch = (previous >= 0) & (sorted_pixels[clipped] == neighbours)
+            neighbour_t = np.where(in_batch, sorted_t[clipped], self.last_t[neighbours])
+            active += sorted_t - neighbour_t <= self.time_ths
+        keep = np.empty(n, dtype=bool)
+        keep[order] = active >= self.activity_ths
+
+        # Last event of each pixel of the batch
+        last = np.flatnonzero(np.append(sorted_pixels[1:] != sorted_pixels[:-1], True))
+        self.last_t[sorted_pixels[last]] = sorted_t[last]
+        return evs[keep]
+
+
+class TrailFilter:
+    def __init__(self, width, height, time_ths):
+        self.time_ths = time_ths
+        self.width = width
+        self.last_t = np.full(width * height, NEVER, dtype=np.int64)
+        self.last_p = np.full(width * height, -1, dtype=np.int16)
+
+    def process_events(self, evs):
+        """
+        Returns the events of evs that pass the filter.
+        """
+        if len(evs) == 0:
+            return evs
+        pixels = evs['y'].astype(np.int64) * self.width + evs['x'].astype(np.int64)
+        order = np.argsort(pixels, kind='stable')
+        sorted_pixels = pixels[order]
+        sorted_t = evs['t'][order]
+        sorted_p = evs['p'][order]
+
+        first = np.insert(sorted_pixels[1:] != sorted_pixels[:-1], 0, True)
+        previous_t = np.where(first, self.last_t[sorted_pixels], np.roll(sorted_t, 1))
+        previous_p = np.where(first, self.last_p[sorted_pixels], np.roll(sorted_p, 1))
+        keep = np.empty(len(evs), dtype=bool)
+        keep[order] = (sorted_p != previous_p) | (sorted_t - previous_t >= self.time_ths)
+
+        last = np.flatnonzero(np.append(first[1:], True))
+        self.last_t[sorted_pixels[last]] = sorted_t[last]
+        self.last_p[sorted_pixels[last]] = sorted_p[last]
+        return evs[keep]
+
+
+class EventFilters:
+    def __init__(self, width, height, activity_time_ths, activity_ths=1, activity_trail_ths=1000, backend='sdk'):
+        """
+        backend: 'sdk' (ActivityNoiseFilterAlgorithm and TrailFilterAlgorithm, activity_ths is not used)
+        or 'numpy' (ActivityFilter and TrailFilter).
+        """
+        if backend not in FILTER_BACKENDS:
+            raise ValueError(f'Unknown filter backend: {backend}')
+        self.backend = backend
+        if backend == 'sdk':
+            from metavision_sdk_cv import ActivityNoiseFilterAlgorithm, TrailFilterAlgorithm
+            self.activity_filter = ActivityNoiseFilterAlgorithm(width, height, activity_time_ths)
+            self.trail_filter = TrailFilterAlgorithm(width, height, activity_trail_ths)
+            self.events_buf = None
+        else:
+            self.activity_filter = ActivityFilter(width, height, activity_time_ths, activity_ths)
+            self.trail_filter = TrailFilter(width, height, activity_trail_ths)
+
+    def process_events(self, evs):
+        """
+        Returns the filtered events as a numpy array, valid until the next call.
+        """
+        if self.backend == 'numpy':
+            return self.trail_filter.process_events(self.activity_filter.process_events(evs))
+        # A new output buffer every batch, as the tracking scripts do
+        self.events_buf = self.activity_filter.get_empty_output_buffer()
+        self.activity_filter.process_events(evs, self.events_buf)
+        self.trail_filter.process_events_(self.events_buf)
+        return self.events_buf.numpy()
@@ -0,0 +1,494 @@
+# Copyright (c) Prophesee S.A. - All Rights Reserved
+#
+# Subject to Prophesee Metavision Licensing Terms and Conditions ("License T&C's").
+# You may not use this file except in compliance with these License T&C's.
+# A copy of these License T&C's is located in the "licensing" folder accompanying this file.
+
+"""
+Simple script to track general objects.
+You can use it, for example, with the reference file traffic_monitoring.raw.
+"""
+
+
+import numpy as np
+import datetime
+import os
+#import gc
+
+from metavision_core.event_io import LiveReplayEventsIterator, is_live_camera
+from metavision_sdk_analytics import TrackingAlgorithm, TrackingConfig
+from metavision_sdk_core import OnDemandFrameGenerationAlgorithm
+
+from evk_tracking.pipeline import results_to_records
+from evk_tracking.camera import CameraSession, MetavisionBackend
+from evk_tracking.rawindex import open_events
+from evk_tracking.filters import EventFilters, FILTER_BACKENDS
+from evk_tracking.common import get_biases_from_file
+from evk_tracking.trajectory import save_results
+
+class Inputs:
+    def __init__(self, args):
+        self.input_path = args.raw_file_path
+        self.process_from = args.process_from * 1e6
+        if args.process_to is not None:
+            self.process_to = args.process_to * 1e6
+        else:
+            self.process_to = None
+        self.bias_file = args.bias_file_path
+        self.update_frequency = float(args.update_frequency)
+        if args.accumulation_time > 0:
+            self.accumulation_time = int(args.accumulation_time * 1e6)
+        else:
+            self.accumulation_time = int(1e6/args.update_frequency)
+        self.min_size = args.min_size
+        self.max_size = args.max_size
+        self.activity_time_ths = args.activity_time_ths
+        self.activity_ths = args.activity_ths
+        self.activity_trail_ths = args.activity_trail_ths
+        self.filter_backend = args.filter_backend
+        if args.output_csv_path:
+            self.output_csv_path = args.output_csv_path
+        else:
+            self.output_csv_path = os.getcwd() + '/EVK_'
+        self.measurement_time = args.outputs_csv_interval * 1e6
+        self.save_flag = args.save_flag
+        self.replay_factor = args.replay_factor
+        self.sync_log = args.sync_log
+        self.memory_timeline = args.memory_timeline
+        self.memory_interval = args.memory_interval
+        self.memory_flush_available = args.memory_flush_available
+        self.stall_timeout = args.stall_timeout
+        self.trigger_channel = args.trigger_channel
+        self.results_ring = args.results_ring
+        self.results_ring_capacity = args.results_ring_capacity
+        self.no_runs = args.no_runs
+        self.event_tee = args.event_tee
+        self.catalog = args.catalog
+        self.save_format = args.save_format
+        self.run_tags = args.run_tags
+        self.velocity = args.velocity
+        self.velocity_window = args.velocity_window
+        self.high_rate = args.high_rate
+        self.high_rate_window = args.high_rate_window
+        self.high_rate_mode = args.high_rate_mode
+        self.histogram_bin = args.histogram_bin
+        self.drift_frame = args.drift_frame
+        self.dynamic_roi = args.dynamic_roi
+        self.roi_hysteresis = args.roi_hysteresis
+        self.roi_window = args.roi_window
+        self.roi_interval = args.roi_interval
+        self.roi_lost = args.roi_lost
+        self.roi_software = args.roi_software
+        self.multiprocess = args.multiprocess
+        self.mp_event_capacity = args.mp_event_capacity
+        self.mp_result_capacity = args.mp_result_capacity
+
+def parse_args():
+    import argparse
+    """
+    Parse command line arguments.
+    """
+    parser = argparse.ArgumentParser(description='Object Tracking', formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    # Base options
+    base_options = parser.add_argument_group('Base options')
+    base_options.add_argument('-i', '--input-raw-file', dest='raw_file_path', default='',
+                              help='Path to input RAW file. If not specified, the live stream of the first available camera is used.'
+                              "If it's a camera ID, it will try to open that camera instead.")
+    base_options.add_argument('-pf','--process-from', dest='process_from', type=int, default=0,
+                              help='Time at which the algorithm starts processing events. If not specified, the algorithm starts processing events from the beginning. Unit: seconds. Default value: 0s.')
+    base_options.add_argument('-pt','--process-to', dest='process_to', type=int, default=None,
+                              help='Time at which the algorithm stops processing events. If not specific, the algorithm will have to be manually stopped. Unit: seconds. Default value: None.')
+    base_options.add_argument('-bf', '--bias-file', dest='bias_file_path',default='',
+                              help='Path to BIAS file to modify the parameters of the sensor of the event-based camera. Default: \'\'.')
+    base_options.add_argument('-st', '--stall-timeout', dest='stall_timeout', type=float, default=0,
+                              help='Time without events after which the live camera is closed and reopened through the SDK with the same biases (also when the stream fails, see camera.py). 0 disables the recovery. Unit: seconds. Default: 0s.')
+    #add ROI as input?
+    algorithm_options = parser.add_argument_group('Algorithm options')
+    algorithm_options.add_argument('-uf', '--update-frequency', dest='update_frequency', type=int, default=1000,
+                              help='Frequency of the frame generation of the tracking algorithm. Unit: Hertz. Default: 1000Hz.')
+    algorithm_options.add_argument('-at', '--accum-time', dest='accumulation_time', type=float, default=0.,
+                              help='Time interval that the tracking algorithm uses to accumulate events into a frame. Unit: seconds. Default: inverse of [update_frequency].')
+    algorithm_options.add_argument('-vel', '--velocity', dest='velocity', type=bool, default=False,
+                              help='Adds the velocity of each object (vx, vy in pixels/s, columns 10 and 11 of the CSV files), fitted on the timestamps of its events (see velocity.py). Default: False.')
+    algorithm_options.add_argument('--velocity-window', dest='velocity_window', type=int, default=5000,
+                              help='Time window of the events used for the velocity. It should be longer than the time an object takes to cross its bounding box. Unit: us. Default: 5000us.')
+    algorithm_options.add_argument('-hr', '--high-rate', dest='high_rate', type=int, default=0,
+                              help='Step of the high-rate position of the dominant object: centroid of its events every [high_rate] us (or events, see --high-rate-mode), saved in [csv file]_hr.csv (see highrate.py). 0 disables it. Default: 0.')
+    algorithm_options.add_argument('--high-rate-window', dest='high_rate_window', type=int, default=0,
+                              help='Window of the events averaged by each high-rate position. Unit: us, or events with --high-rate-mode events. Default: [high_rate].')
+    algorithm_options.add_argument('--high-rate-mode', dest='high_rate_mode', type=str, default='time', choices=['time', 'events'],
+                              help='High-rate step and window in time (us) or in number of events. Default: time.')
+    algorithm_options.add_argument('-hist', '--histogram-bin', dest='histogram_bin', type=float, default=0,
+                              help='Bin width of the X, Y and XY position histograms of the dominant object, saved for each segment in [csv file]_hist.npz (see histograms.py). 0 disables them. Unit: pixels. Default: 0.')
+    algorithm_options.add_argument('-drift', '--drift-frame', dest='drift_frame', type=float, default=0,
+                              help='Duration of the points of the drift series of the trap frequency and linewidth of the dominant object (rolling spectrogram, see spectrogram.py), written during the run in [csv path][timestamp]_drift.csv. 0 disables it. Unit: seconds. Default: 0.')
+    # Object options
+    object_size_options = parser.add_argument_group('Object options')
+    object_size_options.add_argument('-mins', '--min-size', dest='min_size', type=int, default=10,
+                                    help='Minimal size of an object to track (or the resulting bounding box). Unit: pixels. Default: 10px.')
+    object_size_options.add_argument('-maxs', '--max-size', dest='max_size', type=int, default=100,
+                                    help='Maximal size of an object to track (or the resulting bounding box). Unit: pixels. Default: 100px.')
+    # Filtering options
+    filter_options = parser.add_argument_group('Filtering options')
+    filter_options.add_argument('--activity-time-ths', dest='activity_time_ths', type=int, default=10000,
+                                help='Length of the time window for activity filtering (Disabled if the threshold is equal to 0).')
+    filter_options.add_argument('--activity-ths', dest='activity_ths', type=int, default=1,
+                                help='Minimum number of active pixels in the neighborhood (numpy filters only, the SDK filter uses 1).')
+    filter_options.add_argument('--activity-trail-ths', dest='activity_trail_ths', type=int, default=1000,
+                                help='Length of the time window for trail filtering (in us).')
+    filter_options.add_argument('--filters', dest='filter_backend', type=str, default='sdk', choices=FILTER_BACKENDS,
+                                help='Implementation of the activity and trail filters: SDK algorithms or numpy (filters.py). Default: sdk.')
+    # Saving Options
+    saving_options = parser.add_argument_group('Saving options')
+    saving_options.add_argument('-csv', '--save-csv-path', dest='output_csv_path', type=str, default='',
+                                help='File path of output CSV files that contain the information of detected objects, excluding the file extension. Default: \'EVK_\{timestamp\}.csv\' at location of script.')
+    saving_options.add_argument('-csvt', '--save-csv-interval', dest='outputs_csv_interval', type=int, default=5,
+                                help='Time interval of tracked information saved into a single CSV file. For measurement times longer than the input interval time, several CSV files are saved with their corresponding timestamps. Unit: seconds. Default: 5s.')
+    saving_options.add_argument('-csvf', '--save-flag', dest='save_flag', type=bool, default=True,
+                                help="Flag that determines if measurements are recorded. Default: True.")
+    saving_options.add_argument('-csvn', '--csv-runs', dest='no_runs', type=int, default=5,
+                                help="Determines the number of runs that are required for saving. The program stops once they are saved. Default: 5 runs.")
+    saving_options.add_argument('-cat', '--catalog', dest='catalog', type=str, default='',
+                                help='Path of the SQLite catalog where every saved CSV file is registered with its sensor time range, biases and tracking parameters (see catalog.py). If not specified, files are not registered. Default: \'\'.')
+    saving_options.add_argument('-sfmt', '--save-format', dest='save_format', type=str, default='csv', choices=['csv', 'evkt'],
+                                help='Format of the saved files: CSV, or columnar trajectory files (.evkt) queried by column, time range and object ID without reading the rest (see trajectory.py). Default: csv.')
+    saving_options.add_argument('--run-tags', dest='run_tags', type=str, default='',
+                                help='Run information stored with the files in the catalog, as a JSON object (plan, run, cycle, repeat, drive), set by the run plan. Default: \'\'.')
+    saving_options.add_argument('-tee', '--event-tee', dest='event_tee', type=str, default='',
+                                help='File path of a compressed event file (.evk) where the events given to the tracking filters are recorded from a background thread, to track them again offline (e.g. python3 -m evk_tracking batch -i [path]). If not specified, events are not recorded. Default: \'\'.')
+    # Replay Option
+    replay_options = parser.add_argument_group('Replay options')
+    replay_options.add_argument('-rf', '--replay_factor', dest='replay_factor', type=float, default=1.,
+                                help='Replay factor. If greater than 1.0 we replay with slow-motion, otherwise this is a speed-up over real-time. Default: 1.0')
+    # Synchronization Options
+    sync_options = parser.add_argument_group('Synchronization options')
+    sync_options.add_argument('-sync', '--sync-log', dest='sync_log', type=str, default='',
+                                help='Path of the instrument command log written by EVKbiasesOptimization.py. If specified, an EVK_[timestamp].sync.json file with the clock alignment, the external triggers and the instrument commands in camera time is saved next to each CSV file. Default: \'\'.')
+    sync_options.add_argument('-tc', '--trigger-channel', dest='trigger_channel', type=int, default=-1,
+                                help='Trigger-in channel of the camera connected to the signal generator sync output (Disabled if negative). Default: -1.')
+    # Region of Interest options
+    roi_options = parser.add_argument_group('ROI Options')
+    roi_options.add_argument('-droi', '--dynamic-roi', dest='dynamic_roi', type=float, default=0,
+                                help='Margin of the dynamic ROI around the bounding box of the dominant object: the ROI follows the particle (see roi.py), starting from the whole sensor, which is used again when the particle is lost. 0 disables it. Unit: pixels. Default: 0.')
+    roi_options.add_argument('--roi-hysteresis', dest='roi_hysteresis', type=float, default=None,
+                                help='Distance between the recent position of the particle and the ROI centre above which the dynamic ROI is moved. Unit: pixels. Default: half of the margin.')
+    roi_options.add_argument('--roi-window', dest='roi_window', type=int, default=10000,
+                                help='Time window of the positions averaged into the recent position of the particle. Unit: us. Default: 10000us.')
+    roi_options.add_argument('--roi-interval', dest='roi_interval', type=int, default=10000,
+                                help='Minimum time between two moves of the dynamic ROI. Unit: us. Default: 10000us.')
+    roi_options.add_argument('--roi-lost', dest='roi_lost', type=int, default=200000,
+                                help='Time without position of the particle after which the dynamic ROI goes back to the whole sensor. Unit: us. Default: 200000us.')
+    roi_options.add_argument('--roi-software', dest='roi_software', type=bool, default=False,
+                                help='The dynamic ROI only filters the events in software, without moving the hardware ROI of a live camera. Default: False.')
+    # Memory Options
+    memory_options = parser.add_argument_group('Memory profiling options')
+    memory_options.add_argument('-mem', '--memory-timeline', dest='memory_timeline', type=str, default='',
+                                help='File path of a CSV timeline of the memory use (RSS, Python heap, results waiting to be saved), sampled from a background thread. The top Python allocators are written next to it. If not specified, memory is not profiled. Default: \'\'.')
+    memory_options.add_argument('--mem-interval', dest='memory_interval', type=float, default=1.,
+                                help='Sampling interval of the memory timeline. Unit: seconds. Default: 1s.')
+    memory_options.add_argument('--mem-flush-available', dest='memory_flush_available', type=float, default=10.,
+                                help='When the available memory falls below this percentage of the total, the results are saved before the end of the CSV interval. Default: 10%%.')
+    # Live output Options
+    live_options = parser.add_argument_group('Live output options')
+    live_options.add_argument('-rb', '--results-ring', dest='results_ring', type=str, default='',
+                                help='File path of a memory-mapped ring buffer where every tracking result is published for external processes (e.g. /dev/shm/evk_results, read it with python3 -m evk_tracking.ringbuffer [path]). If not specified, no ring is created. Default: \'\'.')
+    live_options.add_argument('-rbc', '--results-ring-capacity', dest='results_ring_capacity', type=int, default=1 << 16,
+                                help='Number of tracking results kept in the memory-mapped ring buffer. Default: 65536.')
+    # Multi-process Options
+    mp_options = parser.add_argument_group('Multi-process options')
+    mp_options.add_argument('-mp', '--multiprocess', dest='multiprocess', type=bool, default=False,
+                                help='Runs ingest/filtering, tracking and storage in three separate processes connected by shared-memory ring buffers. Default: False.')
+    mp_options.add_argument('--mp-event-capacity', dest='mp_event_capacity', type=int, default=1 << 22,
+                                help='Number of filtered events the ring buffer between the ingest and tracking processes can hold. Default: 4194304.')
+    mp_options.add_argument('--mp-result-capacity', dest='mp_result_capacity', type=int, default=1 << 18,
+                                help='Number of tracking results the ring buffer between the tracking and storage processes can hold. Default: 262144.')
+
+    args = parser.parse_args()
+
+    if args.process_to and args.process_from > args.process_to:
+        print(f"The processing time interval is not valid. [{args.process_from,}, {args.process_to}]")
+        exit(1)
+
+    if args.replay_factor < 0:
+        print(f'The replay factor is not valid. [{args.replay_factor}]')
+        exit(1)
+
+    return args
+
+
+def main():
+    """
+    Main
+    """
+    args = parse_args()
+    inputs = Inputs(args)
+
+    if inputs.multiprocess:
+        if inputs.velocity:
+            print('The velocity is not computed by the multi-process pipeline (-mp), only the positions are saved.')
+        if inputs.high_rate > 0:
+            print('The high-rate positions are not computed by the multi-process pipeline (-mp).')
+        if inputs.histogram_bin > 0:
+            print('The position histograms are not computed by the multi-process pipeline (-mp).')
+        if inputs.drift_frame > 0:
+            print('The drift series is not computed by the multi-process pipeline (-mp).')
+        if inputs.dynamic_roi > 0:
+            print('The dynamic ROI is not used by the multi-process pipeline (-mp).')
+        if inputs.sync_log or inputs.trigger_channel >= 0:
+            print('The synchronization sidecars (-sync, -tc) are not written by the multi-process pipeline (-mp).')
+        if inputs.memory_timeline:
+            print('The memory timeline (-mem) is not recorded by the multi-process pipeline (-mp).')
+        if inputs.stall_timeout > 0:
+            print('The camera is not reopened after a stall (-st) by the multi-process pipeline (-mp).')
+        from evk_tracking.pipeline import run_multiprocess
+        run_multiprocess(inputs)
+        return
+
+    total_results = []
+    measurement_index = 0
+
+    # Events iterator on Camera or RAW file - CD PRODUCER
+    mv_iterator = open_events(input_path=inputs.input_path, start_ts=inputs.process_from,
+                              max_duration=inputs.process_to - inputs.process_from if inputs.process_to else None,
+                              delta_t=1e2)
+
+    if is_live_camera(inputs.input_path): #EVK camera connected
+        device = mv_iterator.reader.device
+        #i_roi = device.get_i_roi()
+        if os.path.isfile(inputs.bias_file):
+                b = get_biases_from_file(inputs.bias_file)
+
+                i_ll_biases = device.get_i_ll_biases()
+                for bias_name, bias_value in b.items():
+                    print(f'Applying {bias_name} = {bias_value}')
+                    i_ll_biases.set(bias_name, bias_value)
+                del i_ll_biases
+        if inputs.stall_timeout > 0: # The camera is closed and reopened through the SDK if the stream stalls or fails
+            mv_iterator = CameraSession(MetavisionBackend(inputs.input_path), stall_timeout=inputs.stall_timeout,
+                                        biases=get_biases_from_file(inputs.bias_file) if os.path.isfile(inputs.bias_file) else {},
+                                        iterator=mv_iterator, device=device)
+        del device # Only the session may hold the device, so that it can be released on recovery
+    elif inputs.replay_factor > 0: #Using a RAW file
+        mv_iterator = LiveReplayEventsIterator(mv_iterator, replay_factor=inputs.replay_factor)
+
+    sensor_height, sensor_width = mv_iterator.get_size() # Sensor Geometry
+
+    # Alignment of the trajectories with the instrument commands and external triggers
+    tracker_sync = None
+    if inputs.sync_log or inputs.trigger_channel >= 0:
+        from evk_tracking.sync import TrackerSync
+        tracker_sync = TrackerSync(mv_iterator, inputs.sync_log, inputs.trigger_channel, is_live_camera(inputs.input_path))
+
+    # Noise + Trail filter that will be applied to events
+    event_filters = EventFilters(sensor_width, sensor_height, inputs.activity_time_ths, inputs.activity_ths,
+                                 inputs.activity_trail_ths, backend=inputs.filter_backend)
+
+    # Record of the events given to the filters, to track them again offline
+    event_tee = None
+    if inputs.event_tee:
+        from evk_tracking.eventfile import EventFileWriter, tracker_metadata
+        event_tee = EventFileWriter(inputs.event_tee, sensor_width, sensor_height, metadata=tracker_metadata(inputs))
+
+    # Catalog of the saved files
+    catalog = None
+    if inputs.catalog:
+        from evk_tracking.catalog import RunCatalog, segment_fields
+        catalog = RunCatalog(inputs.catalog)
+        catalog_fields = segment_fields(inputs)
+
+    # Velocity fitted on the events of each object
+    velocity_estimator = None
+    if inputs.velocity:
+        from evk_tracking.velocity import VelocityEstimator
+        velocity_estimator = VelocityEstimator(window=inputs.velocity_window)
+
+    # Position of the dominant object between the tracking updates
+    high_rate = None
+    if inputs.high_rate > 0:
+        from evk_tracking.highrate import HighRateCentroid
+        high_rate = HighRateCentroid(inputs.high_rate, inputs.high_rate_window, mode=inputs.high_rate_mode)
+
+    # Position histograms of the dominant object, saved with each segment
+    position_histograms = None
+    if inputs.histogram_bin > 0:
+        from evk_tracking.histograms import PositionHistograms
+        position_histograms = PositionHistograms(inputs.histogram_bin)
+
+    # Drift of the trap frequency and linewidth of the dominant object, written during the run
+    drift_spectrogram = None
+    if inputs.drift_frame > 0:
+        from evk_tracking.spectrogram import RollingSpectrogram
+        drift_path = inputs.output_csv_path + datetime.datetime.now().strftime('%Y%m%d_%H-%M-%S') + '_drift.csv'
+        drift_spectrogram = RollingSpectrogram(dt=1e6 / inputs.update_frequency, frame=inputs.drift_frame, output=drift_path)
+        print('Writing the drift series in ' + drift_path)
+
+    # ROI following the dominant object, in software and on the hardware ROI of a live camera
+    dynamic_roi = None
+    if inputs.dynamic_roi > 0:
+        from evk_tracking.roi import DynamicRoi, hardware_roi_setter
+        apply_hardware = hardware_roi_setter(mv_iterator) if not inputs.roi_software and is_live_camera(inputs.input_path) else None
+        dynamic_roi = DynamicRoi(sensor_width, sensor_height, inputs.dynamic_roi, inputs.roi_hysteresis, inputs.roi_window,
+                                 inputs.roi_lost, inputs.roi_interval, apply_hardware=apply_hardware)
+    track_selector = None # Dominant object for the features above
+    if position_histograms is not None or drift_spectrogram is not None or dynamic_roi is not None:
+        from evk_tracking.streams import TrackSelector
+        track_selector = TrackSelector()
+
+    # Memory profiling: timeline, warnings and early saving under memory pressure
+    memory_watchdog = None
+    if inputs.memory_timeline:
+        from evk_tracking.memwatch import MemoryWatchdog
+        memory_watchdog = MemoryWatchdog(inputs.memory_timeline, interval=inputs.memory_interval,
+                                         flush_available=inputs.memory_flush_available,
+                                         warn_available=2 * inputs.memory_flush_available)
+        memory_watchdog.register_pool('total_results', lambda: len(total_results))
+        memory_watchdog.start()
+
+    # Tracking Algorithm
+    tracking_config = TrackingConfig()  # Default configuration
+    tracking_algo = TrackingAlgorithm(sensor_width=sensor_width, sensor_height=sensor_height, tracking_config=tracking_config)
+    tracking_algo.update_frequency = inputs.update_frequency
+    tracking_algo.min_size = inputs.min_size
+    tracking_algo.max_size = inputs.max_size
+
+    # Event Frame Generator
+    events_frame_gen_algo = OnDemandFrameGenerationAlgorithm(sensor_width, sensor_height, inputs.accumulation_time)
+    output_img = np.zeros((sensor_height, sensor_width, 3), np.uint8)
+
+    # Memory-mapped ring where the results are published for external processes
+    results_ring = None
+    if inputs.results_ring:
+        from evk_tracking.pipeline import RESULT_DTYPE
+        from evk_tracking.ringbuffer import MmapRingWriter
+        results_ring = MmapRingWriter(inputs.results_ring, RESULT_DTYPE, inputs.results_ring_capacity)
+        print('Publishing tracking results in ' + inputs.results_ring)
+
+    print('--------------------------------------------------------------\n')
+    print('No keyboard shortcuts present.\n'
+            'Press \'CTRL+c\' to leave the program.\n')
+    print('--------------------------------------------------------------\n')
+
+    # The results are converted to records once per update, when a feature uses them
+    records_needed = (results_ring is not None or high_rate is not None or position_histograms is not None or drift_spectrogram is not None
+                      or dynamic_roi is not None or velocity_estimator is not None)
+
+    # Output callback of the tracking algorithmEventsIterator
+    def tracking_cb(ts, tracking_results):
+        """
+        Tracking callback that is triggered whenever an object is detected.
+        """
+        nonlocal output_img
+        nonlocal total_results
+        nonlocal measurement_index
+
+        events_frame_gen_algo.generate(ts, output_img)
+        results = tracking_results.numpy()
+        records = results_to_records(results) if records_needed else None
+        if results_ring is not None:
+            results_ring.publish(records)
+        if high_rate is not None:
+            high_rate.on_results(records)
+        if position_histograms is not None or drift_spectrogram is not None or dynamic_roi is not None:
+            dominant_results = track_selector.select(records)
+            if position_histograms is not None:
+                position_histograms.add(dominant_results)
+            if drift_spectrogram is not None:
+                drift_spectrogram.add(dominant_results)
+            if dynamic_roi is not None:
+                dynamic_roi.update(ts, dominant_results)
+        if inputs.save_flag:
+            callback_results = results.tolist()  # Gets results as numpy.void type
+            if velocity_estimator is not None:
+                velocities = velocity_estimator.estimate(ts, records).tolist()
+                callback_results = [row + tuple(velocity) for row, velocity in zip(callback_results, velocities)]
+
+            if len(callback_results) > 0: # Only stores results if not empty
+                total_results.extend(callback_results)
+
+                current_time = callback_results[0][2]
+                start_time = inputs.measurement_time*measurement_index
+
+                interval_done = current_time >= start_time + inputs.measurement_time
+                memory_flush = memory_watchdog is not None and memory_watchdog.take_flush_request()
+                if interval_done or memory_flush:
+                    # Save run
+                    if interval_done:
+                        measurement_index += 1 # The first interval saved is interval 1
+                    else:
+                        print('Memory pressure: saving the results before the end of the interval.')
+                    file_timestamp = str(datetime.datetime.now().strftime('%Y%m%d_%H-%M-%S'))
+                    file_path = save_results(inputs.output_csv_path + file_timestamp, total_results, inputs.save_format, inputs.velocity)
+
+                    if high_rate is not None:
+                        print("High-rate positions saved at " + high_rate.save(file_path))
+                    if dynamic_roi is not None:
+                        print("ROI changes saved at " + dynamic_roi.save(file_path))
+                    if position_histograms is not None:
+                        position_histograms.metadata['sources'] = [file_path]
+                        print("Position histograms saved at " + position_histograms.save(os.path.splitext(file_path)[0] + '_hist.npz'))
+                        position_histograms.reset()
+                    if tracker_sync is not None:
+                        tracker_sync.write_sidecar(file_path, total_results[0][2], total_results[-1][2])
+                    if catalog is not None:
+                        catalog.register(file_path, total_results[0][2], total_results[-1][2], len(total_results),
+                                         kind=inputs.save_format, **catalog_fields)
+                    print("Results saved at " + file_path)
+                    del file_timestamp
+                    del file_path
+                    del total_results
+                    total_results = []
+                del current_time
+                del start_time
+            del callback_results
+            #gc.collect()
+
+    # Setting output callback to tracking algorithm (asynchronous)
+    tracking_algo.set_output_callback(tracking_cb)
+
+    # Process events, until -csvn saved intervals or Ctrl+C
+    try:
+        for evs in mv_iterator:
+            if tracker_sync is not None:
+                tracker_sync.on_events(evs)
+
+            # Process events
+            if dynamic_roi is not None:
+                evs = dynamic_roi.filter(evs)
+            if event_tee is not None:
+                event_tee.write(evs)
+            filtered_evs = event_filters.process_events(evs)
+            events_frame_gen_algo.process_events(filtered_evs)
+            if velocity_estimator is not None:
+                velocity_estimator.add_events(filtered_evs)
+            if high_rate is not None:
+                high_rate.add_events(filtered_evs)
+            tracking_algo.process_events(filtered_evs)
+            if measurement_index >= inputs.no_runs: # Stops after -csvn saved intervals, like the video scripts
+                break
+    except KeyboardInterrupt:
+        print('Program closing...')
+    finally:
+        if event_tee is not None:
+            dropped = event_tee.close()
+            print("Events saved at " + inputs.event_tee + (f' ({dropped} events dropped)' if dropped else ''))
+        if memory_watchdog is not None:
+            memory_watchdog.stop()
+            print("Memory timeline saved at " + inputs.memory_timeline)
+        if drift_spectrogram is not None:
+            print(f'Drift series saved at {drift_path} ({len(drift_spectrogram.finish())} points)')
+        if results_ring is not None:
+            results_ring.close()
+
+    if catalog is not None:
+        catalog.close()
+
+    if dynamic_roi is not None:
+        print('Dynamic ROI: ' + dynamic_roi.summary())
+
+    if isinstance(mv_iterator, CameraSession):
+        for reason, duration in mv_iterator.recoveries:
+            print(f'Camera recovery after {reason}: {duration:.3f}s')
+
+
+if __name__ == "__main__":
+        main()
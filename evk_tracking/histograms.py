@@ -0,0 +1,376 @@
+"""
+Streaming position histograms: the X and Y histograms of MicrotrapEventDetection.m (and the 2D XY histogram),
+updated from each batch of tracking results, with a memory that depends on the number of bins only.
+
+A histogram has a regular grid of bins of [bin width] pixels, aligned on an origin (0 by default), so two
+histograms with the same bin width and origin can always be merged bin to bin (files of a run, runs of a cycle,
+processes). The range is either fixed (limits; positions outside it are counted apart) or expands to the
+positions seen, up to [max_bins] bins (the positions beyond are counted apart). The number, mean, standard
+deviation, minimum and maximum of the positions are kept exactly, so the MATLAB X - mean(X) is the same
+histogram with the edges shifted by the mean (export with centered=True).
+
+Histograms are saved in .npz files (save/load), and exported as CSV for the plots ([prefix]_x.csv: bin edges,
+counts, probability).
+The tracking scripts save the histograms of the dominant object of each segment with -hist [bin width]
+([csv file]_hist.npz). From archived runs or the tracker ring, with processes for several files:
+    python3 -m evk_tracking.histograms EVK_*.evkt --bin 0.05 -j 8 -o run3
+    python3 -m evk_tracking.histograms --merge EVK_*_hist.npz -o cycle_low_drive --centered True
+"""
+
+import json
+import time
+import numpy as np
+
+
+class StreamingHistogram:
+    """
+    1D or 2D histogram on a regular grid, see the top of this file. bin_width and origin: one value per dimension
+    (or a number for all); limits: None (expanding) or one (low, high) per dimension.
+    """
+    def __init__(self, bin_width, origin=0.0, limits=None, max_bins=1 << 16, dimensions=1):
+        self.dimensions = dimensions
+        self.bin_width = np.broadcast_to(np.asarray(bin_width, dtype=float), (dimensions,)).copy()
+        self.origin = np.broadcast_to(np.asarray(origin, dtype=float), (dimensions,)).copy()
+        if (self.bin_width <= 0).any():
+            raise ValueError('The bin width must be positive.')
+        self.limits = None if limits is None else np.asarray(limits, dtype=float).reshape(dimensions, 2)
+        self.max_bins = max_bins
+        self.offset = np.zeros(dimensions, dtype=np.int64)  # Grid index of counts[0, ...]
+        self.counts = np.zeros((0,) * dimensions, dtype=np.int64)
+        if self.limits is not None:
+            low = np.floor((self.limits[:, 0] - self.origin) / self.bin_width).astype(np.int64)
+            high = np.ceil((self.limits[:, 1] - self.origin) / self.bin_width).astype(np.int64)
+            self.offset = low
+            self.counts = np.zeros(tuple(high - low), dtype=np.int64)
+        self.outside = 0
+        self.invalid = 0
+        self.n = 0
+        self.sum = np.zeros(dimensions)
+        self.sum_squares = np.zeros(dimensions)
+        self.min = np.full(dimensions, np.inf)
+        self.max = np.full(dimensions, -np.inf)
+
+    def _resize(self, low, high):
+        """
+        Grows the grid to the indexes [low, high] (inclusive) of each dimension.
+        """
+        low = np.minimum(low, self.offset) if self.counts.size else low
+        high = np.maximum(high, self.offset + np.array(self.counts.shape) - 1) if self.counts.size else high
+        shape = tuple(high - low + 1)
+        if shape == self.counts.shape and (low == self.offset).all():
+            return
+        counts = np.zeros(shape, dtype=np.int64)
+        if self.counts.size:
+            start = self.offset - low
+            counts[tuple(slice(s, s + n) for s, n in zip(start, self.counts.shape))] = self.counts
+        self.counts, self.offset = counts, low
+
+    def add(self, values):
+        """
+        Adds positions: an array of n values (1D), or (n, 2) (2D).
+        """
+        values = np.asarray(values, dtype=float).reshape(-1, self.dimensions)
+        finite = np.isfinite(values).all(axis=1)
+        self.invalid += int(np.count_nonzero(~finite))
+        values = values[finite]
+        if len(values) == 0:
+            return
+        self.n += len(values)
+        self.sum += values.sum(axis=0)
+        self.sum_squares += (values ** 2).sum(axis=0)
+        self.min = np.minimum(self.min, values.min(axis=0))
+        self.max = np.maximum(self.max, values.max(axis=0))
+
+        index = np.floor((values - self.origin) / self.bin_width).astype(np.int64)
+        if self.limits is None:
+            low, high = index.min(axis=0), index.max(axis=0)
+            current_low = self.offset if self.counts.size else low
+            current_high = self.offset + np.array(self.counts.shape) - 1 if self.counts.size else high
+            new_low, new_high = np.minimum(low, current_low), np.maximum(high, current_high)
+            if np.prod(new_high - new_low + 1) <= self.max_bins:
+                self._resize(new_low, new_high)
+            elif not self.counts.size:
+                # The first positions are too spread: the grid starts around their median
+                center = np.median(index, axis=0).astype(np.int64)
+                half = int(self.max_bins ** (1 / self.dimensions)) // 2
+                self._resize(center - half, center + half - 1)
+        index = index - self.offset
+        inside = ((index >= 0) & (index < np.array(self.counts.shape))).all(axis=1)
+        self.outside += int(np.count_nonzero(~inside))
+        index = index[inside]
+        if len(index):
+            flat = np.ravel_multi_index(tuple(index.T), self.counts.shape)
+            self.counts += np.bincount(flat, minlength=self.counts.size).reshape(self.counts.shape)
+
+    def clear(self):
+        """
+        Removes the counts and statistics; a fixed range is kept.
+        """
+        if self.limits is None:
+            self.counts = np.zeros((0,) * self.dimensions, dtype=np.int64)
+            self.offset = np.zeros(self.dimensions, dtype=np.int64)
+        else:
+            self.counts[:] = 0
+        self.outside = self.invalid = self.n = 0
+        self.sum[:] = 0
+        self.sum_squares[:] = 0
+        self.min[:] = np.inf
+        self.max[:] = -np.inf
+
+    def compatible(self, other):
+        return (self.dimensions == other.dimensions and np.allclose(self.bin_width, other.bin_width)
+                and np.allclose((self.origin - other.origin) / self.bin_width, np.rint((self.origin - other.origin) / self.bin_width)))
+
+    def merge(self, other):
+        """
+        Adds the counts and statistics of another histogram with the same bin width and aligned origin.
+        """
+        if not self.compatible(other):
+            raise ValueError('The histograms do not have the same bins (bin width and origin).')
+        shift = np.rint((other.origin - self.origin) / self.bin_width).astype(np.int64)
+        if other.counts.size:
+            low = other.offset + shift
+            high = low + np.array(other.counts.shape) - 1
+            if self.limits is None:
+                self._resize(low, high)
+                start = low - self.offset
+                self.counts[tuple(slice(s, s + n) for s, n in zip(start, other.counts.shape))] += other.counts
+            else:
+                # Only the bins inside the fixed range
+                grid = np.indices(other.counts.shape).reshape(self.dimensions, -1).T + low - self.offset
+                inside = ((grid >= 0) & (grid < np.array(self.counts.shape))).all(axis=1)
+                counts = other.counts.reshape(-1)
+                np.add.at(self.counts, tuple(grid[inside].T), counts[inside])
+                self.outside += int(counts[~inside].sum())
+        self.outside += other.outside
+        self.invalid += other.invalid
+        self.n += other.n
+        self.sum += other.sum
+        self.sum_squares += other.sum_squares
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+        return self
+
+    @property
+    def mean(self):
+        return self.sum / self.n if self.n else np.full(self.dimensions, np.nan)
+
+    @property
+    def std(self):
+        if not self.n:
+            return np.full(self.dimensions, np.nan)
+        return np.sqrt(np.maximum(self.sum_squares / self.n - self.mean ** 2, 0))
+
+    def edges(self, dimension=0, centered=False):
+        """
+        Bin edges of a dimension (pixels; relative to the mean position with centered=True).
+        """
+        edges = self.origin[dimension] + (self.offset[dimension] + np.arange(self.counts.shape[dimension] + 1)) * self.bin_width[dimension]
+        return edges - self.mean[dimension] if centered else edges
+
+    def probability(self):
+        total = self.counts.sum()
+        return self.counts / total if total else self.counts.astype(float)
+
+    def state(self, prefix=''):
+        """
+        Arrays of the histogram, for np.savez (names prefixed by prefix).
+        """
+        arrays = {'counts': self.counts, 'offset': self.offset, 'bin_width': self.bin_width, 'origin': self.origin,
+                  'limits': self.limits if self.limits is not None else np.empty(0),
+                  'totals': np.array([self.outside, self.invalid, self.n, self.max_bins]),
+                  'sum': self.sum, 'sum_squares': self.sum_squares, 'min': self.min, 'max': self.max}
+        return {prefix + name: value for name, value in arrays.items()}
+
+    @classmethod
+    def from_state(cls, arrays, prefix=''):
+        counts = arrays[prefix + 'counts']
+        limits = arrays[prefix + 'limits']
+        outside, invalid, n, max_bins = (int(value) for value in arrays[prefix + 'totals'])
+        histogram = cls(arrays[prefix + 'bin_width'], arrays[prefix + 'origin'], None, max_bins, counts.ndim)
+        histogram.limits = limits.reshape(counts.ndim, 2) if limits.size else None
+        histogram.counts = counts.astype(np.int64)
+        histogram.offset = arrays[prefix + 'offset'].astype(np.int64)
+        histogram.outside, histogram.invalid, histogram.n = outside, invalid, n
+        for name in ('sum', 'sum_squares', 'min', 'max'):
+            setattr(histogram, name, arrays[prefix + name].astype(float))
+        return histogram
+
+
+class PositionHistograms:
+    """
+    X, Y and XY histograms of positions (records with x and y), with the same bin width (pixels).
+    limits: None (expanding) or ((x low, x high), (y low, y high)).
+    """
+    NAMES = ('x', 'y', 'xy')
+
+    def __init__(self, bin_width=0.05, limits=None, max_bins=1 << 16, metadata=None):
+        limits = None if limits is None else np.asarray(limits, dtype=float).reshape(2, 2)
+        self.x = StreamingHistogram(bin_width, limits=None if limits is None else limits[0], max_bins=max_bins)
+        self.y = StreamingHistogram(bin_width, limits=None if limits is None else limits[1], max_bins=max_bins)
+        # The 2D grid is limited to max_bins bins in total
+        self.xy = StreamingHistogram(bin_width, limits=limits, max_bins=max_bins * 16, dimensions=2)
+        self.metadata = dict(metadata or {})
+
+    def add(self, records):
+        if len(records) == 0:
+            return
+        x = np.asarray(records['x'], dtype=float)
+        y = np.asarray(records['y'], dtype=float)
+        self.x.add(x)
+        self.y.add(y)
+        self.xy.add(np.stack((x, y), axis=1))
+
+    def merge(self, other):
+        for name in self.NAMES:
+            getattr(self, name).merge(getattr(other, name))
+        self.metadata['sources'] = self.metadata.get('sources', []) + other.metadata.get('sources', [])
+        return self
+
+    @property
+    def n(self):
+        return self.x.n
+
+    def reset(self):
+        """
+        Empties the histograms (e.g. after saving a segment).
+        """
+        for name in self.NAMES:
+            getattr(self, name).clear()
+
+    def save(self, path):
+        """
+        Writes the histograms to an .npz file. Returns the path.
+        """
+        arrays = {}
+        for name in self.NAMES:
+            arrays.update(getattr(self, name).state(name + '_'))
+        arrays['metadata'] = np.array(json.dumps(self.metadata))
+        with open(path, 'wb') as histogram_file:
+            np.savez_compressed(histogram_file, **arrays)
+        return path
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            histograms = cls.__new__(cls)
+            for name in cls.NAMES:
+                setattr(histograms, name, StreamingHistogram.from_state(arrays, name + '_'))
+            histograms.metadata = json.loads(str(arrays['metadata']))
+        return histograms
+
+    def export_csv(self, prefix, centered=False):
+        """
+        Writes [prefix]_x.csv and [prefix]_y.csv (bin from, bin to, count, probability) and [prefix]_xy.csv (counts,
+        y bins in rows, x bins in columns; the edges are in the first row and column). Returns the paths.
+        """
+        paths = []
+        for name in ('x', 'y'):
+            histogram = getattr(self, name)
+            edges = histogram.edges(0, centered)
+            path = f'{prefix}_{name}.csv'
+            np.savetxt(path, np.column_stack((edges[:-1], edges[1:], histogram.counts, histogram.probability())),
+                       delimiter=',', fmt=['%.6f', '%.6f', '%d', '%.8g'], header='from,to,count,probability', comments='')
+            paths.append(path)
+        x_edges, y_edges = self.xy.edges(0, centered), self.xy.edges(1, centered)
+        table = np.zeros((len(y_edges), len(x_edges)))
+        table[0, 1:] = x_edges[:-1]
+        table[1:, 0] = y_edges[:-1]
+        table[1:, 1:] = self.xy.counts.T
+        path = f'{prefix}_xy.csv'
+        np.savetxt(path, table, delimiter=',', fmt='%.6g')
+        paths.append(path)
+        return paths
+
+    def summary(self):
+        return {'positions': int(self.n), 'mean': [float(self.x.mean[0]), float(self.y.mean[0])],
+                'std': [float(self.x.std[0]), float(self.y.std[0])], 'bins': [self.x.counts.size, self.y.counts.size],
+                'outside': [self.x.outside, self.y.outside, self.xy.outside]}
+
+
+def file_histograms(path, bin_width, limits=None, object_id=None, t_from=None, t_to=None):
+    """
+    Histograms of the positions of the selected track of one file (for a process pool).
+    """
+    from evk_tracking.streams import TrackSelector, file_results
+    histograms = PositionHistograms(bin_width, limits, metadata={'sources': [path]})
+    selector = TrackSelector(object_id)
+    for _, records in file_results([path], ('t', 'x', 'y', 'object_id'), t_from, t_to):  # One run
+        histograms.add(selector.select(records))
+    return histograms
+
+
+def parse_args():
+    import argparse
+    from evk_tracking.streams import add_source_arguments
+    """
+    Parse command line arguments.
+    """
+    parser = argparse.ArgumentParser(description='Position histograms (X, Y and XY) of archived runs or of the tracker ring, or merge of saved histograms.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    add_source_arguments(parser)
+    histogram_options = parser.add_argument_group('Histogram options')
+    histogram_options.add_argument('--bin', dest='bin_width', type=float, default=0.05,
+                                   help='Bin width. Unit: pixels. Default: 0.05.')
+    histogram_options.add_argument('--limits', dest='limits', type=str, default='',
+                                   help='Fixed range xmin,xmax,ymin,ymax. Unit: pixels. Default: \'\' (range of the positions).')
+    histogram_options.add_argument('--merge', dest='merge', type=bool, default=False,
+                                   help='The paths are histogram files (.npz) to merge. Default: False.')
+    histogram_options.add_argument('-j', '--processes', dest='processes', type=int, default=1,
+                                   help='Number of processes computing the histograms of the files. Default: 1.')
+    histogram_options.add_argument('--report', dest='report', type=float, default=0,
+                                   help='With -rb, saves the histograms every [report] seconds. Unit: seconds. Default: 0 (at the end).')
+    histogram_options.add_argument('--centered', dest='centered', type=bool, default=False,
+                                   help='Bin edges of the CSV files relative to the mean position (X - mean(X)). Default: False.')
+    histogram_options.add_argument('-o', '--output', dest='output', type=str, default='',
+                                   help='Prefix of the output files: [prefix]_hist.npz, [prefix]_x.csv, [prefix]_y.csv and [prefix]_xy.csv. Default: \'\' (not saved).')
+    return parser.parse_args()
+
+
+def main():
+    """
+    Main
+    """
+    args = parse_args()
+    limits = [float(value) for value in args.limits.split(',')] if args.limits else None
+    if args.merge:
+        if not args.paths:
+            print('No histogram files to merge.')
+            exit(1)
+        histograms = PositionHistograms.load(args.paths[0])
+        for path in args.paths[1:]:
+            histograms.merge(PositionHistograms.load(path))
+    elif args.processes > 1 and not args.results_ring:
+        from concurrent.futures import ProcessPoolExecutor
+        from evk_tracking.streams import file_paths_from_args
+        paths = file_paths_from_args(args)
+        t_from = args.t_from * 1e6 if args.t_from is not None else None
+        t_to = args.t_to * 1e6 if args.t_to is not None else None
+        histograms = PositionHistograms(args.bin_width, limits)
+        with ProcessPoolExecutor(max_workers=args.processes) as executor:
+            for result in executor.map(file_histograms, paths, [args.bin_width] * len(paths), [limits] * len(paths),
+                                       [args.object_id] * len(paths), [t_from] * len(paths), [t_to] * len(paths)):
+                histograms.merge(result)
+    else:
+        from evk_tracking.streams import TrackSelector, results_from_args
+        histograms = PositionHistograms(args.bin_width, limits)
+        selector = TrackSelector(args.object_id)
+        last_report = time.monotonic()
+        try:
+            for new_run, records in results_from_args(args):
+                if new_run:
+                    selector.reset()
+                histograms.add(selector.select(records))
+                if args.report and args.output and time.monotonic() - last_report >= args.report:
+                    histograms.save(args.output + '_hist.npz')
+                    last_report = time.monotonic()
+        except KeyboardInterrupt:
+            pass
+    print(json.dumps(histograms.summary()))
+    if args.output:
+        paths = [histograms.save(args.output + '_hist.npz')] + histograms.export_csv(args.output, args.centered)
+        print('Saved at ' + ', '.join(paths))
+
+
+if __name__ == "__main__":
+        main()
@@ -0,0 +1,228 @@
+"""
+Asynchronous (asyncio) control of the instruments used by the Heat Engine cycle (DS335 and other VISA devices).
+
+- Each AsyncInstrument owns one connection (transport) and a command queue processed by a single worker task,
+  so the commands of one device are sent in order while different devices work in parallel.
+- The blocking transport calls (pyvisa) run in a thread dedicated to the device, so they never block the event
+  loop: instrument setup can overlap with the camera acquisition (see run_process()).
+- Every command has a response timeout (InstrumentTimeout), and can be logged with the host clock through an
+  evk_tracking.sync.CommandLog.
+- InstrumentManager reuses the connections: asking twice for the same resource returns the same instrument.
+- SimulatedDS335Transport emulates the DS335 (state, queries and serial line delays), so cycle sequencing can be
+  tested and timed without hardware.
+
+Example:
+    async with InstrumentManager(simulate=True) as manager:
+        ds335 = manager.ds335('ASRL/dev/ttyUSB2::INSTR')
+        await ds335.set_offset(2)
+"""
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class InstrumentError(Exception):
+    pass
+
+
+class InstrumentTimeout(InstrumentError):
+    pass
+
+
+class VisaTransport:
+    """
+    Blocking connection to a VISA resource (serial, GPIB, USB...) through pyvisa.
+    """
+    def __init__(self, resource_name, resource_manager=None, **resource_kwargs):
+        import pyvisa
+        self.resource_manager = resource_manager or pyvisa.ResourceManager()
+        self.resource = self.resource_manager.open_resource(resource_name, **resource_kwargs)
+
+    def write(self, cmd):
+        self.resource.write(cmd)
+
+    def query(self, cmd):
+        return self.resource.query(cmd).strip()
+
+    def close(self):
+        self.resource.close()
+
+
+class SimulatedDS335Transport:
+    """
+    DS335 function generator stand-in. Keeps the instrument state and answers the queries ('OFFS?'...).
+    Each command takes [command_delay] seconds plus the serial transfer time of its characters.
+    """
+    DEFAULTS = {'FUNC': '0', 'FREQ': '1000', 'AMPL': '1VP', 'OFFS': '0', 'PHSE': '0', 'KEYS': '0'}
+
+    def __init__(self, baud_rate=9600, command_delay=2e-3):
+        self.state = dict(self.DEFAULTS)
+        self.char_time = 10. / baud_rate  # start + 8 data + stop bits
+        self.command_delay = command_delay
+        self.history = []
+
+    def _transfer(self, cmd, response=''):
+        time.sleep(self.command_delay + (len(cmd) + len(response) + 2) * self.char_time)
+
+    def write(self, cmd):
+        self.history.append((time.monotonic(), cmd))
+        for single_cmd in cmd.split(';'):
+            name, _, value = single_cmd.strip().partition(' ')
+            if name.upper() == '*RST':
+                self.state = dict(self.DEFAULTS)
+            elif value:
+                self.state[name.upper()] = value.strip()
+        self._transfer(cmd)
+
+    def query(self, cmd):
+        self.history.append((time.monotonic(), cmd))
+        name = cmd.strip().rstrip('?').upper()
+        if name == '*IDN':
+            response = 'StanfordResearchSystems,DS335,00000,1.00 (simulated)'
+        elif name in self.state:
+            response = self.state[name]
+        else:
+            raise InstrumentError(f'Unknown query: {cmd}')
+        self._transfer(cmd, response)
+        return response
+
+    def close(self):
+        pass
+
+
+class AsyncInstrument:
+    """
+    Command queue and worker task of one instrument, see the top of this file.
+    """
+    def __init__(self, name, transport, timeout=2., command_log=None):
+        self.name = name
+        self.transport = transport
+        self.timeout = timeout
+        self.command_log = command_log
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=name)
+        self.queue = None
+        self.worker = None
+
+    def _ensure_worker(self):
+        if self.worker is None or self.worker.done():
+            self.queue = asyncio.Queue()
+            self.worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            cmd, expects_response, future = await self.queue.get()
+            if future.cancelled():
+                continue
+            call = self.transport.query if expects_response else self.transport.write
+            before = time.monotonic_ns()
+            try:
+                response = await asyncio.wait_for(loop.run_in_executor(self.executor, call, cmd), self.timeout)
+            except asyncio.TimeoutError:
+                if not future.done():
+                    future.set_exception(InstrumentTimeout(f'{self.name}: no response to {cmd!r} after {self.timeout}s'))
+                continue
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+                continue
+            if self.command_log is not None:
+                self.command_log.log(self.name, cmd, before, time.monotonic_ns(), response)
+            if not future.done():
+                future.set_result(response)
+
+    async def _submit(self, cmd, expects_response):
+        self._ensure_worker()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((cmd, expects_response, future))
+        return await future
+
+    async def send(self, cmd):
+        """
+        Sends a command without response.
+        """
+        return await self._submit(cmd, False)
+
+    async def query(self, cmd):
+        """
+        Sends a command and returns the response of the instrument.
+        """
+        return await self._submit(cmd, True)
+
+    async def close(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.transport.close)
+        self.executor.shutdown(wait=False)
+
+
+class AsyncDS335(AsyncInstrument):
+    """
+    DS335 function generator.
+    """
+    async def set_offset(self, volts):
+        await self.send(f'OFFS {volts}')
+
+    async def get_offset(self):
+        return float(await self.query('OFFS?'))
+
+    async def set_amplitude(self, volts, unit='VP'):
+        await self.send(f'AMPL {volts}{unit}')
+
+    async def set_frequency(self, hertz):
+        await self.send(f'FREQ {hertz}')
+
+    async def identify(self):
+        return await self.query('*IDN?')
+
+
+class InstrumentManager:
+    """
+    Opens the instruments once and reuses their connections. Use it as an async context manager.
+    """
+    DS335_SERIAL = {'baud_rate': 9600, 'read_termination': '\n', 'write_termination': '\n'}
+
+    def __init__(self, simulate=False, timeout=2., command_log=None):
+        self.simulate = simulate
+        self.timeout = timeout
+        self.command_log = command_log
+        self.instruments = {}
+        self.resource_manager = None
+
+    def ds335(self, resource_name, name='ds335'):
+        if resource_name not in self.instruments:
+            if self.simulate:
+                transport = SimulatedDS335Transport()
+            else:
+                if self.resource_manager is None:
+                    import pyvisa
+                    self.resource_manager = pyvisa.ResourceManager()
+                transport = VisaTransport(resource_name, self.resource_manager, **self.DS335_SERIAL)
+            self.instruments[resource_name] = AsyncDS335(name, transport, self.timeout, self.command_log)
+        return self.instruments[resource_name]
+
+    async def close(self):
+        for instrument in self.instruments.values():
+            await instrument.close()
+        self.instruments = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+
+async def run_process(command):
+    """
+    Runs a shell command (e.g. the tracking script) without blocking the event loop.
+    Returns its exit code.
+    """
+    process = await asyncio.create_subprocess_shell(command, stdout=asyncio.subprocess.PIPE)
+    await process.communicate()
+    return process.returncode
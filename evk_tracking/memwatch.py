@@ -0,0 +1,133 @@
+"""
+Memory watchdog and leak profiler for long acquisitions.
+
+MemoryWatchdog samples from a background thread, every [interval] seconds:
+- the RSS of the process and the memory available on the machine (psutil);
+- the Python heap traced by tracemalloc (current and peak), and every [top_every] samples the top allocators
+  (file:line), appended to [timeline]_top.txt;
+- the size of the registered buffer pools (e.g. the number of tracking results waiting to be saved).
+Each sample is a row of the [timeline] CSV file.
+
+When the available memory falls below warn_available (% of the total), or the RSS goes over rss_limit, a
+ResourceWarning is issued. Below flush_available, a flush is requested: the tracking script checks
+take_flush_request() from its own thread and saves the results it holds before memory gets dangerous.
+"""
+
+import csv
+import os
+import threading
+import time
+import tracemalloc
+import warnings
+import datetime
+
+import psutil
+
+
+class MemoryWatchdog:
+    def __init__(self, timeline_path, interval=1., top_every=10, top_n=10, warn_available=20., flush_available=10.,
+                 rss_limit=None, trace=True):
+        self.timeline_path = timeline_path
+        self.top_path = os.path.splitext(timeline_path)[0] + '_top.txt'
+        self.interval = interval
+        self.top_every = top_every
+        self.top_n = top_n
+        self.warn_available = warn_available
+        self.flush_available = flush_available
+        self.rss_limit = rss_limit
+        self.trace = trace
+        self.pools = {}
+        self.process = psutil.Process()
+        self.flush_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.warned = False
+        self.samples = 0
+
+    def register_pool(self, name, size_fn):
+        """
+        size_fn() returns the current size of the pool (rows, events, bytes...), it is sampled from the watchdog thread.
+        """
+        self.pools[name] = size_fn
+
+    def take_flush_request(self):
+        """
+        Returns True once per flush requested by the watchdog.
+        """
+        if self.flush_event.is_set():
+            self.flush_event.clear()
+            return True
+        return False
+
+    def start(self):
+        if self.trace and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.thread = threading.Thread(target=self._run, name='evk-memwatch', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.trace and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def _run(self):
+        with open(self.timeline_path, 'w') as timeline_file:
+            writer = csv.writer(timeline_file, delimiter=',', lineterminator='\n')
+            writer.writerow(['wall_time', 'monotonic', 'rss', 'available', 'available_percent', 'traced_current',
+                             'traced_peak'] + list(self.pools) + ['action'])
+            while not self.stop_event.wait(self.interval if self.samples else 0):
+                writer.writerow(self.sample())
+                timeline_file.flush()
+
+    def sample(self):
+        rss = self.process.memory_info().rss
+        virtual_memory = psutil.virtual_memory()
+        available_percent = virtual_memory.available * 100 / virtual_memory.total
+        traced_current, traced_peak = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else (0, 0)
+        pools = []
+        for size_fn in self.pools.values():
+            try:
+                pools.append(size_fn())
+            except Exception:
+                pools.append('')
+
+        action = ''
+        if available_percent < self.flush_available:
+            self.flush_event.set()
+            action = 'flush'
+        if available_percent < self.warn_available or (self.rss_limit and rss > self.rss_limit):
+            action = action or 'warn'
+            if not self.warned:
+                warnings.warn(f'Memory pressure: RSS {rss / 2**20:.0f} MiB, {available_percent:.1f}% of the memory available.',
+                              ResourceWarning)
+                self.warned = True
+        else:
+            self.warned = False
+
+        if tracemalloc.is_tracing() and self.top_every and self.samples % self.top_every == 0:
+            self.write_top()
+        self.samples += 1
+        return [datetime.datetime.now().strftime('%Y%m%d_%H-%M-%S.%f'), time.monotonic(), rss, virtual_memory.available,
+                round(available_percent, 2), traced_current, traced_peak] + pools + [action]
+
+    def write_top(self):
+        """
+        Appends the top allocators (by size) to the _top.txt file.
+        """
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+        with open(self.top_path, 'a') as top_file:
+            top_file.write(f"--- sample {self.samples}, {datetime.datetime.now().strftime('%Y%m%d_%H-%M-%S')}\n")
+            for stat in snapshot.statistics('lineno')[:self.top_n]:
+                top_file.write(f'{stat.size / 2**10:10.1f} KiB {stat.count:8d} blocks  {stat.traceback}\n')
@@ -0,0 +1,275 @@
+"""
+Bulk conversion of the CSV files of the trackers (EVK_[date]_[time].csv, columns of README section 7) into
+.evkt trajectory files (trajectory.py), so the archived runs are queried like the new ones instead of parsing
+their text again for every analysis.
+
+The files are converted by a pool of processes. Each process streams its CSV file in blocks of about
+[block_size] bytes (cut at a line end), parses a block at once with numpy, and writes the rows to the .evkt
+file as they come, so the memory used does not depend on the size of the files. The conversion is then checked:
+- the number of rows written, the number of lines of the CSV file and the rows of the .evkt index must agree;
+- the .evkt file is read back (with the crc32 of every block) and the SHA-256 of its rows must equal the one of
+  the rows parsed from the CSV file (the checksum registered in the catalog).
+The converted files are registered in the catalog (-cat) with kind evkt, the CSV file as source and the checksum.
+The CSV files are kept.
+
+    python3 -m evk_tracking.migrate /data/2022 /data/2023 -o /archive/evkt -j 8 -cat /archive/catalog.sqlite
+
+Files already converted (the .evkt file exists and is complete) are skipped, unless --overwrite True.
+"""
+
+import datetime
+import fnmatch
+import hashlib
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+
+from evk_tracking.trajectory import CHUNK_ROWS, TrajectoryWriter, TrajectoryReader, trajectory_dtype
+
+
+# Wall-clock time of the save, in the name of the files of the trackers
+NAME_TIMESTAMP = re.compile(r'(\d{8}_\d{2}-\d{2}-\d{2})')
+# Columns of the CSV files: 9, or 11 with -vel
+CSV_COLUMNS = {9: trajectory_dtype(velocity=False), 11: trajectory_dtype(velocity=True)}
+
+
+class ConversionError(Exception):
+    pass
+
+
+def _parse_block(block, path):
+    values = np.fromstring(block[:-1].replace(b'\n', b',').decode(), sep=',')
+    lines = block.count(b'\n')
+    if len(values) % lines or len(values) // lines not in CSV_COLUMNS:
+        raise ConversionError(f'{path}: {len(values)} values in {lines} lines, expected {" or ".join(map(str, CSV_COLUMNS))} columns per line.')
+    values = values.reshape(lines, -1)
+    dtype = CSV_COLUMNS[values.shape[1]]
+    records = np.empty(lines, dtype=dtype)
+    for column, name in enumerate(dtype.names):
+        records[name] = values[:, column]
+    return records
+
+
+def csv_blocks(path, block_size=1 << 23):
+    """
+    Yields the content of a CSV file in blocks of complete lines (bytes, each ending with a line end).
+    """
+    with open(path, 'rb') as csv_file:
+        rest = b''
+        while True:
+            data = csv_file.read(block_size)
+            if not data:
+                break
+            data = rest + data
+            end = data.rfind(b'\n') + 1
+            rest = data[end:]
+            if end:
+                yield data[:end]
+        if rest.strip():
+            yield rest + b'\n'  # Last line without line end
+
+
+def csv_records(path, block_size=1 << 23):
+    """
+    Yields the rows of a CSV file of the trackers as structured arrays (RESULT_DTYPE, with vx and vy for 11 columns).
+    """
+    for block in csv_blocks(path, block_size):
+        yield _parse_block(block.replace(b'\r', b''), path)
+
+
+def records_checksum(chunks):
+    """
+    SHA-256 of the bytes of the rows (structured arrays) of chunks, independent of how they are cut into chunks.
+    """
+    checksum = hashlib.sha256()
+    for records in chunks:
+        checksum.update(np.ascontiguousarray(records).tobytes())
+    return checksum.hexdigest()
+
+
+def output_path_for(csv_path, input_root=None, output_dir=''):
+    """
+    .evkt path of a CSV file: next to it, or in output_dir with the same path relative to input_root.
+    """
+    name = os.path.splitext(csv_path)[0] + '.evkt'
+    if not output_dir:
+        return name
+    relative = os.path.relpath(name, input_root) if input_root else os.path.basename(name)
+    return os.path.join(output_dir, relative)
+
+
+def is_converted(output_path):
+    try:
+        TrajectoryReader(output_path)
+        return True
+    except (OSError, ValueError, EOFError):
+        return False
+
+
+def convert_csv(csv_path, output_path, chunk_rows=CHUNK_ROWS, level=1, block_size=1 << 23):
+    """
+    Converts a CSV file into an .evkt file and checks it (see the top of this file).
+    Returns the catalog fields of the .evkt file: path, t_first, t_last, rows, source, checksum and the sizes.
+    Raises ConversionError if the check fails.
+    """
+    start = time.monotonic()
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    match = NAME_TIMESTAMP.search(os.path.basename(csv_path))
+    metadata = {'source': os.path.abspath(csv_path), 'recorded': match.group(1) if match else ''}
+    checksum = hashlib.sha256()
+    lines = 0
+    writer = None
+    try:
+        for block in csv_blocks(csv_path, block_size):
+            block = block.replace(b'\r', b'')
+            records = _parse_block(block, csv_path)
+            if writer is None:
+                writer = TrajectoryWriter(output_path, records.dtype, metadata, chunk_rows, level)
+            elif records.dtype != writer.dtype:
+                raise ConversionError(f'{csv_path}: the number of columns changes after line {lines}.')
+            lines += block.count(b'\n')
+            checksum.update(records.tobytes())
+            writer.write(records)
+        if writer is None:  # Empty file
+            writer = TrajectoryWriter(output_path, trajectory_dtype(), metadata, chunk_rows, level)
+        rows = writer.close()
+    except Exception:
+        if writer is not None and not writer.file.closed:
+            writer.file.close()
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        raise
+
+    # Read back what was written
+    with TrajectoryReader(output_path) as reader:
+        written = records_checksum(reader.query())
+        if not (rows == lines == reader.rows == int(reader.index['rows'].sum())):
+            raise ConversionError(f'{csv_path}: {lines} lines, {rows} rows written, {reader.rows} rows in {output_path}.')
+        if written != checksum.hexdigest():
+            raise ConversionError(f'{csv_path}: the rows read from {output_path} differ from the CSV file (checksum).')
+        t_first, t_last = reader.t_first, reader.t_last
+    return {'path': output_path, 't_first': t_first, 't_last': t_last, 'rows': rows, 'source': os.path.abspath(csv_path),
+            'checksum': 'sha256:' + written, 'recorded': metadata['recorded'], 'csv_bytes': os.path.getsize(csv_path),
+            'evkt_bytes': os.path.getsize(output_path), 'seconds': time.monotonic() - start}
+
+
+def find_csv_files(inputs, pattern='EVK_*.csv', recursive=False):
+    """
+    (CSV file, input directory) of the files and directories of inputs; the files of the directories are those
+    whose name matches pattern, without the high-rate files (_hr.csv).
+    """
+    files = []
+    for path in inputs:
+        if os.path.isfile(path):
+            files.append((path, None))
+            continue
+        for directory, subdirectories, names in os.walk(path):
+            if not recursive:
+                subdirectories[:] = []
+            for name in sorted(names):
+                if fnmatch.fnmatch(name, pattern) and not name.endswith('_hr.csv'):
+                    files.append((os.path.join(directory, name), path))
+    return files
+
+
+def migrate(inputs, output_dir='', processes=None, catalog_path='', pattern='EVK_*.csv', recursive=False,
+            overwrite=False, chunk_rows=CHUNK_ROWS, level=1):
+    """
+    Converts the CSV files of inputs (files or directories) with a pool of processes, and registers the .evkt files
+    in the catalog. Yields (CSV file, catalog fields or None if skipped, error message or None) as files finish.
+    """
+    jobs = []
+    for csv_path, input_root in find_csv_files(inputs, pattern, recursive):
+        output_path = output_path_for(csv_path, input_root, output_dir)
+        if not overwrite and is_converted(output_path):
+            yield csv_path, None, None
+            continue
+        jobs.append((csv_path, output_path))
+    if not jobs:
+        return
+
+    catalog = None
+    if catalog_path:
+        from evk_tracking.catalog import RunCatalog
+        catalog = RunCatalog(catalog_path)
+    try:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = {executor.submit(convert_csv, csv_path, output_path, chunk_rows, level): csv_path
+                       for csv_path, output_path in jobs}
+            for future in as_completed(futures):
+                csv_path = futures[future]
+                try:
+                    fields = future.result()
+                except (ConversionError, OSError, ValueError) as e:
+                    yield csv_path, None, str(e)
+                    continue
+                if catalog is not None and fields['rows']:
+                    segment = dict(fields)
+                    catalog.register(segment.pop('path'), segment.pop('t_first'), segment.pop('t_last'),
+                                     segment.pop('rows'), kind='evkt', recorded=segment.pop('recorded'),
+                                     source=segment.pop('source'), checksum=segment.pop('checksum'))
+                yield csv_path, fields, None
+    finally:
+        if catalog is not None:
+            catalog.close()
+
+
+def parse_args():
+    import argparse
+    """
+    Parse command line arguments.
+    """
+    parser = argparse.ArgumentParser(description='Converts the CSV files of the trackers into .evkt trajectory files, in parallel, and registers them in the catalog.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('inputs', nargs='+', help='CSV files, or directories of CSV files.')
+    parser.add_argument('-o', '--output-dir', dest='output_dir', type=str, default='',
+                        help='Directory of the .evkt files, with the same layout as the input directories. Default: next to the CSV files.')
+    parser.add_argument('-j', '--processes', dest='processes', type=int, default=os.cpu_count(),
+                        help='Number of conversion processes. Default: number of CPUs.')
+    parser.add_argument('-cat', '--catalog', dest='catalog', type=str, default='',
+                        help='Path of the SQLite catalog where the .evkt files are registered (see catalog.py). Default: \'\'.')
+    parser.add_argument('--pattern', dest='pattern', type=str, default='EVK_*.csv',
+                        help='Names of the CSV files of the directories. Default: EVK_*.csv.')
+    parser.add_argument('-r', '--recursive', dest='recursive', type=bool, default=False,
+                        help='Also converts the files of the subdirectories. Default: False.')
+    parser.add_argument('--overwrite', dest='overwrite', type=bool, default=False,
+                        help='Converts again the files already converted. Default: False.')
+    parser.add_argument('--chunk-rows', dest='chunk_rows', type=int, default=CHUNK_ROWS,
+                        help='Rows per chunk of the .evkt files. Default: 4096.')
+    parser.add_argument('-l', '--level', dest='level', type=int, default=1, help='zlib compression level. Default: 1.')
+    return parser.parse_args()
+
+
+def main():
+    """
+    Main
+    """
+    args = parse_args()
+    start = time.monotonic()
+    converted = skipped = csv_bytes = evkt_bytes = 0
+    errors = []
+    for csv_path, fields, error in migrate(args.inputs, args.output_dir, args.processes, args.catalog, args.pattern,
+                                           args.recursive, args.overwrite, args.chunk_rows, args.level):
+        if error is not None:
+            errors.append(error)
+            print('Error: ' + error)
+        elif fields is None:
+            skipped += 1
+        else:
+            converted += 1
+            csv_bytes += fields['csv_bytes']
+            evkt_bytes += fields['evkt_bytes']
+            print(f"{fields['path']}: {fields['rows']} rows, {fields['csv_bytes'] / max(fields['evkt_bytes'], 1):.1f}x smaller, "
+                  f"{fields['seconds']:.2f}s")
+    duration = time.monotonic() - start
+    print(f'{converted} files converted ({csv_bytes / 1e6:.1f}MB of CSV into {evkt_bytes / 1e6:.1f}MB, '
+          f'{csv_bytes / 1e6 / max(duration, 1e-9):.1f}MB/s), {skipped} already converted, {len(errors)} errors, '
+          f'{datetime.timedelta(seconds=round(duration))}')
+    if errors:
+        exit(1)
+
+
+if __name__ == "__main__":
+        main()
@@ -0,0 +1,241 @@
+"""
+Multi-process version of the tracking pipeline of headless.py.
+The work done in a single thread by main() is split into three processes:
+- ingest: events decoding (EventsIterator), biases, activity noise filter and trail filter;
+- tracking: TrackingAlgorithm on the filtered events;
+- storage: accumulation of the tracking results and CSV saving.
+The processes are connected by shared-memory ring buffers (see ringbuffer.py) holding the
+filtered events and the tracking results, so no serialization happens between stages.
+
+Use it with python3 -m evk_tracking headless -mp True [other options].
+"""
+
+import datetime
+import os
+import queue
+import signal
+import time
+import types
+import multiprocessing as mp
+import numpy as np
+
+from evk_tracking.ringbuffer import MmapRingWriter, SharedRingBuffer
+from evk_tracking.common import EVENT_DTYPE
+
+
+# Layout of the tracking results, same columns as the CSV files (see README, section 7)
+RESULT_DTYPE = np.dtype([('x_floor', '<u2'), ('y_floor', '<u2'), ('t', '<i8'), ('x', '<f8'), ('y', '<f8'),
+                         ('width', '<f8'), ('height', '<f8'), ('object_id', '<u8'), ('event_id', '<u8')])
+
+
+def results_to_records(results):
+    """
+    Helper function to convert the output of tracking_results.numpy() into RESULT_DTYPE records.
+    The fields are matched by position, following the column order of the CSV files.
+    """
+    out = np.empty(len(results), dtype=RESULT_DTYPE)
+    for src, dst in zip(results.dtype.names, RESULT_DTYPE.names):
+        out[dst] = results[src]
+    return out
+
+
+def _ignore_sigint():
+    # Ctrl+C is handled by the parent process, which sets the stop event
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def ingest_process(inputs, event_ring_spec, geometry_queue, stop_event):
+    """
+    Reads the events from the camera or RAW file, applies the biases and filters them.
+    """
+    _ignore_sigint()
+    from metavision_core.event_io import LiveReplayEventsIterator, is_live_camera
+    from evk_tracking.rawindex import open_events
+    from evk_tracking.eventfile import EventFileWriter, tracker_metadata
+    from evk_tracking.filters import EventFilters
+    from evk_tracking.common import get_biases_from_file
+
+    event_ring = SharedRingBuffer.attach(event_ring_spec)
+    event_tee = None
+    try:
+        mv_iterator = open_events(input_path=inputs.input_path, start_ts=inputs.process_from,
+                                  max_duration=inputs.process_to - inputs.process_from if inputs.process_to else None,
+                                  delta_t=1e2)
+
+        live = is_live_camera(inputs.input_path)
+        if live:
+            device = mv_iterator.reader.device
+            if os.path.isfile(inputs.bias_file):
+                b = get_biases_from_file(inputs.bias_file)
+
+                i_ll_biases = device.get_i_ll_biases()
+                for bias_name, bias_value in b.items():
+                    print(f'Applying {bias_name} = {bias_value}')
+                    i_ll_biases.set(bias_name, bias_value)
+        elif inputs.replay_factor > 0:
+            mv_iterator = LiveReplayEventsIterator(mv_iterator, replay_factor=inputs.replay_factor)
+
+        sensor_height, sensor_width = mv_iterator.get_size()
+        geometry_queue.put((sensor_width, sensor_height))
+
+        event_filters = EventFilters(sensor_width, sensor_height, inputs.activity_time_ths, inputs.activity_ths,
+                                     inputs.activity_trail_ths, backend=inputs.filter_backend)
+        if inputs.event_tee:
+            event_tee = EventFileWriter(inputs.event_tee, sensor_width, sensor_height, metadata=tracker_metadata(inputs))
+
+        for evs in mv_iterator:
+            if stop_event.is_set():
+                break
+            if event_tee is not None:
+                event_tee.write(evs)
+            filtered_evs = event_filters.process_events(evs)
+            # A live camera cannot wait for the tracker, a RAW file can
+            event_ring.push(filtered_evs, block=not live, stop_event=stop_event)
+
+        if event_ring.dropped:
+            print(f'Ingest: {event_ring.dropped} events dropped because the tracking process was too slow.')
+    finally:
+        if event_tee is not None:
+            dropped = event_tee.close()
+            print("Events saved at " + inputs.event_tee + (f' ({dropped} events dropped)' if dropped else ''))
+        event_ring.close_writer()
+        event_ring.release()
+
+
+def tracking_process(inputs, geometry, event_ring_spec, result_ring_spec, stop_event):
+    """
+    Runs the tracking algorithm on the filtered events and publishes the results.
+    """
+    _ignore_sigint()
+    from metavision_sdk_analytics import TrackingAlgorithm, TrackingConfig
+
+    event_ring = SharedRingBuffer.attach(event_ring_spec)
+    result_ring = SharedRingBuffer.attach(result_ring_spec)
+    results_ring = None
+    try:
+        sensor_width, sensor_height = geometry
+        tracking_config = TrackingConfig()  # Default configuration
+        tracking_algo = TrackingAlgorithm(sensor_width=sensor_width, sensor_height=sensor_height, tracking_config=tracking_config)
+        tracking_algo.update_frequency = inputs.update_frequency
+        tracking_algo.min_size = inputs.min_size
+        tracking_algo.max_size = inputs.max_size
+
+        if inputs.results_ring:
+            results_ring = MmapRingWriter(inputs.results_ring, RESULT_DTYPE, inputs.results_ring_capacity)
+
+        def tracking_cb(ts, tracking_results):
+            results = tracking_results.numpy()
+            if len(results) > 0:
+                records = results_to_records(results)
+                if results_ring is not None:
+                    results_ring.publish(records)
+                result_ring.push(records, stop_event=stop_event)
+
+        tracking_algo.set_output_callback(tracking_cb)
+
+        while True:
+            evs = event_ring.wait_pop(stop_event=stop_event)
+            if evs is None:
+                break
+            tracking_algo.process_events(evs)
+    finally:
+        if results_ring is not None:
+            results_ring.close()
+        result_ring.close_writer()
+        event_ring.release()
+        result_ring.release()
+
+
+def storage_process(inputs, result_ring_spec, stop_event):
+    """
+    Accumulates the tracking results and saves them into CSV (or .evkt) files every [measurement_time].
+    """
+    from evk_tracking.trajectory import save_results
+    _ignore_sigint()
+    result_ring = SharedRingBuffer.attach(result_ring_spec)
+    catalog = None
+    if inputs.catalog:
+        from evk_tracking.catalog import RunCatalog, segment_fields
+        catalog = RunCatalog(inputs.catalog)
+        catalog_fields = segment_fields(inputs)
+    total_results = []
+    measurement_index = 0
+    try:
+        while measurement_index < inputs.no_runs:
+            results = result_ring.wait_pop(stop_event=stop_event)
+            if results is None:
+                break
+            if not inputs.save_flag:
+                continue
+            total_results.append(results)
+
+            current_time = results['t'][-1]
+            start_time = inputs.measurement_time*measurement_index
+            if current_time >= start_time + inputs.measurement_time:
+                # Save run
+                measurement_index += 1 # The first interval saved is interval 1
+                file_timestamp = str(datetime.datetime.now().strftime('%Y%m%d_%H-%M-%S'))
+                records = np.concatenate(total_results)
+                file_path = save_results(inputs.output_csv_path + file_timestamp, records, inputs.save_format)
+                if catalog is not None:
+                    catalog.register(file_path, records['t'][0], records['t'][-1], len(records), kind=inputs.save_format,
+                                     **catalog_fields)
+
+                print("Results saved at " + file_path)
+                total_results = []
+    finally:
+        # The tracker must not block on a full result ring once storage is done
+        stop_event.set()
+        if catalog is not None:
+            catalog.close()
+        result_ring.release()
+
+
+def run_multiprocess(inputs):
+    """
+    Starts the three processes of the pipeline and waits for them to finish.
+    """
+    ctx = mp.get_context('spawn')
+    inputs = types.SimpleNamespace(**vars(inputs))
+    event_ring = SharedRingBuffer(EVENT_DTYPE, inputs.mp_event_capacity)
+    result_ring = SharedRingBuffer(RESULT_DTYPE, inputs.mp_result_capacity)
+    stop_event = ctx.Event()
+    geometry_queue = ctx.Queue()
+
+    ingest = ctx.Process(target=ingest_process, name='evk-ingest',
+                         args=(inputs, event_ring.spec(), geometry_queue, stop_event))
+    ingest.start()
+    processes = [ingest]
+
+    print('--------------------------------------------------------------\n')
+    print('Multi-process mode: ingest, tracking and storage processes.\n'
+          'Press \'CTRL+c\' to leave the program.\n')
+    print('--------------------------------------------------------------\n')
+
+    try:
+        # The tracker needs the sensor geometry, which is only known once the camera/file is opened
+        geometry = None
+        while geometry is None:
+            try:
+                geometry = geometry_queue.get(timeout=0.5)
+            except queue.Empty:
+                if not ingest.is_alive():
+                    print('The ingest process stopped before opening the input.')
+                    return
+        processes.append(ctx.Process(target=tracking_process, name='evk-tracking',
+                                     args=(inputs, geometry, event_ring.spec(), result_ring.spec(), stop_event)))
+        processes.append(ctx.Process(target=storage_process, name='evk-storage',
+                                     args=(inputs, result_ring.spec(), stop_event)))
+        for p in processes[1:]:
+            p.start()
+
+        while any(p.is_alive() for p in processes):
+            time.sleep(0.1)
+    except KeyboardInterrupt:
+        print('Program closing...')
+        stop_event.set()
+    finally:
+        for p in processes:
+            p.join()
+        event_ring.release()
+        result_ring.release()
@@ -0,0 +1,226 @@
+"""
+Low-latency output of the tracked particle position, e.g. to drive an oscilloscope or a feedback loop.
+
+For every tracking update, the position of the dominant track (the object ID seen the most since the
+start) is packed into a fixed-size binary packet and handed to one or more sinks:
+- udp:[host]:[port]   UDP datagram;
+- unix:[path]         datagram on a local (AF_UNIX) socket;
+- dac                 DAC stand-in, converts x/y into output codes and passes them to a writer function.
+
+Packet layout (little-endian, 36 bytes, see PACKET_FORMAT):
+    magic b'EVKP' | uint32 sequence | int64 event timestamp (us) | uint64 host send time (time.monotonic_ns())
+    | float32 x (pixels) | float32 y (pixels) | uint32 object ID
+
+The latency from event timestamp to packet send is measured by LatencyMonitor. Camera timestamps are mapped
+to the host clock with the smallest observed delay between the last event of a batch and the arrival of that
+batch, so the reported latency is the time spent in the pipeline on top of the fastest event delivery seen.
+
+Use it with python3 -m evk_tracking osci -po udp:127.0.0.1:5005 [other options], and check the packets with
+python3 -m evk_tracking.position_output udp:127.0.0.1:5005.
+"""
+
+import socket
+import struct
+import time
+import numpy as np
+
+from evk_tracking.sync import ClockSync
+
+
+PACKET_MAGIC = b'EVKP'
+PACKET_FORMAT = '<4sIqQffI'
+PACKET_SIZE = struct.calcsize(PACKET_FORMAT)
+
+
+class PositionSink:
+    """
+    Base class of the position sinks. send() must not block.
+    """
+    def send(self, packet, t, x, y, object_id):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class UdpSink(PositionSink):
+    def __init__(self, host, port):
+        self.address = (host, int(port))
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+
+    def send(self, packet, t, x, y, object_id):
+        try:
+            self.sock.sendto(packet, self.address)
+        except (BlockingIOError, ConnectionRefusedError):
+            pass  # Nobody listening or socket buffer full: drop, never stall the tracker
+
+    def close(self):
+        self.sock.close()
+
+
+class UnixSocketSink(PositionSink):
+    def __init__(self, path):
+        self.path = path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+
+    def send(self, packet, t, x, y, object_id):
+        try:
+            self.sock.sendto(packet, self.path)
+        except (BlockingIOError, ConnectionRefusedError, FileNotFoundError):
+            pass
+
+    def close(self):
+        self.sock.close()
+
+
+class DacSink(PositionSink):
+    """
+    DAC stand-in: maps x and y linearly from [0, sensor size] pixels onto [0, 2**bits - 1] codes and
+    passes them to writer(code_x, code_y). Without a writer, the last codes are only kept in self.codes.
+    """
+    def __init__(self, sensor_width, sensor_height, bits=16, writer=None):
+        self.full_scale = (1 << bits) - 1
+        self.scale = (self.full_scale / max(sensor_width, 1), self.full_scale / max(sensor_height, 1))
+        self.writer = writer
+        self.codes = (0, 0)
+
+    def send(self, packet, t, x, y, object_id):
+        code_x = min(max(int(x * self.scale[0]), 0), self.full_scale)
+        code_y = min(max(int(y * self.scale[1]), 0), self.full_scale)
+        self.codes = (code_x, code_y)
+        if self.writer is not None:
+            self.writer(code_x, code_y)
+
+
+def make_sink(spec: str, sensor_width=640, sensor_height=480):
+    """
+    Helper function to create a sink from its command line description (see the top of this file).
+    """
+    kind, _, target = spec.partition(':')
+    if kind == 'udp':
+        host, _, port = target.rpartition(':')
+        return UdpSink(host or '127.0.0.1', port)
+    if kind == 'unix':
+        return UnixSocketSink(target)
+    if kind == 'dac':
+        return DacSink(sensor_width, sensor_height, bits=int(target) if target else 16)
+    raise ValueError(f'Unknown position output: {spec}')
+
+
+class LatencyMonitor:
+    """
+    Measures the latency from event timestamp to packet send, see the top of this file.
+    The last [capacity] samples are kept in a preallocated buffer.
+    """
+    def __init__(self, capacity=1 << 16):
+        self.clock = ClockSync()
+        self.samples = np.zeros(capacity, dtype=np.int64)
+        self.count = 0
+
+    def on_events(self, evs):
+        """
+        To be called as soon as a batch of events comes out of the events iterator.
+        """
+        self.clock.on_events(evs)
+
+    def on_send(self, t, send_ns):
+        event_ns = self.clock.to_host_ns(t)
+        if event_ns is None:
+            return
+        self.samples[self.count % len(self.samples)] = send_ns - event_ns
+        self.count += 1
+
+    def report(self):
+        """
+        Returns a one-line summary of the latency, in us.
+        """
+        n = min(self.count, len(self.samples))
+        if n == 0:
+            return 'Latency: no packet sent.'
+        us = self.samples[:n] / 1e3
+        return ('Latency over the last {} packets (us): mean {:.1f}, median {:.1f}, 99th percentile {:.1f}, max {:.1f}'
+                .format(n, us.mean(), np.median(us), np.percentile(us, 99), us.max()))
+
+
+class PositionOutput:
+    """
+    Picks the dominant track out of each tracking update and sends its position to all the sinks.
+    """
+    def __init__(self, sinks, latency=None):
+        self.sinks = sinks
+        self.latency = latency if latency is not None else LatencyMonitor()
+        self.id_counts = {}
+        self.seq = 0
+
+    def on_results(self, results):
+        """
+        results: output of tracking_results.numpy(), columns as in the CSV files (see README, section 7).
+        """
+        if len(results) == 0:
+            return
+        names = results.dtype.names
+        ids = results[names[7]]
+        for object_id in ids.tolist():
+            self.id_counts[object_id] = self.id_counts.get(object_id, 0) + 1
+        row = results[max(range(len(ids)), key=lambda i: self.id_counts[int(ids[i])])]
+        t, x, y, object_id = int(row[names[2]]), float(row[names[3]]), float(row[names[4]]), int(row[names[7]])
+
+        send_ns = time.monotonic_ns()
+        packet = struct.pack(PACKET_FORMAT, PACKET_MAGIC, self.seq & 0xFFFFFFFF, t, send_ns, x, y, object_id & 0xFFFFFFFF)
+        for sink in self.sinks:
+            sink.send(packet, t, x, y, object_id)
+        self.latency.on_send(t, send_ns)
+        self.seq += 1
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+def parse_args():
+    import argparse
+    """
+    Parse command line arguments.
+    """
+    parser = argparse.ArgumentParser(description='Receive and print the position packets sent by the tracking scripts.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('address', help='udp:[host]:[port] or unix:[path], as given to the tracking script with -po.')
+    return parser.parse_args()
+
+
+def main():
+    """
+    Main
+    """
+    args = parse_args()
+    kind, _, target = args.address.partition(':')
+    if kind == 'udp':
+        host, _, port = target.rpartition(':')
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((host or '0.0.0.0', int(port)))
+    elif kind == 'unix':
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(target)
+    else:
+        print(f'Unknown address: {args.address}')
+        exit(1)
+
+    try:
+        while True:
+            packet = sock.recv(PACKET_SIZE)
+            magic, seq, t, send_ns, x, y, object_id = struct.unpack(PACKET_FORMAT, packet)
+            if magic != PACKET_MAGIC:
+                continue
+            # Only meaningful when sender and receiver run on the same host
+            transit_us = (time.monotonic_ns() - send_ns) / 1e3
+            print(f'{seq} t={t} x={x:.2f} y={y:.2f} id={object_id} transit={transit_us:.1f}us')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+
+
+if __name__ == "__main__":
+        main()
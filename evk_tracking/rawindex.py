@@ -0,0 +1,267 @@
+"""
+Time index of RAW files, to process a time range (-pf/-pt) without decoding the file from its start.
+
+The index gives the byte offset of the first TIME_HIGH word of every [step] us of the recording. It is built
+once by scanning the TIME_HIGH words of the file (no event decoding, the file is read once with numpy) and
+cached next to it in [file].evkidx.npz; it is rebuilt when the RAW file changes (size or modification time).
+
+open_events() is the drop-in replacement of EventsIterator(input_path, start_ts, max_duration, delta_t) used
+by the tracking scripts. For a RAW file and a time range that does not start at 0, the bytes of the range
+(from one index step before its start) are copied after the header of the RAW file into a temporary RAW
+file, which is decoded by the SDK. The time of the events is moved back to the time base of the whole file,
+so the timestamps are the same as with EventsIterator(start_ts=...). The time spent is proportional to the
+range, not to the position of the range in the file.
+
+Supported formats: EVT 2.0 and EVT 3.0. Other formats, live cameras and ranges starting at 0 go straight
+to EventsIterator. The .evk event files of eventfile.py have their own chunk index.
+
+The index can be built ahead of the analyses:
+    python3 -m evk_tracking.rawindex recording1.raw recording2.raw --step 10
+"""
+
+import os
+import tempfile
+import time
+import numpy as np
+
+
+DEFAULT_STEP = 10000  # us
+INDEX_VERSION = 1
+
+# format: (word dtype, TIME_HIGH type, shift of the type, TIME_HIGH bits, shift of TIME_HIGH in the timestamp)
+FORMATS = {
+    'EVT2': (np.dtype('<u4'), 0x8, 28, 28, 6),
+    'EVT3': (np.dtype('<u2'), 0x8, 12, 12, 12),
+}
+
+
+def read_raw_header(path: str):
+    """
+    Returns (header bytes, format) of a RAW file. The header is made of the lines starting with '%'.
+    """
+    header = b''
+    raw_format = ''
+    with open(path, 'rb') as raw_file:
+        while True:
+            position = raw_file.tell()
+            line = raw_file.readline()
+            if not line.startswith(b'%'):
+                raw_file.seek(position)
+                break
+            header += line
+            key, _, value = line[1:].decode('ascii', 'replace').strip().partition(' ')
+            if key == 'format':  # % format EVT3;height=720;width=1280
+                raw_format = value.split(';')[0].strip().upper()
+            elif key == 'evt' and not raw_format:  # % evt 3.0
+                raw_format = 'EVT' + value.strip().replace('.0', '')
+            if line.strip() == b'% end':
+                break
+    return header, raw_format
+
+
+class RawIndex:
+    """
+    t: time (us) of the indexed TIME_HIGH words, in the time base of the file; offset: their byte offset.
+    t_base: time of the first TIME_HIGH word, subtracted by the SDK to the timestamps (time shifting).
+    """
+    def __init__(self, path, step, raw_format, header_size, t, offset, t_base):
+        self.path = path
+        self.step = step
+        self.format = raw_format
+        self.header_size = header_size
+        self.t = t
+        self.offset = offset
+        self.t_base = t_base
+
+    @staticmethod
+    def index_path(path):
+        return path + '.evkidx.npz'
+
+    @classmethod
+    def build(cls, path, step=DEFAULT_STEP, chunk_words=1 << 24):
+        header, raw_format = read_raw_header(path)
+        if raw_format not in FORMATS:
+            raise ValueError(f'No time index for the {raw_format or "unknown"} format of {path}.')
+        dtype, th_type, type_shift, th_bits, th_shift = FORMATS[raw_format]
+        th_mask = (1 << th_bits) - 1
+        n_words = (os.path.getsize(path) - len(header)) // dtype.itemsize
+        words = np.memmap(path, dtype=dtype, mode='r', offset=len(header), shape=(n_words,))
+        half_range = 1 << (th_bits - 1)
+
+        t_list, offset_list = [], []
+        last_th, loops, last_bin, t_base = None, 0, None, None
+        for start in range(0, n_words, chunk_words):
+            chunk = np.asarray(words[start:start + chunk_words])
+            positions = np.flatnonzero((chunk >> type_shift) == th_type)
+            if len(positions) == 0:
+                continue
+            th = (chunk[positions] & th_mask).astype(np.int64)
+            # The TIME_HIGH counter loops: a large decrease is a new loop
+            previous = np.concatenate(([th[0] if last_th is None else last_th], th[:-1]))
+            th_loops = loops + np.cumsum(previous - th > half_range)
+            loops, last_th = int(th_loops[-1]), int(th[-1])
+            t = ((th_loops << th_bits) + th) << th_shift
+            if t_base is None:
+                t_base = int(t[0])
+            bins = (t - t_base) // step
+            keep = np.concatenate(([last_bin is None or bins[0] != last_bin], bins[1:] != bins[:-1]))
+            last_bin = int(bins[-1])
+            t_list.append(t[keep])
+            offset_list.append(len(header) + (start + positions[keep]) * dtype.itemsize)
+        del words
+
+        if t_base is None:
+            raise ValueError(f'No TIME_HIGH word found in {path}.')
+        return cls(path, step, raw_format, len(header), np.concatenate(t_list), np.concatenate(offset_list), t_base)
+
+    def save(self):
+        stat = os.stat(self.path)
+        np.savez(self.index_path(self.path), t=self.t, offset=self.offset,
+                 meta=np.array([INDEX_VERSION, self.step, self.header_size, self.t_base, stat.st_size, stat.st_mtime_ns]),
+                 format=np.array(self.format))
+
+    @classmethod
+    def load(cls, path, step=DEFAULT_STEP):
+        """
+        Returns the cached index of a RAW file, or builds and caches it if it is missing or out of date.
+        """
+        index_path = cls.index_path(path)
+        if os.path.isfile(index_path):
+            stat = os.stat(path)
+            with np.load(index_path) as cached:
+                version, cached_step, header_size, t_base, size, mtime_ns = cached['meta'].tolist()
+                if version == INDEX_VERSION and cached_step <= step and size == stat.st_size and mtime_ns == stat.st_mtime_ns:
+                    return cls(path, cached_step, str(cached['format']), header_size, cached['t'], cached['offset'], t_base)
+        index = cls.build(path, step)
+        try:
+            index.save()
+        except OSError as e:  # e.g. read-only folder, the index is just not cached
+            print(f'The time index of {path} could not be saved: {e}')
+        return index
+
+    def byte_range(self, start_ts, end_ts=None):
+        """
+        Byte range of the data holding the events of [start_ts, end_ts) (us, shifted time base as the SDK).
+        Returns (first byte, last byte or None for the end of the file, absolute time of the first byte).
+        """
+        i = max(np.searchsorted(self.t, start_ts + self.t_base, side='right') - 2, 0)
+        last = None
+        if end_ts is not None:
+            j = np.searchsorted(self.t, end_ts + self.t_base + self.step, side='left')
+            if j < len(self.t):
+                last = int(self.offset[j])
+        return int(self.offset[i]), last, int(self.t[i])
+
+
+class IndexedRawIterator:
+    """
+    Iterator of the events of a time range of a RAW file, through a temporary RAW file (see the top of this file).
+    The other attributes (get_size(), reader, delta_t...) are the ones of the EventsIterator of the temporary file.
+    """
+    def __init__(self, input_path, start_ts, max_duration=None, delta_t=10000, index=None, tmp_dir=None, **kwargs):
+        from metavision_core.event_io import EventsIterator
+        self.index = index or RawIndex.load(input_path)
+        self.start_ts = start_ts
+        self.end_ts = start_ts + max_duration if max_duration else None
+
+        header, _ = read_raw_header(input_path)
+        first, last, t_first = self.index.byte_range(start_ts, self.end_ts)
+        fd, self.tmp_path = tempfile.mkstemp(suffix='.raw', prefix='evk_range_', dir=tmp_dir)
+        with os.fdopen(fd, 'wb') as tmp_file, open(input_path, 'rb') as raw_file:
+            tmp_file.write(header)
+            raw_file.seek(first)
+            remaining = None if last is None else last - first
+            while remaining is None or remaining > 0:
+                block = raw_file.read(1 << 24 if remaining is None else min(1 << 24, remaining))
+                if not block:
+                    break
+                tmp_file.write(block)
+                if remaining is not None:
+                    remaining -= len(block)
+
+        # The decoder of the temporary file starts the TIME_HIGH loops at 0: the loops before it are added back
+        _, _, _, th_bits, th_shift = FORMATS[self.index.format]
+        period = 1 << (th_bits + th_shift)
+        self.t_shift = t_first - t_first % period - self.index.t_base
+        self.events_iterator = EventsIterator(input_path=self.tmp_path, delta_t=delta_t, do_time_shifting=False, **kwargs)
+
+    def __getattr__(self, name):
+        if 'events_iterator' not in self.__dict__:
+            raise AttributeError(name)
+        return getattr(self.events_iterator, name)
+
+    def get_size(self):
+        return self.events_iterator.get_size()
+
+    def __iter__(self):
+        try:
+            for evs in self.events_iterator:
+                if len(evs) == 0:
+                    continue
+                evs = evs.copy()
+                evs['t'] += self.t_shift
+                if evs['t'][-1] < self.start_ts:
+                    continue
+                if self.end_ts is not None and evs['t'][0] >= self.end_ts:
+                    break
+                if evs['t'][0] < self.start_ts or (self.end_ts is not None and evs['t'][-1] >= self.end_ts):
+                    evs = evs[(evs['t'] >= self.start_ts) & ((evs['t'] < self.end_ts) if self.end_ts is not None else True)]
+                yield evs
+        finally:
+            self.close()
+
+    def close(self):
+        if os.path.isfile(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+def open_events(input_path, start_ts=0, max_duration=None, delta_t=10000, step=DEFAULT_STEP, **kwargs):
+    """
+    EventsIterator(input_path, start_ts, max_duration, delta_t), through the time index when it saves decoding.
+    The .evk event files recorded by the trackers (eventfile.py) are read by EventFileIterator.
+    """
+    if input_path.lower().endswith('.evk'):
+        from evk_tracking.eventfile import EventFileIterator
+        return EventFileIterator(input_path, start_ts, max_duration, delta_t)
+    from metavision_core.event_io import EventsIterator
+    if start_ts > 0 and input_path.lower().endswith('.raw') and os.path.isfile(input_path):
+        try:
+            return IndexedRawIterator(input_path, start_ts, max_duration, delta_t,
+                                      index=RawIndex.load(input_path, step), **kwargs)
+        except ValueError as e:
+            print(str(e) + ' The file is decoded from its start.')
+    return EventsIterator(input_path=input_path, start_ts=start_ts, max_duration=max_duration, delta_t=delta_t, **kwargs)
+
+
+def parse_args():
+    import argparse
+    """
+    Parse command line arguments.
+    """
+    parser = argparse.ArgumentParser(description='Builds the time index of RAW files.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('raw_file_paths', nargs='+', help='Paths to the RAW files.')
+    parser.add_argument('-s', '--step', dest='step', type=float, default=DEFAULT_STEP / 1000,
+                        help='Time between two entries of the index. Unit: ms. Default: 10ms.')
+    return parser.parse_args()
+
+
+def main():
+    """
+    Main
+    """
+    args = parse_args()
+    for path in args.raw_file_paths:
+        start = time.monotonic()
+        try:
+            index = RawIndex.build(path, int(args.step * 1000))
+        except ValueError as e:
+            print(e)
+            continue
+        index.save()
+        print(f'{path}: {index.format}, {len(index.t)} entries over {(index.t[-1] - index.t_base) * 1e-6:.1f}s, '
+              f'built in {time.monotonic() - start:.2f}s')
+
+
+if __name__ == "__main__":
+        main()
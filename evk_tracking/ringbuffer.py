@@ -0,0 +1,358 @@
+"""
+Ring buffers of numpy structured records.
+
+SharedRingBuffer connects the processes of the multi-process tracking pipeline (pipeline.py).
+
+Each ring holds numpy structured records (events or tracking results) and is meant to be used by
+exactly one writer process and one reader process. The counters live in a small header at the start
+of the shared memory block, so no locks are needed:
+- the writer only ever increments the write counter, after the records have been copied in;
+- the reader only ever increments the read counter, after the records have been copied out.
+
+MmapRingWriter/MmapRingReader publish the tracking results into a memory-mapped file (by default in
+/dev/shm) that any number of external processes (plotting, feedback control, PSD monitors...) can
+attach to. The writer never waits for the readers: a reader that falls more than [capacity] records
+behind loses the oldest records. Layout of the file (little-endian):
+
+    offset  size  content
+    0       8     magic, b'EVKRING1'
+    8       4     uint32, layout version (1)
+    12      4     uint32, header size in bytes (512)
+    16      8     uint64, capacity (number of records)
+    24      8     uint64, record size in bytes
+    32      8     uint64, write sequence: total number of records published so far
+    40      8     uint64, writer heartbeat: time.monotonic_ns() of the last publish
+    48      8     uint64, claimed sequence: write sequence + number of records being written
+    56      8     reserved
+    64      448   JSON description of the record dtype (numpy dtype.descr), null padded
+    512     ...   records, record i of the stream is at slot i % capacity
+
+With the tracking results (evk_tracking.pipeline.RESULT_DTYPE) a record has the same 9 columns as the CSV files.
+A record is valid once the write sequence is larger than its index. The writer raises the claimed sequence
+before overwriting slots and the write sequence once done; a reader copies the new slots and then checks the
+claimed sequence: records whose slots may have been overwritten in the meantime are discarded.
+"""
+
+import json
+import mmap
+import os
+import time
+import numpy as np
+from multiprocessing import shared_memory
+
+
+HEADER_SIZE = 64  # bytes, keeps the record area cache-line aligned
+_WRITE_IDX = 0
+_READ_IDX = 1
+_CLOSED = 2
+
+
+def _open_shared_memory(name, create, size=0):
+    """
+    Helper function to open a shared memory block without registering attached blocks to the
+    resource tracker (only the creator is responsible for unlinking it).
+    """
+    if create:
+        return shared_memory.SharedMemory(name=name, create=True, size=size)
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # Python < 3.13
+        return shared_memory.SharedMemory(name=name)
+
+
+class SharedRingBuffer:
+    """
+    Single-producer / single-consumer ring buffer of structured numpy records in shared memory.
+    Create it in the parent process and pass spec() to the child processes, which call attach().
+    """
+    def __init__(self, dtype, capacity, name=None, create=True):
+        self.dtype = np.dtype(dtype)
+        self.capacity = int(capacity)
+        size = HEADER_SIZE + self.capacity * self.dtype.itemsize
+        self.shm = _open_shared_memory(name, create, size)
+        self.name = self.shm.name
+        self.owner = create
+        self.header = np.ndarray((HEADER_SIZE // 8,), dtype=np.int64, buffer=self.shm.buf)
+        self.records = np.ndarray((self.capacity,), dtype=self.dtype, buffer=self.shm.buf, offset=HEADER_SIZE)
+        if create:
+            self.header[:] = 0
+        self.dropped = 0
+
+    def spec(self):
+        """
+        Picklable description of the ring, used to attach to it from another process.
+        """
+        return {'name': self.name, 'dtype': self.dtype.descr, 'capacity': self.capacity}
+
+    @classmethod
+    def attach(cls, spec):
+        return cls(spec['dtype'], spec['capacity'], name=spec['name'], create=False)
+
+    def __len__(self):
+        return int(self.header[_WRITE_IDX] - self.header[_READ_IDX])
+
+    @property
+    def closed(self):
+        return bool(self.header[_CLOSED])
+
+    def close_writer(self):
+        """
+        Marks the end of the stream. The reader drains the remaining records and then stops.
+        """
+        self.header[_CLOSED] = 1
+
+    def push(self, arr, block=True, stop_event=None):
+        """
+        Copies the records of arr into the ring. If the ring is full, waits for the reader when
+        block is True, otherwise drops the records that do not fit (counted in self.dropped).
+        Returns the number of records written.
+        """
+        n = len(arr)
+        if n == 0:
+            return 0
+        if n > self.capacity:
+            raise ValueError(f'Cannot push {n} records into a ring of capacity {self.capacity}.')
+        write_idx = int(self.header[_WRITE_IDX])
+        while self.capacity - (write_idx - int(self.header[_READ_IDX])) < n:
+            if not block:
+                self.dropped += n
+                return 0
+            if stop_event is not None and stop_event.is_set():
+                return 0
+            time.sleep(1e-4)
+
+        start = write_idx % self.capacity
+        first = min(n, self.capacity - start)
+        self.records[start:start + first] = arr[:first]
+        if first < n:
+            self.records[:n - first] = arr[first:]
+        self.header[_WRITE_IDX] = write_idx + n
+        return n
+
+    def pop(self, max_items=None):
+        """
+        Returns a copy of the available records (at most max_items), or an empty array.
+        """
+        read_idx = int(self.header[_READ_IDX])
+        n = int(self.header[_WRITE_IDX]) - read_idx
+        if max_items is not None:
+            n = min(n, max_items)
+        if n <= 0:
+            return np.empty(0, dtype=self.dtype)
+
+        start = read_idx % self.capacity
+        first = min(n, self.capacity - start)
+        if first == n:
+            out = self.records[start:start + n].copy()
+        else:
+            out = np.empty(n, dtype=self.dtype)  # np.concatenate could drop the padding of the layout
+            out[:first] = self.records[start:]
+            out[first:] = self.records[:n - first]
+        self.header[_READ_IDX] = read_idx + n
+        return out
+
+    def wait_pop(self, max_items=None, stop_event=None, poll_interval=1e-4):
+        """
+        Blocking version of pop(). Returns None once the writer has closed the ring and it has been
+        drained, or when stop_event is set.
+        """
+        while True:
+            out = self.pop(max_items)
+            if len(out) > 0:
+                return out
+            if self.closed and len(self) == 0:
+                return None
+            if stop_event is not None and stop_event.is_set():
+                return None
+            time.sleep(poll_interval)
+
+    def release(self):
+        """
+        Detaches from the shared memory. The creator also frees it.
+        """
+        self.header = None
+        self.records = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+RING_MAGIC = b'EVKRING1'
+RING_VERSION = 1
+RING_HEADER_SIZE = 512
+_SEQ_OFFSET = 32  # write sequence, writer heartbeat, claimed sequence
+_DTYPE_OFFSET = 64
+
+
+class MmapRingWriter:
+    """
+    Single writer of a memory-mapped ring of records, see the layout at the top of this file.
+    """
+    def __init__(self, path, dtype, capacity):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.capacity = int(capacity)
+        descr = json.dumps(self.dtype.descr).encode()
+        if len(descr) > RING_HEADER_SIZE - _DTYPE_OFFSET:
+            raise ValueError('The record dtype description does not fit into the ring header.')
+
+        size = RING_HEADER_SIZE + self.capacity * self.dtype.itemsize
+        fd = os.open(path, os.O_CREAT | os.O_RDWR | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self.mm = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        header = np.ndarray((RING_HEADER_SIZE,), dtype=np.uint8, buffer=self.mm)
+        header[:] = 0
+        self.mm[0:8] = RING_MAGIC
+        np.ndarray((2,), dtype='<u4', buffer=self.mm, offset=8)[:] = (RING_VERSION, RING_HEADER_SIZE)
+        np.ndarray((2,), dtype='<u8', buffer=self.mm, offset=16)[:] = (self.capacity, self.dtype.itemsize)
+        self.mm[_DTYPE_OFFSET:_DTYPE_OFFSET + len(descr)] = descr
+        del header
+
+        self.counters = np.ndarray((3,), dtype='<u8', buffer=self.mm, offset=_SEQ_OFFSET)
+        self.records = np.ndarray((self.capacity,), dtype=self.dtype, buffer=self.mm, offset=RING_HEADER_SIZE)
+        self.seq = 0
+
+    def publish(self, arr):
+        """
+        Appends the records of arr to the ring, overwriting the oldest ones.
+        """
+        n = len(arr)
+        if n == 0:
+            return
+        if n > self.capacity:
+            arr = arr[-self.capacity:]
+            self.seq += n - self.capacity
+            n = self.capacity
+        self.counters[2] = self.seq + n
+        start = self.seq % self.capacity
+        first = min(n, self.capacity - start)
+        self.records[start:start + first] = arr[:first]
+        if first < n:
+            self.records[:n - first] = arr[first:]
+        # The sequence is updated last: readers never see slots that are still being written
+        self.seq += n
+        self.counters[1] = time.monotonic_ns()
+        self.counters[0] = self.seq
+
+    def close(self):
+        self.counters = None
+        self.records = None
+        self.mm.close()
+
+
+class MmapRingReader:
+    """
+    Reader of a ring written by MmapRingWriter, from any process. Starts at the newest record.
+    """
+    def __init__(self, path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            self.mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        if self.mm[0:8] != RING_MAGIC:
+            raise ValueError(f'{path} is not an EVK results ring.')
+        version, header_size = np.frombuffer(self.mm, dtype='<u4', count=2, offset=8)
+        if version != RING_VERSION:
+            raise ValueError(f'Unsupported ring layout version {version}.')
+        self.capacity, record_size = (int(v) for v in np.frombuffer(self.mm, dtype='<u8', count=2, offset=16))
+        descr = bytes(self.mm[_DTYPE_OFFSET:header_size]).rstrip(b'\0').decode()
+        self.dtype = np.dtype([tuple(field) for field in json.loads(descr)])
+        if self.dtype.itemsize != record_size:
+            raise ValueError('The record size does not match the record dtype.')
+
+        self.counters = np.frombuffer(self.mm, dtype='<u8', count=3, offset=_SEQ_OFFSET)
+        self.records = np.frombuffer(self.mm, dtype=self.dtype, count=self.capacity, offset=int(header_size))
+        self.seq = int(self.counters[0])
+        self.lost = 0
+
+    @property
+    def write_seq(self):
+        return int(self.counters[0])
+
+    @property
+    def heartbeat_ns(self):
+        """
+        time.monotonic_ns() of the last publish of the writer.
+        """
+        return int(self.counters[1])
+
+    def read(self, max_items=None):
+        """
+        Returns a copy of the records published since the last call (at most max_items, the oldest
+        first), or an empty array. Records overwritten before they could be read are counted in self.lost.
+        """
+        write_seq = self.write_seq
+        start = max(self.seq, write_seq - self.capacity)
+        self.lost += start - self.seq
+        end = write_seq if max_items is None else min(write_seq, start + max_items)
+        if end <= start:
+            return np.empty(0, dtype=self.dtype)
+
+        idx = np.arange(start, end) % self.capacity
+        out = self.records[idx]
+
+        # Drop what the writer may have overwritten while we were copying
+        overwritten = int(self.counters[2]) - self.capacity - start
+        if overwritten > 0:
+            self.lost += min(overwritten, end - start)
+            out = out[overwritten:]
+        self.seq = end
+        return out
+
+    def latest(self):
+        """
+        Returns the newest record, or None if nothing has been published yet.
+        """
+        write_seq = self.write_seq
+        if write_seq == 0:
+            return None
+        self.seq = write_seq - 1
+        out = self.read(1)
+        return out[-1] if len(out) else None
+
+    def close(self):
+        self.counters = None
+        self.records = None
+        self.mm.close()
+
+
+def parse_args():
+    import argparse
+    """
+    Parse command line arguments.
+    """
+    parser = argparse.ArgumentParser(description='Print the tracking results published into a memory-mapped ring.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('path', help='Path of the ring file given to the tracking script with -rb.')
+    parser.add_argument('-f', '--fields', dest='fields', type=str, default='t,x,y,object_id',
+                        help='Comma separated list of the fields to print. Default: t,x,y,object_id.')
+    return parser.parse_args()
+
+
+def main():
+    """
+    Main
+    """
+    args = parse_args()
+    reader = MmapRingReader(args.path)
+    fields = args.fields.split(',')
+    try:
+        while True:
+            records = reader.read()
+            for record in records[fields].tolist():
+                print(*record)
+            if len(records) == 0:
+                time.sleep(1e-3)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reader.close()
+
+
+if __name__ == "__main__":
+        main()
@@ -0,0 +1,139 @@
+"""
+Dynamic ROI that follows the tracked particle, so the events of the rest of the sensor (noise, other objects)
+are not processed while the particle drifts, instead of a static ROI wide enough for the drift.
+
+The ROI is centred on the recent position of the dominant object (mean of its positions in the last [window] us,
+e.g. the centre of its oscillation) and extends [margin] pixels beyond its mean bounding box on each side. It is
+only moved when the recent position is more than [hysteresis] pixels away from the ROI centre (or the bounding
+box grew or shrank by more than that), and at most once every [min_interval] us, so it does not follow every
+oscillation. When the particle is not seen for [lost_timeout] us, the ROI goes back to the home window (the
+static ROI, by default the whole sensor) to find it again.
+
+The events outside the ROI are always removed in software (DynamicRoi.filter, before the noise filters). With a
+live camera the hardware ROI of the sensor is moved as well (see camera.py), so the events outside are not even
+sent; if the camera has no hardware ROI, or applying it fails, only the software filter is used. The ROI changes
+(t, x0, y0, x1, y1, corners included) are saved with each CSV file in [csv file]_roi.csv.
+"""
+
+import collections
+import os
+import numpy as np
+
+
+class DynamicRoi:
+    """
+    ROI following the dominant object, see the top of this file. home: (x0, y0, x1, y1), default: whole sensor;
+    apply_hardware: function applying an ROI to the camera (e.g. from hardware_roi_setter()), or None.
+    """
+    def __init__(self, sensor_width, sensor_height, margin, hysteresis=None, window=10000, lost_timeout=200000,
+                 min_interval=10000, home=None, apply_hardware=None):
+        self.sensor_width = sensor_width
+        self.sensor_height = sensor_height
+        self.margin = margin
+        self.hysteresis = margin / 2 if hysteresis is None else hysteresis
+        self.window = window
+        self.lost_timeout = lost_timeout
+        self.min_interval = min_interval
+        self.home = (0, 0, sensor_width - 1, sensor_height - 1)
+        if home is not None:
+            self.home = (max(int(home[0]), 0), max(int(home[1]), 0),
+                         min(int(home[2]), sensor_width - 1), min(int(home[3]), sensor_height - 1))
+        self.apply_hardware = apply_hardware
+        self.recent = collections.deque()  # (t, x, y, width, height) of the last [window] us
+        self.sums = np.zeros(4)
+        self.t_seen = None
+        self.t_changed = None
+        self.roi = None
+        self.changes = []
+        self.moves = 0
+        self.events_in = 0
+        self.events_kept = 0
+        self._set(self.home, 0)
+
+    @property
+    def following(self):
+        return self.roi != self.home
+
+    def _set(self, roi, t):
+        if self.roi is not None:
+            self.moves += 1
+        self.roi = roi
+        self.t_changed = t
+        self.changes.append((int(t),) + roi)
+        if self.apply_hardware is not None:
+            try:
+                self.apply_hardware(roi)
+            except Exception as e:
+                print(f'Hardware ROI not applied ({e}): the events outside of the ROI are filtered in software.')
+                self.apply_hardware = None
+
+    def update(self, ts, records):
+        """
+        To be called at every tracking update (ts, us) with the rows of the dominant object (e.g. from
+        streams.TrackSelector, possibly empty).
+        """
+        for row in records[['t', 'x', 'y', 'width', 'height']].tolist():
+            self.recent.append(row)
+            self.sums += row[1:]
+        if len(records):
+            self.t_seen = int(records['t'][-1])
+        while self.recent and self.recent[0][0] < ts - self.window:
+            self.sums -= self.recent.popleft()[1:]
+
+        if self.t_changed is not None and ts - self.t_changed < self.min_interval:
+            return
+        if not self.recent:
+            if self.following and (self.t_seen is None or ts - self.t_seen > self.lost_timeout):
+                self._set(self.home, ts)
+            return
+        x, y, width, height = self.sums / len(self.recent)
+        half_width, half_height = width / 2 + self.margin, height / 2 + self.margin
+        x0, y0, x1, y1 = self.roi
+        if self.following and abs(x - (x0 + x1) / 2) <= self.hysteresis and abs(y - (y0 + y1) / 2) <= self.hysteresis \
+                and abs(half_width - (x1 - x0) / 2) <= self.hysteresis and abs(half_height - (y1 - y0) / 2) <= self.hysteresis:
+            return
+        roi = (int(max(round(x - half_width), 0)), int(max(round(y - half_height), 0)),
+               int(min(round(x + half_width), self.sensor_width - 1)), int(min(round(y + half_height), self.sensor_height - 1)))
+        if roi != self.roi:
+            self._set(roi, ts)
+
+    def filter(self, evs):
+        """
+        Returns the events of evs inside the ROI.
+        """
+        self.events_in += len(evs)
+        x0, y0, x1, y1 = self.roi
+        if self.roi != (0, 0, self.sensor_width - 1, self.sensor_height - 1):
+            x, y = evs['x'], evs['y']
+            evs = evs[(x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)]
+        self.events_kept += len(evs)
+        return evs
+
+    def save(self, csv_path):
+        """
+        Writes the ROI changes since the last save (the first row is the ROI at the start of the segment) in
+        [csv file]_roi.csv. Returns its path.
+        """
+        path = os.path.splitext(csv_path)[0] + '_roi.csv'
+        np.savetxt(path, np.array(self.changes, dtype=np.int64).reshape(-1, 5), fmt='%d', delimiter=',',
+                   header='t,x0,y0,x1,y1', comments='')
+        self.changes = [(int(self.t_changed),) + self.roi]
+        return path
+
+    def summary(self):
+        kept = self.events_kept / self.events_in if self.events_in else 1.
+        return f'{self.moves} ROI moves, {100 * kept:.1f}% of the events kept'
+
+
+def hardware_roi_setter(mv_iterator):
+    """
+    Function applying an ROI (x0, y0, x1, y1) to the live camera of mv_iterator (CameraSession, which also applies
+    it again after a recovery, or a Metavision iterator), or None for a RAW file.
+    """
+    from evk_tracking.camera import CameraSession, MetavisionBackend
+    if isinstance(mv_iterator, CameraSession):
+        return mv_iterator.set_roi
+    device = getattr(getattr(mv_iterator, 'reader', None), 'device', None)
+    if device is None or not hasattr(device, 'get_i_roi'):
+        return None
+    return lambda roi: MetavisionBackend.apply_roi(device, roi)
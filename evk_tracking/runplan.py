@@ -0,0 +1,235 @@
+"""
+Heat Engine run plans: declarative description of the cycles to record, and the scheduler that runs them.
+
+A plan is a YAML or JSON file (see HeatEnginePlan.yaml):
+    name: HE_ramping
+    saving_location: /path/to/signal/      # folder of the trajectories, parameters and logs
+    bias_file: /path/to/out.bias           # biases applied to all the cycles
+    port: ASRL/dev/ttyUSB2::INSTR          # DS335 resource
+    defaults:                              # parameters of every cycle unless overridden
+        duration: 12
+        ...
+    cycles:
+        - name: low_drive
+          amplitude: 0.5
+          repeats: 3
+        - name: high_drive
+          amplitude: 1.0
+          biases: {bias_diff_on: 420}      # overrides of the bias file for this cycle only
+
+The cycle parameters are listed in CYCLE_DEFAULTS. Each cycle is recorded [repeats] times; each recording is a run.
+
+The scheduler:
+- prepares run N+1 (folders, bias file, tracker command) while run N is recording;
+- sends the drive parameters of a run right before it, starts the tracker and switches the drive on
+  (offset_on) while the camera is being opened, then switches it off (offset_off) once the tracker is done;
+- appends one row per run to [saving_location]run_parameters.csv (parameters, start/end time, exit code);
+- has the tracker register its CSV files in [saving_location]catalog.sqlite with the run tags (see catalog.py);
+- skips the runs that already have a successful row in run_parameters.csv, so an interrupted plan is resumed
+  from the last completed run by starting it again.
+"""
+
+import asyncio
+import csv
+import datetime
+import json
+import os
+import shlex
+import time
+
+from evk_tracking.common import get_biases_from_file
+from evk_tracking.instruments import InstrumentError, run_process
+
+
+CYCLE_DEFAULTS = {
+    'duration': 12,             # seconds per CSV file (-csvt)
+    'files': 1,                 # CSV files per run (-csvn)
+    'update_frequency': 1000,   # Hz (-uf)
+    'accumulation_time': 0.,    # seconds, 0 = inverse of the update frequency (-at)
+    'min_size': 0,              # pixels (-mins)
+    'max_size': 220,            # pixels (-maxs)
+    'roi': None,                # {'x0', 'y0', 'x1', 'y1'} or {'width', 'height'}, video tracker only
+    'biases': {},               # overrides of the bias file
+    'offset_on': 2,             # DS335 offset (V) while recording
+    'offset_off': 0,            # DS335 offset (V) between runs
+    'amplitude': None,          # DS335 amplitude (Vpp), unchanged if None
+    'frequency': None,          # DS335 frequency (Hz), unchanged if None
+    'repeats': 1,
+    'video': False,             # True: video mode, False: headless mode (python3 -m evk_tracking)
+}
+
+PARAMETER_FIELDS = ['run', 'cycle', 'repeat', 'start_time', 'end_time', 'returncode', 'csv_prefix', 'bias_file'] + \
+                   [key for key in CYCLE_DEFAULTS if key not in ('biases', 'repeats')] + ['biases']
+
+
+def load_plan(path: str):
+    """
+    Helper function to read a YAML (.yaml/.yml) or JSON run plan.
+    """
+    with open(path, 'r') as plan_file:
+        if path.endswith(('.yaml', '.yml')):
+            import yaml
+            plan = yaml.safe_load(plan_file)
+        else:
+            plan = json.load(plan_file)
+    if not plan.get('cycles'):
+        raise ValueError(f'The run plan {path} has no cycles.')
+    for cycle in plan['cycles']:
+        unknown = set(cycle) - set(CYCLE_DEFAULTS) - {'name'}
+        if unknown:
+            raise ValueError(f'Unknown cycle parameters in {path}: {sorted(unknown)}')
+    return plan
+
+
+def expand_runs(plan):
+    """
+    Returns the list of runs of a plan, each one with its full set of parameters.
+    """
+    defaults = dict(CYCLE_DEFAULTS, **plan.get('defaults', {}))
+    runs = []
+    for cycle_index, cycle in enumerate(plan['cycles']):
+        params = dict(defaults, **cycle)
+        for repeat in range(params['repeats']):
+            run = dict(params, run=len(runs), cycle=cycle.get('name', f'cycle{cycle_index}'), repeat=repeat)
+            runs.append(run)
+    return runs
+
+
+def write_bias_file(path: str, biases):
+    with open(path, 'w') as biases_file:
+        for name, value in biases.items():
+            biases_file.write(f'{value:<5d}% {name}\n')
+
+
+def completed_runs(parameters_path: str):
+    """
+    Returns the indices of the runs with a successful row in the parameters CSV.
+    """
+    done = set()
+    if os.path.isfile(parameters_path):
+        with open(parameters_path, 'r') as parameters_file:
+            for row in csv.DictReader(parameters_file):
+                if row['returncode'] == '0':
+                    done.add(int(row['run']))
+    return done
+
+
+class RunPlanScheduler:
+    """
+    Runs the cycles of a plan, see the top of this file.
+    instruments: evk_tracking.instruments.InstrumentManager. on_failure: optional blocking function called when the
+    tracker fails (e.g. camera reset), after which the run is recorded again once.
+    """
+    def __init__(self, plan, instruments, on_failure=None, command_log=None, tracker_command=None):
+        self.plan = plan
+        self.instruments = instruments
+        self.on_failure = on_failure
+        self.command_log = command_log
+        self.tracker_command = tracker_command
+        self.saving_location = plan['saving_location']
+        self.parameters_path = os.path.join(self.saving_location, 'run_parameters.csv')
+        self.catalog_path = os.path.join(self.saving_location, 'catalog.sqlite')
+        self.sync_log_path = command_log.path if command_log is not None else ''
+
+    def prepare(self, run):
+        """
+        Creates the folders and the bias file of the run and returns its tracker command.
+        """
+        os.makedirs(self.saving_location, exist_ok=True)
+        run['csv_prefix'] = os.path.join(self.saving_location, f"run{run['run']:03d}_EVK_")
+        run['bias_file'] = self.plan.get('bias_file', '')
+        if run['biases']:
+            biases = get_biases_from_file(run['bias_file']) if run['bias_file'] else {}
+            biases.update(run['biases'])
+            run['bias_file'] = os.path.join(self.saving_location, f"run{run['run']:03d}.bias")
+            write_bias_file(run['bias_file'], biases)
+        if self.tracker_command is not None:
+            return self.tracker_command(run)
+
+        command = 'python3 -m evk_tracking ' + ('video -dbb True' if run['video'] else 'headless')
+        command += ' -csv ' + run['csv_prefix'] + ' -csvt ' + str(run['duration']) + ' -csvn ' + str(run['files'])
+        command += ' -uf ' + str(run['update_frequency']) + ' -mins ' + str(run['min_size']) + ' -maxs ' + str(run['max_size'])
+        if run['accumulation_time'] > 0:
+            command += ' -at ' + str(run['accumulation_time'])
+        if run['bias_file']:
+            command += ' -bf ' + run['bias_file']
+        if self.sync_log_path:
+            command += ' -sync ' + self.sync_log_path
+        # Every CSV file of the run is registered in the catalog of the plan with the run and drive settings
+        run_tags = {'plan': self.plan.get('name', ''), 'run': run['run'], 'cycle': run['cycle'], 'repeat': run['repeat'],
+                    'drive': {key: run[key] for key in ('amplitude', 'frequency', 'offset_on')}}
+        command += ' -cat ' + shlex.quote(self.catalog_path) + ' --run-tags ' + shlex.quote(json.dumps(run_tags))
+        if run['roi']:
+            if not run['video']:
+                print(f"Run {run['run']}: the ROI is only supported by the video tracker, it is ignored.")
+            elif 'width' in run['roi']:
+                command += ' -xw ' + str(run['roi']['width']) + ' -xh ' + str(run['roi']['height'])
+            else:
+                command += ''.join(f" -{key} {run['roi'][key]}" for key in ('x0', 'y0', 'x1', 'y1'))
+        return command
+
+    async def setup_instruments(self, ds335, run):
+        if run['amplitude'] is not None:
+            await ds335.set_amplitude(run['amplitude'])
+        if run['frequency'] is not None:
+            await ds335.set_frequency(run['frequency'])
+
+    async def record(self, ds335, run, command):
+        """
+        Switches the drive on while the tracker starts, and off once it is done. Returns the tracker exit code.
+        """
+        tracker = asyncio.ensure_future(run_process(command))
+        try:
+            await ds335.set_offset(run['offset_on'])
+        except InstrumentError as e:
+            print("Instrument error: " + str(e))
+        returncode = await tracker
+        await ds335.set_offset(run['offset_off'])
+        return returncode
+
+    def save_parameters(self, run, start_time, end_time, returncode):
+        new_file = not os.path.isfile(self.parameters_path)
+        with open(self.parameters_path, 'a') as parameters_file:
+            writer = csv.DictWriter(parameters_file, fieldnames=PARAMETER_FIELDS, extrasaction='ignore', lineterminator='\n')
+            if new_file:
+                writer.writeheader()
+            row = dict(run, start_time=start_time, end_time=end_time, returncode=returncode)
+            row['roi'] = json.dumps(run['roi']) if run['roi'] else ''
+            row['biases'] = json.dumps(run['biases']) if run['biases'] else ''
+            writer.writerow(row)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        runs = expand_runs(self.plan)
+        done = completed_runs(self.parameters_path)
+        pending = [run for run in runs if run['run'] not in done]
+        if done:
+            print(f'Resuming plan: {len(done)} of {len(runs)} runs already completed.')
+        if not pending:
+            return
+
+        ds335 = self.instruments.ds335(self.plan.get('port', 'ASRL/dev/ttyUSB2::INSTR'))
+        await ds335.set_offset(pending[0]['offset_off'])
+
+        next_command = loop.run_in_executor(None, self.prepare, pending[0])
+        for i, run in enumerate(pending):
+            command = await next_command
+            cycle_start = time.monotonic()
+            print(f"Run No: {run['run']} ({run['cycle']}, repeat {run['repeat']})")
+            if self.command_log is not None:
+                self.command_log.tag = f"run {run['run']}"
+            await self.setup_instruments(ds335, run)
+
+            start_time = datetime.datetime.now().strftime('%Y%m%d_%H-%M-%S')
+            recording = asyncio.ensure_future(self.record(ds335, run, command))
+            # Run N+1 is prepared while run N is recording
+            if i + 1 < len(pending):
+                next_command = loop.run_in_executor(None, self.prepare, pending[i + 1])
+            returncode = await recording
+            if returncode != 0 and self.on_failure is not None:
+                await loop.run_in_executor(None, self.on_failure)
+                returncode = await self.record(ds335, run, command)
+            self.save_parameters(run, start_time, datetime.datetime.now().strftime('%Y%m%d_%H-%M-%S'), returncode)
+            print('Run duration: {:.2f}s'.format(time.monotonic() - cycle_start))
+
+        await ds335.set_offset(pending[-1]['offset_off'])
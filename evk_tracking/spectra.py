@@ -0,0 +1,133 @@
+"""
+Power spectral densities of positions and fits of the trap models, with numpy only.
+
+- resample(): positions at the update times onto a regular grid (the missing updates are interpolated);
+- welch_psd(): one-sided PSD (pixels**2/Hz) averaged over Hann windows with 50% overlap, like periodogram() of
+  the MATLAB scripts but with less noise;
+- fit_psd(): fit of
+    oscillator (default): S(f) = A / ((f0**2 - f**2)**2 + damping**2 f**2) + floor, a damped harmonic oscillator
+                          driven by thermal noise (f0 trap frequency, damping full width of the peak, Hz);
+    lorentzian:           S(f) = A / (fc**2 + f**2) + floor, an overdamped trap (fc corner frequency, Hz).
+  The model without floor is linear in 1/S (1, f**2, f**4), which gives the starting values; they are refined by
+  Gauss-Newton iterations on the relative residuals S / model - 1 (the relative error of a PSD estimate is the
+  same at all frequencies). The variance of the position is the integral of the model without floor.
+"""
+
+import numpy as np
+
+
+PSD_MODELS = ('oscillator', 'lorentzian')
+
+
+def resample(t, values, dt=None):
+    """
+    Values at the times t (us) on a regular grid of period dt (us, default: median period). Returns the grid times,
+    the values and the fraction of grid points without a position.
+    """
+    t = np.asarray(t, dtype=np.int64)
+    if dt is None:
+        dt = float(np.median(np.diff(t)))
+    grid = t[0] + np.arange(int((t[-1] - t[0]) // dt) + 1) * dt
+    index = np.rint((t - t[0]) / dt).astype(np.int64)
+    missing = 1 - len(np.unique(index)) / len(grid)
+    values = np.asarray(values, dtype=float)
+    if values.ndim == 1:
+        return grid, np.interp(grid, t, values), missing
+    return grid, np.stack([np.interp(grid, t, column) for column in values.T], axis=1), missing
+
+
+def welch_psd(x, fs, nperseg=4096):
+    """
+    One-sided PSD of x (sampling frequency fs, Hz): mean of the periodograms of Hann windows of nperseg samples
+    with 50% overlap, each without its mean. Returns frequencies (Hz), PSD (units**2/Hz) and number of windows.
+    """
+    x = np.asarray(x, dtype=float)
+    nperseg = min(nperseg, len(x))
+    step = nperseg // 2
+    starts = np.arange(0, len(x) - nperseg + 1, step)
+    window = np.hanning(nperseg)
+    scale = 1 / (fs * (window ** 2).sum())
+    segments = np.lib.stride_tricks.sliding_window_view(x, nperseg)[starts]
+    segments = (segments - segments.mean(axis=1, keepdims=True)) * window
+    psd = (np.abs(np.fft.rfft(segments, axis=1)) ** 2).mean(axis=0) * scale
+    psd[1:-1 if nperseg % 2 == 0 else None] *= 2
+    return np.fft.rfftfreq(nperseg, 1 / fs), psd, len(starts)
+
+
+def psd_model(f, parameters, model='oscillator'):
+    if model == 'oscillator':
+        amplitude, f0, damping, floor = parameters
+        return amplitude / ((f0 ** 2 - f ** 2) ** 2 + damping ** 2 * f ** 2) + floor
+    amplitude, fc, floor = parameters
+    return amplitude / (fc ** 2 + f ** 2) + floor
+
+
+def _linear_start(f, psd, floor, model):
+    signal = psd - floor
+    keep = signal > 0
+    f, signal = f[keep], signal[keep]
+    basis = [np.ones_like(f), f ** 2] + ([f ** 4] if model == 'oscillator' else [])
+    design = signal[:, None] * np.stack(basis, axis=1)
+    coefficients = np.linalg.lstsq(design, np.ones_like(f), rcond=None)[0]
+    if model == 'oscillator':
+        a, b, c = coefficients
+        amplitude = 1 / c if c > 0 else float(np.max(signal) * np.median(f) ** 4)
+        f0 = (max(a, 1e-30) * amplitude) ** 0.25
+        damping = np.sqrt(max(b * amplitude + 2 * f0 ** 2, (0.05 * f0) ** 2))
+        return np.array([amplitude, f0, damping, max(floor, 1e-30)])
+    a, b = coefficients
+    amplitude = 1 / b if b > 0 else float(np.max(signal) * np.median(f) ** 2)
+    fc = np.sqrt(max(a * amplitude, (f[1] if len(f) > 1 else 1.0) ** 2))
+    return np.array([amplitude, fc, max(floor, 1e-30)])
+
+
+def fit_psd(f, psd, model='oscillator', f_min=None, f_max=None, iterations=50):
+    """
+    Fits a model of PSD_MODELS on the PSD between f_min and f_max (Hz, default: second frequency to Nyquist).
+    Returns a dictionary: parameters (amplitude, f0 and damping or fc, floor), variance of the position (integral of
+    the model without floor), chi2 (mean squared relative residual) and points.
+    """
+    if model not in PSD_MODELS:
+        raise ValueError(f'Unknown PSD model: {model}')
+    band = (f > 0) & (f >= (f_min if f_min is not None else f[1])) & (f <= (f_max if f_max is not None else f[-1]))
+    f, psd = f[band], psd[band]
+    floor = float(np.median(psd[-max(len(psd) // 10, 1):]))
+    parameters = _linear_start(f, psd, 0.5 * floor, model)
+
+    # Gauss-Newton on the logarithms of the parameters (all positive)
+    log_parameters = np.log(parameters)
+    damping_factor = 1e-3
+
+    def residuals(log_p):
+        return psd / psd_model(f, np.exp(log_p), model) - 1
+
+    current = residuals(log_parameters)
+    for _ in range(iterations):
+        jacobian = np.empty((len(f), len(log_parameters)))
+        for i in range(len(log_parameters)):
+            step = np.zeros_like(log_parameters)
+            step[i] = 1e-6
+            jacobian[:, i] = (residuals(log_parameters + step) - current) / 1e-6
+        normal = jacobian.T @ jacobian
+        gradient = jacobian.T @ current
+        update = np.linalg.solve(normal + damping_factor * np.diag(np.diag(normal) + 1e-12), -gradient)
+        candidate = residuals(log_parameters + update)
+        if (candidate ** 2).sum() < (current ** 2).sum():
+            log_parameters, current = log_parameters + update, candidate
+            damping_factor = max(damping_factor / 10, 1e-9)
+            if np.abs(update).max() < 1e-8:
+                break
+        else:
+            damping_factor *= 10
+            if damping_factor > 1e8:
+                break
+    parameters = np.exp(log_parameters)
+    result = {'model': model, 'points': int(len(f)), 'chi2': float((current ** 2).mean())}
+    if model == 'oscillator':
+        amplitude, f0, damping, floor = parameters
+        result.update(amplitude=amplitude, f0=f0, damping=damping, floor=floor,
+                      variance=amplitude * np.pi / (2 * damping * f0 ** 2))
+    else:
+        amplitude, fc, floor = parameters
+        result.update(amplitude=amplitude, fc=fc, floor=floor, variance=amplitude * np.pi / (2 * fc))
+    return result
@@ -0,0 +1,329 @@
+"""
+Rolling spectrogram of the dominant track: drift of the trap frequency and of the damping over long runs (Heat
+Engine sessions), seen while measuring instead of after the MATLAB post-processing.
+
+The X and Y positions are put on the grid of the update period (the missing updates are interpolated; after a gap
+longer than max_gap, or at the start of another run, the spectrogram starts again). Every nperseg / 2 new positions, the periodogram of the last
+nperseg positions (Hann window) is added to the spectrum of the current frame; a frame is closed every [frame]
+seconds, giving one point of the drift series per axis:
+    peak method (default): frequency of the maximum of the PSD between f_min and f_max (parabolic interpolation)
+                           and linewidth (full width at half maximum above the floor, the median of the band). The
+                           linewidth cannot be below ~2 frequency bins (fs / nperseg) of the Hann window;
+    fit method:            f0 and damping of the damped oscillator fit of spectra.py (slower, not limited by the
+                           bins).
+with the power in the band (pixels**2) and the peak over floor ratio.
+
+All the buffers (positions, FFT input and spectrum) are allocated once, the same FFT size is used for the whole
+run (numpy keeps the FFT plan of a size in a cache) and the rfft writes into a preallocated output when numpy
+accepts it, so a point costs the same after hours as at the start and the memory only grows by one row per frame.
+
+The tracking scripts write the drift series of a run with -drift [frame seconds] ([csv path][timestamp]_drift.csv,
+one row per frame, written as soon as it is closed). From archived runs or the tracker ring:
+    python3 -m evk_tracking.spectrogram EVK_20240311_*.evkt --frame 10 -o drift_0311.csv
+    python3 -m evk_tracking.spectrogram -rb /dev/shm/evk_results --frame 5 --f-min 50 --f-max 300 -o drift_live.csv
+"""
+
+import csv
+import inspect
+import time
+import numpy as np
+
+
+DRIFT_AXES = ('x', 'y')
+DRIFT_FIELDS = ['t', 't_start', 't_end', 'samples', 'missing', 'segments']
+AXIS_FIELDS = ['frequency', 'linewidth', 'power', 'peak_ratio']
+_RFFT_OUT = 'out' in inspect.signature(np.fft.rfft).parameters
+
+
+def peak_and_width(f, psd):
+    """
+    Frequency of the maximum of psd (parabolic interpolation of its logarithm), full width at half maximum above the
+    floor (median of psd) and peak over floor ratio.
+    """
+    i = int(np.argmax(psd))
+    floor = float(np.median(psd))
+    df = f[1] - f[0]
+    frequency = f[i]
+    if 0 < i < len(psd) - 1 and (psd[i - 1:i + 2] > 0).all():
+        left, center, right = np.log(psd[i - 1:i + 2])
+        curvature = left - 2 * center + right
+        if curvature < 0:
+            frequency += 0.5 * df * (left - right) / curvature
+    half = floor + 0.5 * (psd[i] - floor)
+    low = i
+    while low > 0 and psd[low] > half:
+        low -= 1
+    high = i
+    while high < len(psd) - 1 and psd[high] > half:
+        high += 1
+    # Linear interpolation of the crossings
+    f_low = f[low] + df * (half - psd[low]) / (psd[low + 1] - psd[low]) if psd[low] <= half < psd[low + 1] else f[low]
+    f_high = f[high] - df * (half - psd[high]) / (psd[high - 1] - psd[high]) if psd[high] <= half < psd[high - 1] else f[high]
+    return float(frequency), float(f_high - f_low), float(psd[i] / floor) if floor > 0 else np.inf
+
+
+class RollingSpectrogram:
+    """
+    Incremental spectrogram and drift series of the X and Y positions, see the top of this file. dt: update period
+    (us, default: median period of the first results); max_gap (us); output: CSV path where the rows are written as
+    soon as the frames are closed (optional, the rows are also kept in self.rows).
+    """
+    def __init__(self, dt=None, nperseg=2048, frame=10.0, f_min=None, f_max=None, method='peak', max_gap=1e5, output=''):
+        if method not in ('peak', 'fit'):
+            raise ValueError(f'Unknown drift method: {method}')
+        self.dt = dt
+        self.nperseg = nperseg
+        self.hop = nperseg // 2
+        self.frame = frame
+        self.f_min = f_min
+        self.f_max = f_max
+        self.method = method
+        self.max_gap = max_gap
+        self.rows = []
+
+        # Preallocated buffers
+        self.ring = np.zeros((nperseg, 2))
+        self.work = np.zeros((nperseg, 2))
+        self.spectrum_out = np.zeros((nperseg // 2 + 1, 2), dtype=complex)
+        self.power = np.zeros((nperseg // 2 + 1, 2))
+        self.spectrum = np.zeros((nperseg // 2 + 1, 2))
+        self.window = np.hanning(nperseg)[:, None]
+        self.window_power = float((self.window ** 2).sum())
+
+        self.output_file = None
+        self.writer = None
+        if output:
+            self.output_file = open(output, 'w')
+            self.writer = csv.DictWriter(self.output_file, fieldnames=self.fields(), lineterminator='\n')
+            self.writer.writeheader()
+        self._restart()
+
+    def fields(self):
+        return DRIFT_FIELDS + [f'{axis}_{field}' for axis in DRIFT_AXES for field in AXIS_FIELDS]
+
+    def restart(self):
+        """
+        The next positions come from another run (its sensor clock starts again): starts again as after a gap.
+        """
+        self._restart()
+
+    def _restart(self):
+        self.t0 = None          # Time of grid index 0
+        self.last_index = None
+        self.last_value = None
+        self.pushed_index = None
+        self.write_index = 0
+        self.filled = 0         # Positions in the ring since the (re)start
+        self.pending = 0        # Positions since the last periodogram
+        self._clear_frame()
+
+    def _clear_frame(self):
+        self.spectrum[:] = 0
+        self.segments = 0
+        self.frame_samples = 0
+        self.frame_missing = 0
+        self.frame_start = None
+
+    @property
+    def averages(self):
+        """
+        Periodograms per frame.
+        """
+        return max(1, int(round(self.frame * 1e6 / self.dt / self.hop)))
+
+    def add(self, records):
+        """
+        Adds one position per update time (records with t, x, y, e.g. from streams.TrackSelector), in time order.
+        """
+        if len(records) == 0:
+            return
+        t = records['t'].astype(np.int64)
+        if self.dt is None:
+            if len(t) < 2:
+                return
+            self.dt = float(np.median(np.diff(t)))
+        positions = np.stack([records['x'], records['y']], axis=1).astype(float)
+        if self.t0 is None:
+            self.t0 = int(t[0])
+        index = np.rint((t - self.t0) / self.dt).astype(np.int64)
+        keep = index > (self.last_index if self.last_index is not None else -1)
+        index, positions, t = index[keep], positions[keep], t[keep]
+        keep = np.ones(len(index), dtype=bool)
+        keep[1:] = index[1:] != index[:-1]
+        index, positions, t = index[keep], positions[keep], t[keep]
+        if len(index) == 0:
+            return
+
+        # Gaps longer than max_gap: the spectrogram starts again after them
+        previous = np.concatenate(([self.last_index if self.last_index is not None else index[0] - 1], index[:-1]))
+        gaps = np.flatnonzero((index - previous) * self.dt > self.max_gap)
+        start = 0
+        for gap in list(gaps) + [len(index)]:
+            if gap > start:
+                self._add_grid(index[start:gap], positions[start:gap], t[start])
+            if gap < len(index):
+                self._restart()
+                self.t0 = int(t[gap])
+                index = np.rint((t - self.t0) / self.dt).astype(np.int64)
+            start = gap
+
+    def _add_grid(self, index, positions, t_first):
+        if self.last_index is None:
+            known, values = index, positions
+            self.frame_start = t_first
+        else:
+            known = np.concatenate(([self.last_index], index))
+            values = np.concatenate((self.last_value[None, :], positions))
+        grid = np.arange(known[0] if self.last_index is None else self.last_index + 1, index[-1] + 1)
+        if len(grid) == len(index):
+            grid_positions = positions
+        else:
+            grid_positions = np.stack([np.interp(grid, known, values[:, 0]), np.interp(grid, known, values[:, 1])], axis=1)
+        measured = np.zeros(len(grid), dtype=bool)
+        measured[index - grid[0]] = True
+        self.last_index = int(index[-1])
+        self.last_value = positions[-1].copy()
+        self._push(grid_positions, measured, int(grid[0]))
+
+    def _push(self, values, measured, grid_start):
+        offset = 0
+        while offset < len(values):
+            n = min(self.hop - self.pending, len(values) - offset, self.nperseg - self.write_index)
+            self.ring[self.write_index:self.write_index + n] = values[offset:offset + n]
+            self.write_index = (self.write_index + n) % self.nperseg
+            self.frame_samples += int(measured[offset:offset + n].sum())
+            self.frame_missing += n - int(measured[offset:offset + n].sum())
+            self.pushed_index = grid_start + offset + n - 1
+            self.filled += n
+            self.pending += n
+            offset += n
+            if self.pending == self.hop:
+                self.pending = 0
+                if self.filled >= self.nperseg:
+                    self._periodogram()
+
+    def _periodogram(self):
+        w = self.write_index
+        self.work[:self.nperseg - w] = self.ring[w:]
+        self.work[self.nperseg - w:] = self.ring[:w]
+        self.work -= self.work.mean(axis=0)
+        self.work *= self.window
+        if _RFFT_OUT:
+            np.fft.rfft(self.work, axis=0, out=self.spectrum_out)
+        else:
+            self.spectrum_out[:] = np.fft.rfft(self.work, axis=0)
+        np.square(self.spectrum_out.real, out=self.power)
+        self.spectrum += self.power
+        np.square(self.spectrum_out.imag, out=self.power)
+        self.spectrum += self.power
+        self.segments += 1
+        if self.segments >= self.averages:
+            self._close_frame()
+
+    def psd(self):
+        """
+        Frequencies (Hz) and one-sided PSD (pixels**2/Hz) of X and Y of the current frame.
+        """
+        fs = 1e6 / self.dt
+        psd = self.spectrum / (max(self.segments, 1) * fs * self.window_power)
+        psd[1:-1 if self.nperseg % 2 == 0 else None] *= 2
+        return np.fft.rfftfreq(self.nperseg, 1 / fs), psd
+
+    def _close_frame(self):
+        f, psd = self.psd()
+        band = (f >= (self.f_min if self.f_min is not None else f[2])) & (f <= (self.f_max if self.f_max is not None else f[-1]))
+        t_end = self.t0 + self.pushed_index * self.dt
+        row = {'t': int((self.frame_start + t_end) / 2), 't_start': int(self.frame_start), 't_end': int(t_end),
+               'samples': self.frame_samples, 'missing': self.frame_missing / max(self.frame_samples + self.frame_missing, 1),
+               'segments': self.segments}
+        for i, axis in enumerate(DRIFT_AXES):
+            axis_psd = psd[band, i]
+            frequency, linewidth, peak_ratio = peak_and_width(f[band], axis_psd)
+            if self.method == 'fit':
+                from evk_tracking.spectra import fit_psd
+                try:
+                    fit = fit_psd(f[band], axis_psd, 'oscillator')
+                    frequency, linewidth = fit['f0'], fit['damping']
+                except (np.linalg.LinAlgError, ValueError):
+                    frequency, linewidth = np.nan, np.nan
+            row.update({f'{axis}_frequency': frequency, f'{axis}_linewidth': linewidth,
+                        f'{axis}_power': float(axis_psd.sum() * (f[1] - f[0])), f'{axis}_peak_ratio': peak_ratio})
+        self.rows.append(row)
+        if self.writer is not None:
+            self.writer.writerow(row)
+            self.output_file.flush()
+        self._clear_frame()
+        self.frame_start = t_end + self.dt
+
+    def finish(self):
+        """
+        Closes the last frame if it has at least half of its periodograms, and the output file. Returns the rows.
+        """
+        if self.segments >= max(self.averages // 2, 1):
+            self._close_frame()
+        if self.output_file is not None:
+            self.output_file.close()
+            self.output_file = None
+        return self.rows
+
+
+def parse_args():
+    import argparse
+    from evk_tracking.streams import add_source_arguments
+    """
+    Parse command line arguments.
+    """
+    parser = argparse.ArgumentParser(description='Rolling spectrogram: drift of the trap frequency and linewidth of the dominant track, from archived runs or the tracker ring.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    add_source_arguments(parser)
+    spectrogram_options = parser.add_argument_group('Spectrogram options')
+    spectrogram_options.add_argument('--frame', dest='frame', type=float, default=10.0,
+                                     help='Duration of a point of the drift series. Unit: seconds. Default: 10.')
+    spectrogram_options.add_argument('--nperseg', dest='nperseg', type=int, default=2048,
+                                     help='Positions per periodogram (frequency resolution: update frequency / nperseg). Default: 2048.')
+    spectrogram_options.add_argument('--dt', dest='dt', type=float, default=None,
+                                     help='Update period of the tracker. Unit: us. Default: median period of the first results.')
+    spectrogram_options.add_argument('--f-min', dest='f_min', type=float, default=None,
+                                     help='Lowest frequency of the peak. Unit: Hz. Default: third frequency bin.')
+    spectrogram_options.add_argument('--f-max', dest='f_max', type=float, default=None,
+                                     help='Highest frequency of the peak. Unit: Hz. Default: Nyquist frequency.')
+    spectrogram_options.add_argument('--method', dest='method', type=str, default='peak', choices=['peak', 'fit'],
+                                     help='Peak and half-maximum width, or damped oscillator fit of each frame. Default: peak.')
+    spectrogram_options.add_argument('--max-gap', dest='max_gap', type=float, default=1e5,
+                                     help='Longest gap between positions that is interpolated; the spectrogram starts again after longer gaps. Unit: us. Default: 1e5.')
+    spectrogram_options.add_argument('-o', '--output', dest='output', type=str, default='drift.csv',
+                                     help='CSV file of the drift series, one row per frame. Default: drift.csv.')
+    return parser.parse_args()
+
+
+def main():
+    """
+    Main
+    """
+    args = parse_args()
+    from evk_tracking.streams import TrackSelector, results_from_args
+    spectrogram = RollingSpectrogram(args.dt, args.nperseg, args.frame, args.f_min, args.f_max, args.method,
+                                     args.max_gap, args.output)
+    selector = TrackSelector(args.object_id)
+    start = time.perf_counter()
+    try:
+        for new_run, records in results_from_args(args):
+            if new_run:
+                selector.reset()
+                spectrogram.restart()
+            spectrogram.add(selector.select(records))
+    except KeyboardInterrupt:
+        pass
+    rows = spectrogram.finish()
+    print(f'{len(rows)} frames in {time.perf_counter() - start:.2f}s')
+    if rows:
+        for axis in DRIFT_AXES:
+            frequencies = np.array([row[f'{axis}_frequency'] for row in rows])
+            linewidths = np.array([row[f'{axis}_linewidth'] for row in rows])
+            print(f'{axis}: frequency {np.nanmin(frequencies):.2f} to {np.nanmax(frequencies):.2f} Hz, '
+                  f'linewidth {np.nanmin(linewidths):.2f} to {np.nanmax(linewidths):.2f} Hz')
+    print('Saved at ' + args.output)
+
+
+if __name__ == "__main__":
+        main()
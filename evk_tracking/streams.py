@@ -0,0 +1,198 @@
+"""
+Sources of tracking results for the streaming analyses (telegraph.py...): the same analysis runs over archived
+runs or live, chunk by chunk, in constant memory.
+- archived runs: .evkt files (only the needed columns and time range are read, see trajectory.py) or CSV files
+  (parsed in blocks, see migrate.py), given as paths or selected in the catalog (--catalog with --run, --cycle);
+- live: the results ring published by the tracker with -rb (see ringbuffer.py), until Ctrl+C or until the
+  tracker stops publishing.
+
+The sources yield (new_run, rows): the sensor clock of the camera starts again at 0 in every tracker process, so
+rows earlier than the previous ones start a new run (e.g. the next run of a catalog, whose segments are ordered by
+run, then time). At a new run the analyses reset their TrackSelector and restart as after a gap, instead of
+dropping the rows of the runs after the first.
+
+TrackSelector keeps one position per update time, from the object seen the most so far, so an analysis follows
+the particle through the ID changes caused by missing time stamps instead of mixing several objects.
+"""
+
+import os
+import time
+import numpy as np
+
+
+def _mark_runs(batches):
+    """
+    Yields (new_run, rows) for the batches of rows (with t, in time order within a run): new_run is True when the
+    rows are earlier than the previous ones (the sensor clock restarted with another tracker process).
+    """
+    t_last = None
+    for records in batches:
+        new_run = t_last is not None and int(records['t'][0]) < t_last
+        t_last = int(records['t'][-1])
+        yield new_run, records
+
+
+def _path_results(path, columns=None, t_from=None, t_to=None):
+    from evk_tracking.trajectory import TrajectoryReader
+    if path.endswith('.evkt'):
+        with TrajectoryReader(path) as reader:
+            for records in reader.query(columns, t_from, t_to):
+                if len(records):
+                    yield records
+        return
+    from evk_tracking.migrate import csv_records
+    for records in csv_records(path):
+        if t_from is not None or t_to is not None:
+            keep = np.ones(len(records), dtype=bool)
+            if t_from is not None:
+                keep &= records['t'] >= t_from
+            if t_to is not None:
+                keep &= records['t'] <= t_to
+            records = records[keep]
+        if len(records):
+            yield records[list(columns)] if columns else records
+
+
+def file_results(paths, columns=None, t_from=None, t_to=None):
+    """
+    Yields (new_run, rows) for the .evkt and CSV files (rows: structured arrays, only columns, which must include t)
+    of the time range [t_from, t_to] (us), see the top of this file.
+    """
+    return _mark_runs(records for path in paths for records in _path_results(path, columns, t_from, t_to))
+
+
+def file_runs(paths, t_from=None, t_to=None):
+    """
+    Groups paths (in order) by run: a file whose first row is earlier than the last row of the previous file starts
+    a new run. Files without rows in [t_from, t_to] (us) are left out. Returns a list of lists of paths.
+    """
+    runs, t_last = [], None
+    for path in paths:
+        t_first = None
+        for records in _path_results(path, ('t',), t_from, t_to):
+            t_first = int(records['t'][0]) if t_first is None else t_first
+            t_end = int(records['t'][-1])
+        if t_first is None:
+            continue
+        if t_last is None or t_first < t_last:
+            runs.append([])
+        runs[-1].append(path)
+        t_last = t_end
+    return runs
+
+
+def ring_results(path, columns=None, idle_timeout=None, poll_interval=1e-3):
+    """
+    Yields (new_run, rows) for the batches of results published into the ring of the tracker (-rb). Stops after
+    idle_timeout seconds without new results (None: only on Ctrl+C, handled by the caller).
+    """
+    return _mark_runs(_ring_batches(path, columns, idle_timeout, poll_interval))
+
+
+def _ring_batches(path, columns, idle_timeout, poll_interval):
+    from evk_tracking.ringbuffer import MmapRingReader
+    reader = MmapRingReader(path)
+    try:
+        last = time.monotonic()
+        while True:
+            records = reader.read()
+            if len(records):
+                last = time.monotonic()
+                yield records[list(columns)] if columns else records
+            elif idle_timeout is not None and time.monotonic() - last > idle_timeout:
+                return
+            else:
+                time.sleep(poll_interval)
+    finally:
+        if reader.lost:
+            print(f'{reader.lost} results were lost (the analysis was slower than the tracker).')
+        reader.close()
+
+
+class TrackSelector:
+    """
+    Keeps one row per timestamp: the row of the object ID with the most rows so far (or of object_id if given).
+    reset() at a new run: the object IDs and the sensor clock of another tracker process start again.
+    """
+    def __init__(self, object_id=None):
+        self.object_id = object_id
+        self.reset()
+
+    def reset(self):
+        self.counts = {}
+        self.t_last = None
+
+    def select(self, records):
+        if len(records) == 0:
+            return records
+        if self.object_id is not None:
+            records = records[records['object_id'] == self.object_id]
+        else:
+            ids, inverse, n = np.unique(records['object_id'], return_inverse=True, return_counts=True)
+            for object_id, count in zip(ids.tolist(), n.tolist()):
+                self.counts[object_id] = self.counts.get(object_id, 0) + count
+            score = np.array([self.counts[object_id] for object_id in ids.tolist()])[inverse]
+            records = records[np.lexsort((-score, records['t']))]
+            first = np.ones(len(records), dtype=bool)
+            first[1:] = records['t'][1:] != records['t'][:-1]
+            records = records[first]
+        if self.t_last is not None:
+            records = records[records['t'] > self.t_last]
+        if len(records):
+            self.t_last = int(records['t'][-1])
+        return records
+
+
+def add_source_arguments(parser):
+    """
+    Adds the options selecting the results to analyse: paths, --catalog (--run, --cycle), -rb, --from, --to, --id.
+    """
+    source_options = parser.add_argument_group('Source options')
+    source_options.add_argument('paths', nargs='*', help='.evkt or CSV files of the tracker.')
+    source_options.add_argument('--catalog', dest='catalog', type=str, default='',
+                                help='Catalog (see catalog.py) where the files overlapping the time range are selected, with --run and --cycle. Default: \'\'.')
+    source_options.add_argument('--run', dest='run', type=int, nargs='+', default=None, help='Run numbers (with --catalog). Default: all.')
+    source_options.add_argument('--cycle', dest='cycle', type=str, nargs='+', default=None, help='Cycle names (with --catalog). Default: all.')
+    source_options.add_argument('-rb', '--results-ring', dest='results_ring', type=str, default='',
+                                help='Ring where a running tracker publishes its results (its -rb option): analyses them live, until Ctrl+C. Default: \'\'.')
+    source_options.add_argument('--idle-timeout', dest='idle_timeout', type=float, default=None,
+                                help='With -rb, stops after this time without new results. Unit: seconds. Default: None (until Ctrl+C).')
+    source_options.add_argument('--from', dest='t_from', type=float, default=None,
+                                help='Start of the sensor time range. Unit: seconds. Default: unbounded.')
+    source_options.add_argument('--to', dest='t_to', type=float, default=None,
+                                help='End of the sensor time range. Unit: seconds. Default: unbounded.')
+    source_options.add_argument('--id', dest='object_id', type=int, default=None,
+                                help='Object ID to analyse. Default: at each update, the ID seen the most so far.')
+
+
+def file_paths_from_args(args):
+    """
+    Files of the source options of add_source_arguments(): the paths and the files selected in the catalog.
+    Exits if there is none.
+    """
+    paths = list(args.paths)
+    if args.catalog:
+        if not os.path.isfile(args.catalog):
+            print('No catalog at ' + args.catalog)
+            exit(1)
+        from evk_tracking.catalog import RunCatalog
+        t_from = args.t_from * 1e6 if args.t_from is not None else None
+        t_to = args.t_to * 1e6 if args.t_to is not None else None
+        with RunCatalog(args.catalog) as catalog:
+            paths += [segment['path'] for segment in catalog.segments(t_from=t_from, t_to=t_to, run=args.run, cycle=args.cycle)]
+    if not paths:
+        print('No results to analyse: give files, --catalog or -rb.')
+        exit(1)
+    return paths
+
+
+def results_from_args(args, columns=('t', 'x', 'y', 'object_id')):
+    """
+    Results stream ((new_run, rows), see the top of this file) of the source options of add_source_arguments().
+    Exits if there is no source.
+    """
+    if args.results_ring:
+        return ring_results(args.results_ring, columns, args.idle_timeout)
+    t_from = args.t_from * 1e6 if args.t_from is not None else None
+    t_to = args.t_to * 1e6 if args.t_to is not None else None
+    return file_results(file_paths_from_args(args), columns, t_from, t_to)
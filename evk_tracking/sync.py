@@ -0,0 +1,215 @@
+"""
+Synchronization between the instrument commands and the camera timestamps.
+
+- CommandLog is used by the script driving the instruments (EVKbiasesOptimization.py). Every command sent
+  is appended to a CSV file with the host monotonic clock (time.monotonic_ns(), shared by all the processes
+  of the machine) just before and just after it was sent.
+- TrackerSync is used by the tracking scripts (-sync [command log path]). It estimates the offset between the
+  host monotonic clock and the camera clock, collects the external trigger events of the camera (trigger-in,
+  e.g. the sync output of the DS335) and writes next to each saved EVK_[timestamp].csv an EVK_[timestamp].sync.json sidecar
+  with the clock offset, the triggers of that segment and the instrument commands sent since the previous
+  segment, in camera time. The commands of the first segment start [STARTUP_MARGIN] seconds before the tracker
+  process was started (so the command starting a Heat Engine cycle just before the recording is included, but
+  not the commands of the previous runs and sessions in the same command log).
+
+The camera time of a host time h is (h - offset_ns) / 1000, with offset_ns the smallest observed difference
+between the arrival time of a batch of events and the timestamp of its last event.
+"""
+
+import csv
+import json
+import os
+import time
+import datetime
+import numpy as np
+import psutil
+
+
+STARTUP_MARGIN = 2.  # s, see the top of this file
+COMMAND_LOG_FIELDS = ['host_ns_before', 'host_ns_after', 'wall_time', 'instrument', 'command', 'response', 'tag']
+
+
+class ClockSync:
+    """
+    Estimates the offset between the host monotonic clock (ns) and the camera clock (us).
+    """
+    def __init__(self):
+        self.offset_ns = None
+
+    def on_events(self, evs, host_ns=None):
+        """
+        To be called as soon as a batch of events comes out of the events iterator.
+        """
+        if len(evs) == 0:
+            return
+        if host_ns is None:
+            host_ns = time.monotonic_ns()
+        offset = host_ns - int(evs['t'][-1]) * 1000
+        if self.offset_ns is None or offset < self.offset_ns:
+            self.offset_ns = offset
+
+    def to_camera_us(self, host_ns):
+        if self.offset_ns is None:
+            return None
+        return (host_ns - self.offset_ns) / 1000
+
+    def to_host_ns(self, camera_us):
+        if self.offset_ns is None:
+            return None
+        return int(camera_us * 1000) + self.offset_ns
+
+
+class CommandLog:
+    """
+    Appends every instrument command to a CSV file, see the top of this file.
+    """
+    def __init__(self, path):
+        self.path = path
+        new_file = not os.path.isfile(path)
+        self.file = open(path, 'a')
+        self.writer = csv.writer(self.file, delimiter=',', lineterminator='\n')
+        if new_file:
+            self.writer.writerow(COMMAND_LOG_FIELDS)
+        self.tag = ''
+
+    def log(self, instrument, command, host_ns_before, host_ns_after, response=None):
+        wall_time = datetime.datetime.now().strftime('%Y%m%d_%H-%M-%S.%f')
+        self.writer.writerow([host_ns_before, host_ns_after, wall_time, instrument, command,
+                              '' if response is None else response, self.tag])
+        self.file.flush()
+
+    def wrap(self, device, name):
+        """
+        Returns a proxy of the device whose sendCmd/query calls are logged.
+        """
+        return _LoggedDevice(device, name, self)
+
+    def close(self):
+        self.file.close()
+
+
+class _LoggedDevice:
+    def __init__(self, device, name, command_log):
+        self._device = device
+        self._name = name
+        self._log = command_log
+
+    def sendCmd(self, cmd):
+        before = time.monotonic_ns()
+        response = self._device.sendCmd(cmd)
+        self._log.log(self._name, cmd, before, time.monotonic_ns(), response)
+        return response
+
+    def query(self, cmd):
+        before = time.monotonic_ns()
+        response = self._device.query(cmd)
+        self._log.log(self._name, cmd, before, time.monotonic_ns(), response)
+        return response
+
+    def __getattr__(self, name):
+        return getattr(self._device, name)
+
+
+def process_start_ns():
+    """
+    Host monotonic time (ns) at which the current process was started.
+    """
+    age = time.time() - psutil.Process().create_time()
+    return time.monotonic_ns() - int(age * 1e9)
+
+
+def read_command_log(path, host_ns_from=None, host_ns_to=None):
+    """
+    Helper function to read the commands of a CommandLog file, optionally within a host time range.
+    """
+    commands = []
+    if not os.path.isfile(path):
+        return commands
+    with open(path, 'r') as log_file:
+        for row in csv.DictReader(log_file):
+            row['host_ns_before'] = int(row['host_ns_before'])
+            row['host_ns_after'] = int(row['host_ns_after'])
+            if host_ns_from is not None and row['host_ns_after'] < host_ns_from:
+                continue
+            if host_ns_to is not None and row['host_ns_before'] > host_ns_to:
+                continue
+            commands.append(row)
+    return commands
+
+
+class TrackerSync:
+    """
+    Clock offset, external triggers and sidecar files of the tracking scripts, see the top of this file.
+    """
+    def __init__(self, mv_iterator, command_log_path='', trigger_channel=-1, live=False):
+        # The reader is looked up at every batch: a CameraSession opens a new one after a recovery, and keeping it
+        # here would keep the old device open
+        self.events_source = mv_iterator
+        self.command_log_path = command_log_path
+        self.clock = ClockSync()
+        self.triggers = []
+        self.live = live
+        self.last_host_ns_end = process_start_ns() - int(STARTUP_MARGIN * 1e9)
+        if live and trigger_channel >= 0:
+            i_trigger_in = self.reader.device.get_i_trigger_in()
+            if i_trigger_in is None:
+                print('The camera has no trigger-in interface, only the host clock is used for synchronization.')
+            else:
+                i_trigger_in.enable(trigger_channel)
+                print(f'Trigger-in enabled on channel {trigger_channel}')
+
+    @property
+    def reader(self):
+        return getattr(self.events_source, 'reader', None)
+
+    def on_events(self, evs):
+        """
+        To be called for every batch of events coming out of the events iterator.
+        """
+        # The host clock only says something about the camera clock for a live stream
+        if self.live:
+            self.clock.on_events(evs)
+        reader = self.reader
+        if reader is None:
+            return
+        try:
+            triggers = reader.get_ext_trigger_events()
+        except AttributeError:
+            self.events_source = None
+            return
+        if len(triggers) > 0:
+            self.triggers.append(np.array(triggers))
+            reader.clear_ext_trigger_events()
+
+    def write_sidecar(self, csv_path, t_start, t_end):
+        """
+        Writes the .sync.json sidecar of csv_path for the segment [t_start, t_end] (camera time, us).
+        """
+        triggers = []
+        if self.triggers:
+            all_triggers = np.concatenate(self.triggers)
+            in_segment = (all_triggers['t'] >= t_start) & (all_triggers['t'] <= t_end)
+            triggers = [{'t': int(tr['t']), 'p': int(tr['p']), 'id': int(tr['id'])} for tr in all_triggers[in_segment]]
+            # Older triggers are not needed for the next segments
+            self.triggers = [all_triggers[all_triggers['t'] > t_end]]
+
+        commands = []
+        if self.command_log_path and self.clock.offset_ns is not None:
+            host_ns_end = self.clock.to_host_ns(t_end)
+            for row in read_command_log(self.command_log_path, self.last_host_ns_end, host_ns_end):
+                row['t_before'] = self.clock.to_camera_us(row['host_ns_before'])
+                row['t_after'] = self.clock.to_camera_us(row['host_ns_after'])
+                commands.append(row)
+            self.last_host_ns_end = host_ns_end
+
+        sync = {
+            't_start': int(t_start),
+            't_end': int(t_end),
+            'host_ns_start': self.clock.to_host_ns(t_start),
+            'host_ns_end': self.clock.to_host_ns(t_end),
+            'clock_offset_ns': self.clock.offset_ns,
+            'triggers': triggers,
+            'commands': commands,
+        }
+        with open(os.path.splitext(csv_path)[0] + '.sync.json', 'w') as sync_file:
+            json.dump(sync, sync_file, indent=1)
@@ -0,0 +1,384 @@
+"""
+Streaming analysis of telegraph noise: the particle jumps between two positions (states), and the statistics of
+interest are the dwell times in each state and the switching rates.
+
+The positions (one per update time, see TrackSelector in streams.py) are projected on the axis of the jumps:
+x, y, or with axis auto the principal axis of the first [warmup] positions. The two states are then found with
+- hysteresis (default): the state becomes 1 above the high threshold and 0 below the low threshold, and does not
+  change in between, so the noise around one threshold does not create switches;
+- hmm: a two-state Gaussian hidden Markov model, filtered causally (the state of a sample only depends on the
+  samples before it). The forward recursion is computed for a whole chunk at once as a prefix product of 2x2
+  matrices (log2(chunk size) vectorized steps) instead of a loop over the samples.
+Without thresholds, the two state positions are found in the warmup positions (two clusters), and the thresholds
+are put at [hysteresis] times the half distance between them, around the middle. The HMM parameters (means,
+noise, switching probabilities) also come from the warmup.
+
+Dwell times are accumulated in fixed log-spaced histograms, so the memory does not grow with the duration.
+A dwell is only counted when both of its switches are seen: the dwells cut by the start of the stream, by a
+gap in the positions longer than [max_gap] (missing time stamps, lost track) or by the start of another run are
+counted as censored.
+
+    python3 -m evk_tracking.telegraph EVK_*.evkt -o run3
+    python3 -m evk_tracking.telegraph --catalog [saving_location]catalog.sqlite --cycle telegraph --method hmm
+    python3 -m evk_tracking.telegraph -rb /dev/shm/evk_results --report 10
+"""
+
+import json
+import time
+import numpy as np
+
+
+STATES = 2
+UNKNOWN = -1
+
+
+def dwell_bin_edges(dwell_min=1, dwell_max=1e9, bins_per_decade=10):
+    """
+    Log-spaced edges of the dwell histograms (us).
+    """
+    decades = np.log10(dwell_max) - np.log10(dwell_min)
+    return np.logspace(np.log10(dwell_min), np.log10(dwell_max), int(round(decades * bins_per_decade)) + 1)
+
+
+def two_clusters(values, iterations=50):
+    """
+    Means and pooled standard deviation of the two clusters of values (1D k-means), lower mean first.
+    """
+    means = np.percentile(values, [10, 90]).astype(float)
+    for _ in range(iterations):
+        upper = values > means.mean()
+        if upper.all() or not upper.any():
+            break
+        new_means = np.array([values[~upper].mean(), values[upper].mean()])
+        if np.allclose(new_means, means):
+            break
+        means = new_means
+    upper = values > means.mean()
+    residuals = values - np.where(upper, means[1], means[0])
+    return means, max(float(residuals.std()), 1e-9)
+
+
+def hysteresis_states(s, low, high, state=UNKNOWN):
+    """
+    States of the samples s: 1 above high, 0 below low, else the previous state (state before the first sample).
+    """
+    decided = np.where(s > high, 1, np.where(s < low, 0, UNKNOWN))
+    last = np.where(decided != UNKNOWN, np.arange(len(s)), -1)
+    last = np.maximum.accumulate(last)
+    return np.where(last >= 0, decided[np.maximum(last, 0)], state)
+
+
+class TwoStateHMM:
+    """
+    Causal filter of a two-state Gaussian HMM: means[i], common sigma, p_switch[i] probability to leave state i
+    between two samples. filter() returns the most likely state of each sample given the samples before it.
+    """
+    def __init__(self, means, sigma, p_switch):
+        self.means = np.asarray(means, dtype=float)
+        self.sigma = float(sigma)
+        p = np.clip(np.asarray(p_switch, dtype=float), 1e-9, 0.5)
+        # transition[i, j]: probability to go from state i to state j
+        self.transition = np.array([[1 - p[0], p[0]], [p[1], 1 - p[1]]])
+        self.alpha = np.full(STATES, 1 / STATES)
+
+    def filter(self, s):
+        log_likelihood = -0.5 * ((s[:, None] - self.means[None, :]) / self.sigma) ** 2
+        emission = np.exp(log_likelihood - log_likelihood.max(axis=1, keepdims=True))
+        # alpha_t = diag(e_t) . T' . alpha_{t-1}: M_t = diag(e_t) . T', and alpha_t ~ M_t ... M_1 . alpha_0
+        products = emission[:, :, None] * self.transition.T[None, :, :]
+        step = 1
+        while step < len(s):
+            combined = products.copy()
+            combined[step:] = np.matmul(products[step:], products[:-step])
+            combined /= combined.sum(axis=(1, 2), keepdims=True)
+            products = combined
+            step *= 2
+        alpha = np.matmul(products, self.alpha)
+        alpha /= alpha.sum(axis=1, keepdims=True)
+        self.alpha = alpha[-1]
+        return np.argmax(alpha, axis=1)
+
+
+class TelegraphAnalyzer:
+    """
+    Two-state switching analysis of a stream of positions, see the top of this file. add() takes chunks of
+    records with t, x and y (one per update time); summary() gives the statistics so far.
+    axis: 'x', 'y' or 'auto'; low/high: thresholds on the projected position (pixels; with axis auto, relative
+    to the center of the warmup positions), found in the warmup if None; method: 'hysteresis' or 'hmm';
+    max_gap: longest time between positions inside a dwell (us, None = no limit).
+    """
+    def __init__(self, axis='auto', low=None, high=None, hysteresis=0.5, method='hysteresis', warmup=5000,
+                 max_gap=None, edges=None):
+        if method not in ('hysteresis', 'hmm'):
+            raise ValueError(f'Unknown method: {method}')
+        self.axis = axis
+        self.low = low
+        self.high = high
+        self.hysteresis = hysteresis
+        self.method = method
+        self.warmup = warmup
+        self.max_gap = max_gap
+        self.edges = dwell_bin_edges() if edges is None else np.asarray(edges)
+        self.histograms = np.zeros((STATES, len(self.edges) - 1), dtype=np.int64)
+        self.dwell_sum = np.zeros(STATES)
+        self.dwell_count = np.zeros(STATES, dtype=np.int64)
+        self.censored = np.zeros(STATES, dtype=np.int64)
+        self.switches = np.zeros((STATES, STATES), dtype=np.int64)
+        self.time_in_state = np.zeros(STATES)
+        self.samples = 0
+        self.gaps = 0
+        self.center = np.zeros(2)
+        self.direction = None
+        self.means = None
+        self.sigma = None
+        self.hmm = None
+        self.pending = []
+        self.pending_samples = 0
+        self.state = UNKNOWN
+        self.t_enter = None
+        self.entered_seen = False  # The switch into the current state was seen
+        self.t_last = None
+
+    def add(self, records):
+        if len(records) == 0:
+            return
+        t = np.asarray(records['t'], dtype=np.int64)
+        xy = np.stack((records['x'], records['y']), axis=1).astype(float)
+        if self.direction is None:
+            self.pending.append((t, xy))
+            self.pending_samples += len(t)
+            if self.pending_samples >= self.warmup:
+                self._end_warmup()
+            return
+        self._process(t, (xy - self.center) @ self.direction)
+
+    def restart(self):
+        """
+        The next positions come from another run (its sensor clock starts again): cuts the dwell in progress as
+        a gap does.
+        """
+        if self.direction is None:
+            self.pending.append(None)  # The warmup positions of each run are processed separately
+            return
+        self._break()
+        self.t_last = None
+
+    def finish(self):
+        """
+        Analyses the positions kept for the warmup if the stream ended before the warmup was complete.
+        """
+        if self.direction is None and self.pending_samples > 1:
+            self._end_warmup()
+
+    def _end_warmup(self):
+        pending = self.pending
+        self.pending, self.pending_samples = [], 0
+        self._calibrate(np.concatenate([chunk[1] for chunk in pending if chunk is not None]))
+        for chunk in pending:
+            if chunk is None:
+                self.restart()
+            else:
+                self._process(chunk[0], (chunk[1] - self.center) @ self.direction)
+
+    def _calibrate(self, xy):
+        if self.axis == 'x':
+            self.direction = np.array([1.0, 0.0])
+        elif self.axis == 'y':
+            self.direction = np.array([0.0, 1.0])
+        else:
+            self.center = xy.mean(axis=0)
+            eigenvalues, eigenvectors = np.linalg.eigh(np.cov((xy - self.center).T))
+            self.direction = eigenvectors[:, np.argmax(eigenvalues)]
+            if self.direction[np.argmax(np.abs(self.direction))] < 0:
+                self.direction = -self.direction  # State 1 towards increasing x (or y)
+        s = (xy - self.center) @ self.direction
+        self.means, self.sigma = two_clusters(s)
+        middle, half = self.means.mean(), (self.means[1] - self.means[0]) / 2
+        if self.low is None:
+            self.low = middle - self.hysteresis * half
+        if self.high is None:
+            self.high = middle + self.hysteresis * half
+        if self.method == 'hmm':
+            states = hysteresis_states(s, self.low, self.high)
+            p_switch = []
+            for state in range(STATES):
+                in_state = states[:-1] == state
+                left = np.count_nonzero(in_state & (states[1:] != state))
+                p_switch.append((left + 1) / (np.count_nonzero(in_state) + 2))
+            self.hmm = TwoStateHMM(self.means, self.sigma, p_switch)
+
+    def _process(self, t, s):
+        if self.t_last is not None:
+            keep = t > self.t_last
+            t, s = t[keep], s[keep]
+        if len(t) == 0:
+            return
+        previous_t = np.concatenate(([self.t_last if self.t_last is not None else t[0]], t[:-1]))
+        dt = t - previous_t
+        # Segments without gaps longer than max_gap
+        breaks = np.flatnonzero(dt > self.max_gap) if self.max_gap is not None else []
+        start = 0
+        for end in list(breaks) + [len(t)]:
+            if end > start:
+                self._process_segment(t[start:end], s[start:end], dt[start:end])
+            if end < len(t):
+                self._break()
+            start = end
+        self.samples += len(t)
+        self.t_last = int(t[-1])
+
+    def _break(self):
+        # The dwell in progress is cut by a gap (or the start): its length is unknown
+        if self.state != UNKNOWN:
+            self.censored[self.state] += 1
+            self.gaps += 1
+        self.state = UNKNOWN
+        self.t_enter = None
+        self.entered_seen = False
+        if self.hmm is not None:
+            self.hmm.alpha = np.full(STATES, 1 / STATES)
+
+    def _process_segment(self, t, s, dt):
+        if self.method == 'hmm':
+            states = self.hmm.filter(s)
+        else:
+            states = hysteresis_states(s, self.low, self.high, self.state)
+        previous = np.concatenate(([self.state], states[:-1]))
+        known = previous != UNKNOWN
+        # The first dt of a segment after a gap is not inside a dwell
+        np.add.at(self.time_in_state, previous[known], dt[known])
+        if self.state == UNKNOWN:
+            first = np.flatnonzero(states != UNKNOWN)
+            if len(first) == 0:
+                return
+            t, states = t[first[0]:], states[first[0]:]
+            self.t_enter = int(t[0])
+            self.entered_seen = False
+            self.state = int(states[0])
+            previous = np.concatenate(([self.state], states[:-1]))
+        switch = np.flatnonzero(states != previous)
+        if len(switch) == 0:
+            return
+        switch_t = t[switch]
+        from_state = previous[switch]
+        np.add.at(self.switches, (from_state, states[switch]), 1)
+        dwells = np.diff(np.concatenate(([self.t_enter], switch_t)))
+        complete = np.ones(len(dwells), dtype=bool)
+        if not self.entered_seen:
+            complete[0] = False
+            self.censored[from_state[0]] += 1
+        for state in range(STATES):
+            selected = complete & (from_state == state)
+            self.histograms[state] += np.histogram(dwells[selected], self.edges)[0]
+            self.dwell_sum[state] += dwells[selected].sum()
+            self.dwell_count[state] += np.count_nonzero(selected)
+        self.state = int(states[-1])
+        self.t_enter = int(switch_t[-1])
+        self.entered_seen = True
+
+    def summary(self):
+        """
+        Statistics so far: thresholds, state positions, dwell counts and means (us), switching rates (1/s), occupancy.
+        """
+        rates = [float(self.switches[i, 1 - i] / (self.time_in_state[i] * 1e-6)) if self.time_in_state[i] > 0 else None
+                 for i in range(STATES)]
+        total = self.time_in_state.sum()
+        return {
+            'method': self.method,
+            'samples': int(self.samples),
+            'direction': self.direction.tolist() if self.direction is not None else None,
+            'center': self.center.tolist(),
+            'state_positions': self.means.tolist() if self.means is not None else None,
+            'noise': self.sigma,
+            'separation': float((self.means[1] - self.means[0]) / self.sigma) if self.means is not None else None,
+            'thresholds': [float(self.low), float(self.high)] if self.low is not None else None,
+            'dwells': self.dwell_count.tolist(),
+            'censored_dwells': self.censored.tolist(),
+            'mean_dwell_us': [float(self.dwell_sum[i] / self.dwell_count[i]) if self.dwell_count[i] else None for i in range(STATES)],
+            'switches': int(self.switches[0, 1] + self.switches[1, 0]),
+            'switching_rates_hz': rates,
+            'occupancy': (self.time_in_state / total).tolist() if total > 0 else None,
+            'gaps': int(self.gaps),
+        }
+
+    def save(self, prefix):
+        """
+        Writes [prefix]_dwell.csv (bin edges in us, counts of state 0 and 1) and [prefix]_telegraph.json (summary).
+        Returns the two paths.
+        """
+        histogram_path = prefix + '_dwell.csv'
+        table = np.column_stack((self.edges[:-1], self.edges[1:], self.histograms.T))
+        np.savetxt(histogram_path, table, delimiter=',', fmt=['%.6g', '%.6g', '%d', '%d'],
+                   header='dwell_from_us,dwell_to_us,state_0,state_1', comments='')
+        summary_path = prefix + '_telegraph.json'
+        with open(summary_path, 'w') as summary_file:
+            json.dump(self.summary(), summary_file, indent=1)
+        return histogram_path, summary_path
+
+
+def print_summary(summary):
+    print(f"{summary['samples']} positions, {summary['switches']} switches, dwells {summary['dwells']} "
+          f"(censored {summary['censored_dwells']}), mean dwell {summary['mean_dwell_us']}us, "
+          f"rates {summary['switching_rates_hz']}Hz, occupancy {summary['occupancy']}")
+
+
+def parse_args():
+    import argparse
+    from evk_tracking.streams import add_source_arguments
+    """
+    Parse command line arguments.
+    """
+    parser = argparse.ArgumentParser(description='Telegraph noise analysis: two-state switching, dwell-time histograms and switching rates.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    add_source_arguments(parser)
+    analysis_options = parser.add_argument_group('Analysis options')
+    analysis_options.add_argument('--axis', dest='axis', type=str, default='auto', choices=['auto', 'x', 'y'],
+                                  help='Axis of the jumps. auto: principal axis of the warmup positions. Default: auto.')
+    analysis_options.add_argument('--method', dest='method', type=str, default='hysteresis', choices=['hysteresis', 'hmm'],
+                                  help='State detection: hysteresis thresholds, or two-state hidden Markov model. Default: hysteresis.')
+    analysis_options.add_argument('--low', dest='low', type=float, default=None,
+                                  help='Low threshold on the projected position. Unit: pixels. Default: from the warmup.')
+    analysis_options.add_argument('--high', dest='high', type=float, default=None,
+                                  help='High threshold on the projected position. Unit: pixels. Default: from the warmup.')
+    analysis_options.add_argument('--hysteresis', dest='hysteresis', type=float, default=0.5,
+                                  help='Distance of the thresholds from the middle of the two states, relative to half their distance. Default: 0.5.')
+    analysis_options.add_argument('--warmup', dest='warmup', type=int, default=5000,
+                                  help='Number of positions used to find the axis, the states and the thresholds. Default: 5000.')
+    analysis_options.add_argument('--max-gap', dest='max_gap', type=float, default=None,
+                                  help='Longest time without position inside a dwell; longer gaps cut the dwell. Unit: us. Default: None (no limit).')
+    analysis_options.add_argument('--report', dest='report', type=float, default=0,
+                                  help='Prints the statistics every [report] seconds (0: only at the end). Unit: seconds. Default: 0.')
+    analysis_options.add_argument('-o', '--output', dest='output', type=str, default='',
+                                  help='Prefix of the output files [prefix]_dwell.csv and [prefix]_telegraph.json. Default: \'\' (not saved).')
+    return parser.parse_args()
+
+
+def main():
+    """
+    Main
+    """
+    from evk_tracking.streams import TrackSelector, results_from_args
+    args = parse_args()
+    analyzer = TelegraphAnalyzer(args.axis, args.low, args.high, args.hysteresis, args.method, args.warmup, args.max_gap)
+    selector = TrackSelector(args.object_id)
+    last_report = time.monotonic()
+    try:
+        for new_run, records in results_from_args(args):
+            if new_run:
+                selector.reset()
+                analyzer.restart()
+            analyzer.add(selector.select(records))
+            if args.report and time.monotonic() - last_report >= args.report and analyzer.direction is not None:
+                print_summary(analyzer.summary())
+                last_report = time.monotonic()
+    except KeyboardInterrupt:
+        pass
+    analyzer.finish()
+    summary = analyzer.summary()
+    print(json.dumps(summary, indent=1))
+    if args.output:
+        print('Saved at ' + ', '.join(analyzer.save(args.output)))
+
+
+if __name__ == "__main__":
+        main()
@@ -0,0 +1,404 @@
+"""
+Columnar trajectory archives (.evkt) and a chunked query engine over them, so an analysis reads only the columns,
+time ranges and objects it needs instead of loading every column of every CSV file and then keeping ID == idMode.
+
+A trajectory file holds the rows of a tracker output file (the CSV columns, see RESULT_DTYPE, plus vx and vy with
+-vel) in chunks of [chunk_rows] rows. Each column of a chunk is compressed separately (zlib), and the index at the
+end of the file gives, for every chunk and column, the position of the block, its crc32 and the min/max of the
+column in the chunk. A query reads the index, skips the chunks whose min/max cannot match the predicates (time
+range, object IDs, value ranges), reads the predicate columns of the remaining chunks, and the projected columns
+only of the chunks where rows match.
+
+Layout (little-endian):
+    header:  magic b'EVKTRAJ1', uint32 metadata size, metadata (JSON: dtype, chunk_rows, source...)
+    chunks:  the compressed column blocks of each chunk, one after the other
+    index:   zlib of the index records (INDEX_FIELDS for every column: offset, size, crc32, min, max)
+    end:     uint64 index offset, uint32 index size, uint64 rows, magic b'EVKTEND1'
+
+The trackers write them with -sfmt evkt. Query from a script:
+    for chunk in query(paths, columns=('t', 'x', 'y'), t_from=10e6, t_to=20e6, object_id=dominant_object(paths)):
+        ...
+or from the command line (the files can be selected in the catalog, see catalog.py):
+    python3 -m evk_tracking.trajectory EVK_*.evkt -c t,x,y --from 10 --to 20 --id dominant -o positions.csv
+    python3 -m evk_tracking.trajectory --catalog [saving_location]catalog.sqlite --cycle low_drive -c t,x,y --id 3
+"""
+
+import json
+import os
+import struct
+import zlib
+import numpy as np
+
+from evk_tracking.pipeline import RESULT_DTYPE
+
+
+MAGIC = b'EVKTRAJ1'
+END_MAGIC = b'EVKTEND1'
+END_FORMAT = '<QIQ8s'
+END_SIZE = struct.calcsize(END_FORMAT)
+VELOCITY_DTYPE = np.dtype(RESULT_DTYPE.descr + [('vx', '<f8'), ('vy', '<f8')])
+# Per column and chunk; the min/max are stored as float64 (exact for timestamps and IDs below 2**53)
+INDEX_FIELDS = [('offset', '<u8'), ('size', '<u4'), ('crc', '<u4'), ('min', '<f8'), ('max', '<f8')]
+# Small enough that the min/max of the chunks prune inside a -csvn segment, not only between files
+CHUNK_ROWS = 1 << 12
+
+
+def trajectory_dtype(velocity=False):
+    """
+    Columns of the tracker output files: RESULT_DTYPE, with vx and vy when the velocity is computed (-vel).
+    """
+    return VELOCITY_DTYPE if velocity else RESULT_DTYPE
+
+
+def _index_dtype(names):
+    return np.dtype([('rows', '<u4')] + [(name, INDEX_FIELDS) for name in names])
+
+
+class TrajectoryWriter:
+    """
+    Writes a .evkt file, see the top of this file. write() takes structured arrays (or lists of tuples in the
+    column order of dtype) and writes a chunk every chunk_rows rows; close() writes the index.
+    """
+    def __init__(self, path, dtype=RESULT_DTYPE, metadata=None, chunk_rows=CHUNK_ROWS, level=1):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.chunk_rows = chunk_rows
+        self.level = level
+        self.rows = 0
+        self.t_first = self.t_last = None
+        self.pending = []
+        self.pending_rows = 0
+        self.index = []
+        self.file = open(path, 'wb')
+        metadata = dict(metadata or {}, dtype=self.dtype.descr, chunk_rows=chunk_rows)
+        metadata_bytes = json.dumps(metadata).encode()
+        self.file.write(MAGIC + struct.pack('<I', len(metadata_bytes)) + metadata_bytes)
+
+    def write(self, records):
+        if len(records) == 0:
+            return
+        if isinstance(records, np.ndarray) and records.dtype.names:
+            converted = np.empty(len(records), dtype=self.dtype)
+            for name in self.dtype.names:
+                converted[name] = records[name]
+            records = converted
+        else:
+            records = np.array([tuple(row) for row in records], dtype=self.dtype)
+        self.pending.append(records)
+        self.pending_rows += len(records)
+        while self.pending_rows >= self.chunk_rows:
+            records = np.concatenate(self.pending)
+            self._write_chunk(records[:self.chunk_rows])
+            self.pending = [records[self.chunk_rows:]]
+            self.pending_rows = len(self.pending[0])
+
+    def _write_chunk(self, records):
+        entry = [len(records)]
+        for name in self.dtype.names:
+            column = np.ascontiguousarray(records[name])
+            block = zlib.compress(column.tobytes(), self.level)
+            entry.append((self.file.tell(), len(block), zlib.crc32(block), column.min(), column.max()))
+            self.file.write(block)
+        self.index.append(tuple(entry))
+        if self.t_first is None:
+            self.t_first = int(records['t'][0])
+        self.t_last = int(records['t'][-1])
+        self.rows += len(records)
+
+    def close(self):
+        """
+        Writes the last chunk and the index. Returns the number of rows.
+        """
+        if self.pending_rows:
+            self._write_chunk(np.concatenate(self.pending))
+            self.pending, self.pending_rows = [], 0
+        index = zlib.compress(np.array(self.index, dtype=_index_dtype(self.dtype.names)).tobytes(), self.level)
+        index_offset = self.file.tell()
+        self.file.write(index)
+        self.file.write(struct.pack(END_FORMAT, index_offset, len(index), self.rows, END_MAGIC))
+        self.file.close()
+        return self.rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class TrajectoryReader:
+    """
+    Reads a .evkt file: metadata and dtype from the header, index (one record per chunk: rows, and offset, size,
+    crc, min and max of every column) and rows from the end. bytes_read counts the bytes read from the file, and
+    chunks_read the chunks of which at least one column was read.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as trajectory_file:
+            if trajectory_file.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f'{path} is not a .evkt trajectory file.')
+            size, = struct.unpack('<I', trajectory_file.read(4))
+            self.metadata = json.loads(trajectory_file.read(size))
+            trajectory_file.seek(-END_SIZE, os.SEEK_END)
+            index_offset, index_size, self.rows, end_magic = struct.unpack(END_FORMAT, trajectory_file.read(END_SIZE))
+            if end_magic != END_MAGIC:
+                raise ValueError(f'{path}: no index, the file was not closed.')
+            trajectory_file.seek(index_offset)
+            index = zlib.decompress(trajectory_file.read(index_size))
+        self.dtype = np.dtype([tuple(field) for field in self.metadata['dtype']])
+        self.index = np.frombuffer(index, dtype=_index_dtype(self.dtype.names))
+        self.bytes_read = len(MAGIC) + 4 + size + END_SIZE + index_size
+        self.chunks_read = set()
+        self.file = None
+
+    @property
+    def t_first(self):
+        return int(self.index['t']['min'].min()) if len(self.index) else None
+
+    @property
+    def t_last(self):
+        return int(self.index['t']['max'].max()) if len(self.index) else None
+
+    def read_column(self, chunk, name):
+        """
+        Column name of chunk number chunk (numpy array).
+        """
+        if self.file is None:
+            self.file = open(self.path, 'rb')
+        block = self.index[chunk][name]
+        self.file.seek(int(block['offset']))
+        data = self.file.read(int(block['size']))
+        self.bytes_read += len(data)
+        self.chunks_read.add(chunk)
+        if zlib.crc32(data) != block['crc']:
+            raise ValueError(f'{self.path}: checksum error in column {name} of chunk {chunk}.')
+        return np.frombuffer(zlib.decompress(data), dtype=self.dtype[name], count=int(self.index[chunk]['rows']))
+
+    def candidate_chunks(self, t_from=None, t_to=None, object_id=None, ranges=None):
+        """
+        Numbers of the chunks whose min/max statistics do not exclude rows matching the predicates (see query()).
+        """
+        keep = np.ones(len(self.index), dtype=bool)
+        for name, (low, high) in _predicate_ranges(t_from, t_to, ranges).items():
+            if low is not None:
+                keep &= self.index[name]['max'] >= low
+            if high is not None:
+                keep &= self.index[name]['min'] <= high
+        if object_id is not None:
+            ids = np.unique(np.atleast_1d(object_id).astype(np.float64))
+            lower = np.searchsorted(ids, self.index['object_id']['min'], side='left')
+            upper = np.searchsorted(ids, self.index['object_id']['max'], side='right')
+            keep &= upper > lower  # At least one of the IDs inside [min, max] of the chunk
+        return np.flatnonzero(keep)
+
+    def query(self, columns=None, t_from=None, t_to=None, object_id=None, ranges=None):
+        """
+        Yields, for every chunk with matching rows, the matching rows as a structured array of the columns.
+        """
+        columns = list(columns) if columns else list(self.dtype.names)
+        unknown = [name for name in columns + list(ranges or {}) if name not in self.dtype.names]
+        if unknown:
+            raise ValueError(f'{self.path}: unknown columns {unknown}, the file has {list(self.dtype.names)}.')
+        predicates = _predicate_ranges(t_from, t_to, ranges)
+        if object_id is not None:
+            object_id = np.unique(np.atleast_1d(object_id).astype(np.uint64))
+        for chunk in self.candidate_chunks(t_from, t_to, object_id, ranges):
+            read = {}
+            mask = None
+            for name, (low, high) in predicates.items():
+                column = read[name] = self.read_column(chunk, name)
+                condition = np.ones(len(column), dtype=bool)
+                if low is not None:
+                    condition &= column >= low
+                if high is not None:
+                    condition &= column <= high
+                mask = condition if mask is None else mask & condition
+            if object_id is not None:
+                column = read['object_id'] = self.read_column(chunk, 'object_id')
+                condition = np.isin(column, object_id)
+                mask = condition if mask is None else mask & condition
+            if mask is not None and not mask.any():
+                continue
+            out = np.empty(int(self.index[chunk]['rows']) if mask is None else int(mask.sum()),
+                           dtype=[(name, self.dtype[name]) for name in columns])
+            for name in columns:
+                column = read[name] if name in read else self.read_column(chunk, name)
+                out[name] = column if mask is None else column[mask]
+            yield out
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def _predicate_ranges(t_from, t_to, ranges):
+    predicates = dict(ranges or {})
+    if t_from is not None or t_to is not None:
+        predicates['t'] = (t_from, t_to)
+    return predicates
+
+
+def query(paths, columns=None, t_from=None, t_to=None, object_id=None, ranges=None, stats=None):
+    """
+    Iterator over the rows of .evkt files matching the predicates, chunk by chunk (structured arrays).
+    columns: projected columns (None = all); t_from, t_to: time range (us, inclusive, None = unbounded);
+    object_id: an object ID or a list of IDs; ranges: {column: (min, max)} for other columns.
+    Only the chunks whose statistics allow a match are read, and only their needed columns.
+    stats: optional dictionary, filled with the files, chunks (total, read), rows and bytes (file sizes, read).
+    """
+    if isinstance(paths, str):
+        paths = [paths]
+    if stats is not None:
+        stats.update(files=0, chunks=0, chunks_read=0, rows=0, bytes=0, bytes_read=0)
+    for path in paths:
+        with TrajectoryReader(path) as reader:
+            try:
+                for chunk in reader.query(columns, t_from, t_to, object_id, ranges):
+                    if stats is not None:
+                        stats['rows'] += len(chunk)
+                    yield chunk
+            finally:
+                if stats is not None:
+                    stats['files'] += 1
+                    stats['chunks'] += len(reader.index)
+                    stats['chunks_read'] += len(reader.chunks_read)
+                    stats['bytes'] += os.path.getsize(path)
+                    stats['bytes_read'] += reader.bytes_read
+
+
+def read(paths, columns=None, t_from=None, t_to=None, object_id=None, ranges=None):
+    """
+    Same as query(), with the matching rows of all the files in one structured array.
+    """
+    chunks = list(query(paths, columns, t_from, t_to, object_id, ranges))
+    if chunks:
+        return np.concatenate(chunks)
+    dtype = TrajectoryReader(paths if isinstance(paths, str) else paths[0]).dtype if paths else RESULT_DTYPE
+    return np.empty(0, dtype=[(name, dtype[name]) for name in (columns or dtype.names)])
+
+
+def object_counts(paths, t_from=None, t_to=None):
+    """
+    Number of rows of every object ID in the files (only the object_id column, and t for a time range, are read).
+    """
+    counts = {}
+    for chunk in query(paths, columns=('object_id',), t_from=t_from, t_to=t_to):
+        ids, n = np.unique(chunk['object_id'], return_counts=True)
+        for object_id, count in zip(ids.tolist(), n.tolist()):
+            counts[object_id] = counts.get(object_id, 0) + count
+    return counts
+
+
+def dominant_object(paths, t_from=None, t_to=None):
+    """
+    Object ID with the most rows (idMode of the MATLAB scripts), None if there are no rows.
+    """
+    counts = object_counts(paths, t_from, t_to)
+    return max(counts, key=counts.get) if counts else None
+
+
+def catalog_paths(catalog_path, t_from=None, t_to=None, **where):
+    """
+    Paths of the .evkt files of the catalog overlapping [t_from, t_to] (us) with the columns of where (see catalog.py).
+    """
+    from evk_tracking.catalog import RunCatalog
+    with RunCatalog(catalog_path) as catalog:
+        return [segment['path'] for segment in catalog.segments(t_from=t_from, t_to=t_to, kind='evkt', **where)]
+
+
+def save_results(file_base, results, save_format='csv', velocity=False, metadata=None):
+    """
+    Saves a segment of tracking results (rows in the CSV column order, or RESULT_DTYPE records) as
+    [file_base].csv or [file_base].evkt. Returns the path.
+    """
+    import csv
+    if save_format == 'evkt':
+        path = file_base + '.evkt'
+        with TrajectoryWriter(path, trajectory_dtype(velocity), metadata) as writer:
+            writer.write(results)
+        return path
+    path = file_base + '.csv'
+    with open(path, 'w') as new_file:
+        writer = csv.writer(new_file, delimiter=',', lineterminator='\n')
+        writer.writerows(results.tolist() if isinstance(results, np.ndarray) else results)
+    return path
+
+
+def parse_args():
+    import argparse
+    """
+    Parse command line arguments.
+    """
+    parser = argparse.ArgumentParser(description='Queries .evkt trajectory files: projected columns of the rows in a time range and of some objects.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('paths', nargs='*', help='.evkt files.')
+    parser.add_argument('--catalog', dest='catalog', type=str, default='',
+                        help='Catalog (see catalog.py) where the .evkt files overlapping the time range are selected, with --run and --cycle. Default: \'\'.')
+    parser.add_argument('--run', dest='run', type=int, nargs='+', default=None, help='Run numbers (with --catalog). Default: all.')
+    parser.add_argument('--cycle', dest='cycle', type=str, nargs='+', default=None, help='Cycle names (with --catalog). Default: all.')
+    parser.add_argument('-c', '--columns', dest='columns', type=str, default='',
+                        help='Comma-separated columns to read, e.g. t,x,y. Default: all.')
+    parser.add_argument('--from', dest='t_from', type=float, default=None,
+                        help='Start of the sensor time range. Unit: seconds. Default: unbounded.')
+    parser.add_argument('--to', dest='t_to', type=float, default=None,
+                        help='End of the sensor time range. Unit: seconds. Default: unbounded.')
+    parser.add_argument('--id', dest='object_id', type=str, default='',
+                        help='Comma-separated object IDs, or dominant for the ID with the most rows in the time range. Default: all.')
+    parser.add_argument('-o', '--output', dest='output', type=str, default='',
+                        help='CSV file where the rows are written. If not specified, only the numbers of rows and bytes read are printed. Default: \'\'.')
+    return parser.parse_args()
+
+
+def main():
+    """
+    Main
+    """
+    args = parse_args()
+    t_from = args.t_from * 1e6 if args.t_from is not None else None
+    t_to = args.t_to * 1e6 if args.t_to is not None else None
+    paths = list(args.paths)
+    if args.catalog:
+        if not os.path.isfile(args.catalog):
+            print('No catalog at ' + args.catalog)
+            exit(1)
+        paths += catalog_paths(args.catalog, t_from, t_to, run=args.run, cycle=args.cycle)
+    if not paths:
+        print('No trajectory files to query.')
+        exit(1)
+
+    object_id = None
+    if args.object_id == 'dominant':
+        object_id = dominant_object(paths, t_from, t_to)
+        print(f'Dominant object ID: {object_id}')
+    elif args.object_id:
+        object_id = [int(value) for value in args.object_id.split(',')]
+    columns = args.columns.split(',') if args.columns else None
+
+    stats = {}
+    output_file = writer = None
+    if args.output:
+        import csv
+        output_file = open(args.output, 'w')
+        writer = csv.writer(output_file, delimiter=',', lineterminator='\n')
+    try:
+        for chunk in query(paths, columns, t_from, t_to, object_id, stats=stats):
+            if writer is not None:
+                writer.writerows(chunk.tolist())
+    finally:
+        if output_file is not None:
+            output_file.close()
+    print(f"{stats['rows']} rows from {stats['files']} files, {stats['chunks_read']}/{stats['chunks']} chunks, "
+          f"{stats['bytes_read'] / 1e6:.2f}MB read of {stats['bytes'] / 1e6:.2f}MB")
+    if args.output:
+        print('Rows saved at ' + args.output)
+
+
+if __name__ == "__main__":
+        main()
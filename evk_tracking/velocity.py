@@ -0,0 +1,107 @@
+"""
+Velocity of the tracked objects from the event timestamps (time surface), instead of differencing their positions.
+
+The edge of a moving object fires the pixels it crosses one after the other: around the object, the timestamps
+of the last [window] us of events lie on a plane t = a*x + b*y + c whose gradient (a, b) (us/pixel) is the
+inverse of the velocity: v = (a, b) / (a^2 + b^2). At each tracking update the plane is fitted by least squares
+to the events inside the bounding box of every object (plus [margin] pixels), all the objects at once: the
+moments of the events are one matrix product between the (objects x events) box masks and the event features.
+The leading edge (e.g. positive events) and the trailing edge (negative events) of the object fire at different
+times, so each polarity has its own plane; the velocity is the average of the two fits weighted by their events.
+The window should be longer than the time the object takes to cross its bounding box (the events are then
+selected by position only, which keeps the fit unbiased), but shorter than the time between two passages of the
+object over the same pixels.
+
+The fit is rejected (velocity NaN) with fewer than [min_events] events, or when the plane explains less than
+[min_r2] of the variance of the timestamps, e.g. for a particle that does not move (the events inside its box
+come in random order and the fitted gradient means nothing).
+"""
+
+import numpy as np
+
+from evk_tracking.common import EVENT_DTYPE
+
+
+class VelocityEstimator:
+    def __init__(self, window=5000, min_events=20, min_r2=0.3, margin=2):
+        self.window = window
+        self.min_events = min_events
+        self.min_r2 = min_r2
+        self.margin = margin
+        self.batches = []
+
+    def add_events(self, evs):
+        """
+        Keeps a copy of the events given to the tracking algorithm (the buffers of the SDK are reused).
+        """
+        if len(evs) > 0:
+            self.batches.append(np.array(evs))
+
+    def recent_events(self, ts):
+        """
+        Events of (ts - window, ts]. The older batches are dropped.
+        """
+        t_min = ts - self.window
+        while self.batches and self.batches[0]['t'][-1] <= t_min:
+            self.batches.pop(0)
+        if not self.batches:
+            return np.empty(0, dtype=EVENT_DTYPE)
+        evs = np.concatenate(self.batches) if len(self.batches) > 1 else self.batches[0]
+        return evs[np.searchsorted(evs['t'], t_min, side='right'):np.searchsorted(evs['t'], ts, side='right')]
+
+    def estimate(self, ts, records):
+        """
+        records: tracking results of the update at ts, as RESULT_DTYPE records
+        (evk_tracking.pipeline.results_to_records); (x, y) is taken as the center of the width x height bounding box.
+        Returns an (objects, 2) array of the velocities (vx, vy) in pixels/s, NaN where no plane was fitted.
+        """
+        velocities = np.full((len(records), 2), np.nan)
+        evs = self.recent_events(ts)
+        if len(records) == 0 or len(evs) < self.min_events:
+            return velocities
+
+        x = evs['x'].astype(np.float64)
+        y = evs['y'].astype(np.float64)
+        t = (evs['t'] - ts).astype(np.float64)
+        half_width = np.asarray(records['width'], dtype=np.float64)[:, None] / 2 + self.margin
+        half_height = np.asarray(records['height'], dtype=np.float64)[:, None] / 2 + self.margin
+        inside = (np.abs(x - np.asarray(records['x'], dtype=np.float64)[:, None]) <= half_width) & \
+                 (np.abs(y - np.asarray(records['y'], dtype=np.float64)[:, None]) <= half_height)
+        features = np.stack((np.ones_like(x), x, y, t, x * x, x * y, y * y, x * t, y * t, t * t), axis=1)
+
+        # The leading and trailing edges (opposite polarities) lie on two different planes, fitted apart
+        total = np.zeros(len(records))
+        weighted = np.zeros((len(records), 2))
+        positive = evs['p'] > 0
+        for polarity in (positive, ~positive):
+            moments = (inside & polarity).astype(np.float64) @ features
+            velocity, valid = self._fit(moments)
+            weighted[valid] += velocity[valid] * moments[valid, :1]
+            total[valid] += moments[valid, 0]
+        found = total > 0
+        velocities[found] = weighted[found] / total[found, None]
+        return velocities
+
+    def _fit(self, moments):
+        """
+        Plane fit from the moments [1, x, y, t, xx, xy, yy, xt, yt, tt] of the events of each object.
+        Returns (velocities in pixels/s, valid).
+        """
+        n = moments[:, 0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mx, my, mt = (moments[:, 1:4] / n[:, None]).T
+            cxx = moments[:, 4] / n - mx * mx
+            cxy = moments[:, 5] / n - mx * my
+            cyy = moments[:, 6] / n - my * my
+            cxt = moments[:, 7] / n - mx * mt
+            cyt = moments[:, 8] / n - my * mt
+            ctt = moments[:, 9] / n - mt * mt
+
+            det = cxx * cyy - cxy * cxy
+            a = (cxt * cyy - cyt * cxy) / det
+            b = (cyt * cxx - cxt * cxy) / det
+            r2 = (a * cxt + b * cyt) / ctt
+            gradient2 = a * a + b * b
+            valid = (n >= self.min_events) & (det > 1e-9) & (r2 >= self.min_r2) & (gradient2 > 0)
+            velocities = np.stack((a, b), axis=1) / gradient2[:, None] * 1e6
+        return velocities, valid